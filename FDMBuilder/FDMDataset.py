@@ -1,5 +1,25 @@
 # from google.cloud import bigquery
 from FDMBuilder.FDMTable import *
+from functools import partial
+
+# Codes stored in the fdm_problem column for each problem, in order of priority
+# (entries are labelled with the first problem they have). Each problem also 
+# sets bit (code - 1) of the fdm_problem_flags column. 0 means no problem.
+PROBLEM_CODES = {
+    "Entry has no person_id": 1,
+    "person_id isn't in master person table": 2,
+    "person has no bith_datetime in master person table": 3,
+    "Entry has no fdm_start_date": 4,
+    "fdm_start_date is before person birth_datetime": 5,
+    "fdm_start_date is after death_datetime (+42 days)": 6,
+    "fdm_start_date is after the end date for the data extract": 7,
+    "Entry has no fdm_end_date": 8,
+    "fdm_end_date is before fdm_start_date": 9,
+    "fdm_end_date is before person birth_datetime": 10,
+    "fdm_end_date is after person death_datetime": 11,
+    "fdm_end_date is after extract end date": 12,
+    "fdm_start_date is before person birth_datetime - Note: Within pre-natal period": 13
+}
     
     
 class FDMDataset:
@@ -20,11 +40,26 @@ class FDMDataset:
         dataset_id = id of dataset where table is to be built in GCP
         person_table_id = full id of person table 
         observation_period_table_id = full id of observation_period table
+        problem_codes_table_id = full id of fdm_problem_codes table - lookup of
+            the problem described by each fdm_problem code
+        journal_table_id = full id of fdm_build_journal table - record of each 
+            completed build step (see `_run_build_step`)
+        partition_by = column source tables (without problems) are 
+            partitioned by, per month (see `build`)
+        cluster_by = columns source and problems tables are clustered by
     """
     def __init__(self, dataset_id):
         self.dataset_id = dataset_id
+        self.problem_storage = "split"
+        self.partition_by = "fdm_start_date"
+        self.cluster_by = ["person_id"]
         self.person_table_id = f"{PROJECT}.{dataset_id}.person"
         self.observation_period_table_id = f"{PROJECT}.{dataset_id}.observation_period"
+        self.problem_codes_table_id = f"{PROJECT}.{dataset_id}.fdm_problem_codes"
+        self.journal_table_id = f"{PROJECT}.{dataset_id}.fdm_build_journal"
+        self._build_journal = {}
+        self._build_inputs = {}
+        self._journal_records = []
         if not check_dataset_exists(self.dataset_id):
             print(f"Dataset {self.dataset_id} doesn't yet exist!\n\n"
                   "Double-check that you've got the correct spelling. If you wish to\n"
@@ -33,7 +68,9 @@ class FDMDataset:
     
     
     def build(self, extract_end_date, excluded_tables=[], 
-              includes_pre_natal=False):
+              includes_pre_natal=False, approximate_data_dicts=False,
+              one_pass_split=True, problem_storage="split", max_workers=1,
+              force=False, partition_by="fdm_start_date", cluster_by=None):
         """Builds the FDM dataset
         
         Simply requires that the dataset specified when initialising the 
@@ -41,15 +78,62 @@ class FDMDataset:
         tables have been "built" using the FDMTable tool. Running .build() then
         generates all the necessary standard FDM tables.
         
+        Each completed step is recorded in the fdm_build_journal table (in a 
+        single load once the build finishes or fails), and re-running the build
+        skips steps whose inputs haven't changed since they last completed (see
+        `_run_build_step`) - so a build that fails part way resumes where it 
+        stopped, and only source tables that have changed are re-split.
+        
         Args:
             includes_pre_natal: bool (default False), determines if observations 
                 dated within pre-natal period before birth (300 days) are 
                 removed, False, or kept, True,  when generating the problem 
                 tables
+            approximate_data_dicts: bool (default False), True builds the data
+                dictionaries with cheaper approximate statistics (see 
+                `FDMTable.build_data_dict`)
+            one_pass_split: bool (default True), True labels problem entries 
+                once and writes the problems and source tables from the 
+                labelled entries in a single script, False uses the original 
+                three separate table rewrites (see 
+                `_split_problem_entries_from_src_tables`)
+            problem_storage: string (default "split"), "split" moves problem 
+                entries from each source table into a [table_name]_fdm_problems
+                table. "flag" keeps all entries in the source table, labelled 
+                in its fdm_problem column, and creates [table_name]_fdm_clean 
+                and [table_name]_fdm_problems views of the entries 
+                without/with problems - source tables then don't need to be 
+                recombined before they're edited (labels are refreshed by the
+                next build). See `_flag_problem_entries_in_src_tables`
+            max_workers: int (default 1), maximum number of tables processed 
+                at once - the per-table steps of the build are independent, so
+                can be run concurrently (see `_get_build_graph`). Each step 
+                only uses its own table's FDMTable, which isn't thread safe. 
+                If a step fails, steps already running are left to finish 
+                (and are recorded in the journal) before the error is raised
+            force: bool (default False), True re-runs every step, even if its
+                inputs are unchanged since the last build
+            partition_by: string (default "fdm_start_date"), date column the 
+                source tables are partitioned by once problem entries are split
+                from them, one partition per month - None doesn't partition 
+                them. Tables with problem entries (problems tables, or source 
+                tables if problem_storage is "flag") aren't partitioned, as 
+                problem dates can exceed BigQuery's limit of 4000 partitions.
+            cluster_by: list (default None), columns the source and problems
+                tables are clustered by (person summary, person and 
+                observation_period tables are clustered by person_id) - None 
+                clusters them by person_id, [] doesn't cluster them
         
         Returns:
             None - all changes in GCP
         """
+        if problem_storage not in ["split", "flag"]:
+            raise ValueError('problem_storage must be either "split" or "flag"')
+        self.problem_storage = problem_storage
+        # normalised, so equivalent settings give the same step fingerprints
+        self.partition_by = partition_by or None
+        self.cluster_by = (["person_id"] if cluster_by is None 
+                           else list(cluster_by))
         
         print(f"\t\t ##### BUILDING FDM DATASET {self.dataset_id} #####")
         print("_" * 80 + "\n")
@@ -63,21 +147,109 @@ class FDMDataset:
             f"\tresolved the issues preventing the build from completing."
             )
             return None
-        print("\n2. Building person table\n")
-        self._build_person_table()
-        print("3. Separating out problem entries from source tables\n")
-        self._split_problem_entries_from_src_tables(extract_end_date, 
-                                                    includes_pre_natal)
-        print("\n4. Rebuilding person table\n")
-        self._build_person_table()
-        print("5. Building observation_period table\n")
-        self._build_observation_period_table()
-        print("6. Building data dictionaries\n")
-        self._build_data_dictionaries()
+        print("\n2. Separating out problem entries from source tables, building "
+              "person and observation_period tables and data dictionaries\n")
+        self._build_journal = {} if force else self._read_build_journal()
+        self._journal_records = []
+        self._build_inputs = {
+            "extract_end_date": str(extract_end_date),
+            "includes_pre_natal": includes_pre_natal,
+            "problem_storage": problem_storage,
+            "partition_by": self.partition_by,
+            "cluster_by": self.cluster_by,
+            "master_person": self._get_table_state(MASTER_PERSON)
+        }
+        build_graph = self._get_build_graph(extract_end_date, 
+                                            includes_pre_natal, 
+                                            approximate_data_dicts, 
+                                            one_pass_split)
+        try:
+            run_dag(build_graph, max_workers=max_workers)
+        finally:
+            self._write_build_journal()
         print("_" * 80 + "\n")
         print(f"\t ##### BUILD PROCESS FOR {self.dataset_id} COMPLETE! #####\n")
         
     
+    def build_delta(self, extract_end_date, excluded_tables=[], 
+                    includes_pre_natal=False):
+        """Merges the new rows of each source table into the built dataset
+        
+        For monthly refreshes of append-only source tables: after the new rows
+        of each source table have been built with `FDMTable.quick_build_delta`
+        (into [table_name]_fdm_delta tables), separates their problem entries 
+        and merges them into the dataset - see `_merge_delta_into_table`. Only
+        the new rows are read, so the cost of a refresh depends on the number
+        of new rows rather than the size of the dataset. Source tables without 
+        a delta table are left as they are.
+        
+        Build steps that were up to date before the merge (see 
+        `_get_current_build_steps`) are recorded as completed in the build 
+        journal afterwards, so the next `build` doesn't redo them.
+        
+        Requires a dataset previously built with `build`. Limitations: 
+        entries already in the dataset aren't re-checked for problems (e.g. if 
+        extract_end_date or the master person table change), and data dicts 
+        aren't refreshed - run `build` to refresh everything.
+        
+        Args:
+            extract_end_date: string, end date of the data extract
+            excluded_tables: list (default []), see `build`
+            includes_pre_natal: bool (default False), see `build`
+            
+        Returns:
+            None - all changes in GCP
+        """
+        print(f"\t\t ##### MERGING NEW ROWS INTO FDM DATASET {self.dataset_id} #####")
+        print("_" * 80 + "\n")
+        for table_id in [self.person_table_id, self.observation_period_table_id]:
+            if not check_table_exists(table_id):
+                raise ValueError(f"{table_id} doesn't exist - run .build() "
+                                 "before .build_delta()")
+        print("1. Checking dataset for source tables:\n")
+        build_ready = self._get_fdm_tables(excluded_tables)
+        if not build_ready:
+            print(
+            "_" * 80 + "\n\n"  
+            f"\t ##### MERGE PROCESS FOR {self.dataset_id} COULD NOT BE COMPLETED! #####\n"
+            f"\tFollow the guidance provided above and then re-run .build_delta()\n"
+            f"\twhen you've resolved the issues preventing the merge from completing."
+            )
+            return None
+        print("\n2. Merging new rows into source, problem, person and "
+              "observation_period tables\n")
+        self._build_journal = self._read_build_journal()
+        self._journal_records = []
+        step_table_ids = self._get_build_step_table_ids()
+        current_steps = self._get_current_build_steps(step_table_ids, 
+                                                      extract_end_date,
+                                                      includes_pre_natal)
+        merged_steps = []
+        try:
+            for table in self.tables:
+                delta_table = table._get_delta_table()
+                if not table._table_exists(delta_table.full_table_id):
+                    print(f"    * {table.table_id} has no new rows")
+                    continue
+                self._merge_delta_into_table(table, delta_table, 
+                                             extract_end_date, 
+                                             includes_pre_natal)
+                # each merge also updates the person and observation_period 
+                # tables
+                merged_steps += [f"problems:{table.table_id}", "person", 
+                                 "observation_period"]
+        finally:
+            for step in dict.fromkeys(merged_steps):
+                if step in current_steps:
+                    fingerprint = self._get_step_fingerprint(
+                        step_table_ids[step], inputs=current_steps[step]
+                    )
+                    self._record_build_step(step, fingerprint, "completed")
+            self._write_build_journal()
+        print("_" * 80 + "\n")
+        print(f"\t ##### MERGE PROCESS FOR {self.dataset_id} COMPLETE! #####\n")
+        
+    
     def create_dataset(self):
         """Creates dataset named in dataset_id if it doesn't already exist
         
@@ -102,23 +274,38 @@ class FDMDataset:
         FDMTable for more info) stores FDMTable objects for each as a list in a 
         `tables` attribute, for use in rest of build process.
         
+        The metadata of all tables in the dataset is read with a single query
+        (see `get_dataset_metadata` in FDM_helpers), and the FDMTable objects 
+        are built from it without any further metadata calls.
+        
         Returns:
             bool, True if all tables are ready for FDM build, otherwise False
         """
               
-        standard_tables = ["person", "observation_period"]
+        standard_tables = ["person", "observation_period", "fdm_problem_codes",
+                           "fdm_build_journal"]
         fdm_src_tables = []
         build_ready = True
-        for table in CLIENT.list_tables(self.dataset_id):
-            is_standard_table = table.table_id in standard_tables
-            is_problem_table = "fdm_problems" in table.table_id
-            is_data_dict = "data_dict" in table.table_id
-            is_excluded = table.table_id in excluded_tables
-            if is_standard_table or is_problem_table or is_data_dict or is_excluded:
+        dataset_metadata = get_dataset_metadata(self.dataset_id)
+        for full_table_id in dataset_metadata.keys():
+            table_id = full_table_id.split(".")[-1]
+            is_standard_table = table_id in standard_tables
+            is_problem_table = ("fdm_problems" in table_id 
+                                or "fdm_clean" in table_id
+                                or "fdm_person_summary" in table_id)
+            is_data_dict = "data_dict" in table_id
+            is_snapshot = ("fdm_snapshot" in table_id 
+                           or table_id.endswith("_fdm_tmp"))
+            is_delta_table = ("fdm_delta" in table_id 
+                              or "fdm_ingested" in table_id)
+            is_excluded = table_id in excluded_tables
+            if (is_standard_table or is_problem_table or is_data_dict 
+                    or is_snapshot or is_delta_table or is_excluded):
                 continue
             fdm_table = FDMTable(
-                source_table_id = (f"{self.dataset_id}.{table.table_id}"),
-                dataset_id = self.dataset_id
+                source_table_id = (f"{self.dataset_id}.{table_id}"),
+                dataset_id = self.dataset_id,
+                dataset_metadata = dataset_metadata
             )
             (exists, has_person_id, person_id_is_int, has_fdm_start, 
              has_fdm_end, has_problem_table) = fdm_table.check_build()
@@ -132,19 +319,17 @@ class FDMDataset:
                                  if not has_fdm_start else "")
                 errors = person_missing + person_not_int + start_missing
                 print(f"""
-    {table.table_id} is not ready for dataset build:\n{errors}
+    {table_id} is not ready for dataset build:\n{errors}
     
-    Complete the table build process for {table.table_id} and then re-run the
+    Complete the table build process for {table_id} and then re-run the
     dataset build -- OR -- if the table doesn't apply to the usual FDM criteria
     e.g. it's a lookup table, then add to the `excluded_tables` argument of 
     `.build()`.
                 """)
                 build_ready = False
             else:
-                if has_problem_table:
-                    fdm_table.recombine()
                 fdm_end = ' fdm_end_date' if has_fdm_end else ''
-                print(f"    * {table.table_id} contains: "
+                print(f"    * {table_id} contains: "
                       f" - INTEGER person_id - fdm_start_date {fdm_end}"
                       "\n\t-> Table ready")
             fdm_src_tables.append(fdm_table)
@@ -152,41 +337,364 @@ class FDMDataset:
         return build_ready
                 
                 
+    def _get_build_graph(self, extract_end_date, includes_pre_natal, 
+                         approximate_data_dicts=False, one_pass_split=True):
+        """Lists the steps of the build after the source tables are checked
+        
+        Steps are nodes of a dependency graph, to be run with `run_dag` (see 
+        FDM_helpers):
+        
+        * problem_codes - builds the fdm_problem_codes table
+        * problems:[table_id] - separates problem entries from a source table, 
+          split or flagged depending on `problem_storage`, and summarises its 
+          entries without problems by person (see `_get_person_summary_sql`)
+        * data_dict:[table_id] - builds a source table's data dict, after its 
+          problem entries are separated
+        * person, observation_period - build the tables, after every source 
+          table's problem entries are separated
+          
+        The problems, person and observation_period steps are skipped if their
+        inputs are unchanged since they last completed (see `_run_build_step`).
+        Data dicts are only rebuilt if their table has changed (see 
+        `FDMTable.build_data_dict`).
+        
+        Args:
+            extract_end_date: string, end date of the data extract
+            includes_pre_natal: bool, True if entries within the pre-natal 
+                period aren't problems, False if they are
+            approximate_data_dicts: bool (default False), True uses approximate
+                statistics (see `FDMTable.build_data_dict`)
+            one_pass_split: bool (default True), see `build`
+                
+        Returns:
+            dict, node name: (function, list of names of nodes it depends on)
+                pairs
+        """
+        step_table_ids = self._get_build_step_table_ids()
+        build_graph = {"problem_codes": (self._build_problem_codes_table, [])}
+        problem_nodes = []
+        for table in self.tables:
+            if self.problem_storage == "flag":
+                separate_problems = partial(self._flag_problem_entries_in_table,
+                                            table, extract_end_date, 
+                                            includes_pre_natal)
+            else:
+                separate_problems = partial(
+                    self._split_problem_entries_from_table, table, 
+                    extract_end_date, includes_pre_natal, 
+                    one_pass=one_pass_split
+                )
+            problem_node = f"problems:{table.table_id}"
+            build_graph[problem_node] = (
+                partial(self._run_build_step, problem_node, 
+                        step_table_ids[problem_node], separate_problems),
+                []
+            )
+            build_graph[f"data_dict:{table.table_id}"] = (
+                partial(self._build_data_dictionary, table, 
+                        approximate=approximate_data_dicts),
+                [problem_node]
+            )
+            problem_nodes.append(problem_node)
+        build_graph["person"] = (
+            partial(self._run_build_step, "person", step_table_ids["person"], 
+                    self._build_person_table),
+            problem_nodes
+        )
+        build_graph["observation_period"] = (
+            partial(self._run_build_step, "observation_period", 
+                    step_table_ids["observation_period"], 
+                    self._build_observation_period_table),
+            problem_nodes
+        )
+        return build_graph
+    
+    
+    def _get_build_step_table_ids(self):
+        """Lists the tables each journalled build step reads/writes
+        
+        Returns:
+            dict, step name (see `_get_build_graph`): list of full table ids 
+                pairs
+        """
+        step_table_ids = {}
+        for table in self.tables:
+            step_table_ids[f"problems:{table.table_id}"] = [
+                table.full_table_id, 
+                f"{table.full_table_id}_fdm_problems",
+                self._get_person_summary_table_id(table)
+            ]
+        # person and observation_period are built from the person summaries, 
+        # so only need rebuilding if a summary has changed
+        summary_table_ids = [self._get_person_summary_table_id(table) 
+                             for table in self.tables]
+        step_table_ids["person"] = summary_table_ids + [self.person_table_id]
+        step_table_ids["observation_period"] = (
+            summary_table_ids + [self.observation_period_table_id]
+        )
+        return step_table_ids
+    
+    
+    def _get_current_build_steps(self, step_table_ids, extract_end_date, 
+                                 includes_pre_natal):
+        """Finds the build steps that are unchanged since they last completed
+        
+        Used by `build_delta` - a step is current if none of its tables have 
+        changed since it last completed, with the same extract_end_date and 
+        includes_pre_natal. Requires the build journal to have been read (see 
+        `_read_build_journal`).
+        
+        Args:
+            step_table_ids: dict, step name: list of full table ids pairs (see
+                `_get_build_step_table_ids`)
+            extract_end_date: string, end date of the data extract
+            includes_pre_natal: bool, see `build`
+            
+        Returns:
+            dict, step name: build inputs of its last completed run pairs
+        """
+        current_steps = {}
+        for step, table_ids in step_table_ids.items():
+            fingerprint = self._build_journal.get(step)
+            if fingerprint is None:
+                continue
+            inputs = fingerprint["inputs"]
+            if (inputs.get("extract_end_date") == str(extract_end_date)
+                    and inputs.get("includes_pre_natal") == includes_pre_natal
+                    and self._get_step_fingerprint(table_ids, inputs) 
+                    == fingerprint):
+                current_steps[step] = inputs
+        return current_steps
+    
+    
+    def _run_build_step(self, step, table_ids, run_step):
+        """Runs a build step, unless it's unchanged since it last completed
+        
+        The step's fingerprint - the build's inputs (extract_end_date, 
+        includes_pre_natal, problem_storage and the state of the master person
+        table) and the state of every table the step reads or writes - is 
+        compared to the fingerprint recorded in the build journal when the step
+        last completed. As the recorded fingerprint is taken after the step, 
+        they only match if nothing has changed since. Otherwise the step is run
+        and its outcome recorded in the journal.
+        
+        Args:
+            step: string, name of the step e.g. "problems:[table_id]"
+            table_ids: list, full ids of the tables the step reads/writes
+            run_step: function, runs the step
+            
+        Returns:
+            None - all changes in GCP
+        """
+        fingerprint = self._get_step_fingerprint(table_ids)
+        if self._build_journal.get(step) == fingerprint:
+            print(f"    * {step} unchanged since last build - skipped")
+            return None
+        try:
+            run_step()
+        except Exception as error:
+            self._record_build_step(step, fingerprint, f"failed: {error}")
+            raise
+        self._record_build_step(step, self._get_step_fingerprint(table_ids), 
+                                "completed")
+        
+        
+    def _get_step_fingerprint(self, table_ids, inputs=None):
+        """Summarises the inputs of a build step to detect changes
+        
+        Args:
+            table_ids: list, full ids of the tables the step reads/writes
+            inputs: dict (default None), build inputs to include - None uses
+                those of the current build
+            
+        Returns:
+            dict, containing the build's inputs and the state of each table 
+                (see `_get_table_state`)
+        """
+        return {
+            "inputs": self._build_inputs if inputs is None else inputs,
+            "tables": {table_id: self._get_table_state(table_id) 
+                       for table_id in table_ids}
+        }
+    
+    
+    def _get_table_state(self, table_id):
+        """Gets the last modified time, number of rows and schema hash of a table
+        
+        Args:
+            table_id: string, full id of the table
+            
+        Returns:
+            dict, containing "modified", "num_rows" and "schema_hash" -- or --
+                None if the table doesn't exist
+        """
+        try:
+            bq_table = CLIENT.get_table(table_id)
+        except NotFound:
+            return None
+        schema_hash = hashlib.sha256(
+            json.dumps([[field.name, field.field_type] 
+                        for field in bq_table.schema]).encode()
+        ).hexdigest()
+        return {
+            "modified": (bq_table.modified.isoformat() 
+                         if bq_table.modified else None),
+            "num_rows": bq_table.num_rows,
+            "schema_hash": schema_hash
+        }
+    
+    
+    def _read_build_journal(self):
+        """Reads the fingerprint of each step when it last completed
+        
+        Creates the fdm_build_journal table if it doesn't exist. Each row of 
+        the journal records a step, its fingerprint (JSON - see 
+        `_get_step_fingerprint`), its outcome ("completed" or "failed: 
+        [error]") and when it was recorded.
+        
+        Returns:
+            dict, step name: fingerprint pairs
+        """
+        create_journal_sql = f"""
+            CREATE TABLE IF NOT EXISTS `{self.journal_table_id}` (
+                step STRING,
+                fingerprint STRING,
+                outcome STRING,
+                recorded_at TIMESTAMP
+            )
+        """
+        run_sql_query(create_journal_sql)
+        journal_sql = f"""
+            SELECT step, fingerprint
+            FROM `{self.journal_table_id}`
+            WHERE outcome = "completed"
+            QUALIFY ROW_NUMBER() OVER (
+                PARTITION BY step ORDER BY recorded_at DESC
+            ) = 1
+        """
+        journal_df = read_sql_query(journal_sql)
+        return {step: json.loads(fingerprint) 
+                for step, fingerprint in zip(journal_df.step, 
+                                             journal_df.fingerprint)}
+    
+    
+    def _record_build_step(self, step, fingerprint, outcome):
+        """Records the outcome of a build step for the build journal
+        
+        Records are held until `_write_build_journal` appends them all to the 
+        journal in one load job, rather than a load job per step.
+        
+        Args:
+            step: string, name of the step
+            fingerprint: dict, fingerprint of the step (see 
+                `_get_step_fingerprint`)
+            outcome: string, "completed" or "failed: [error]"
+            
+        Returns:
+            None
+        """
+        self._journal_records.append({
+            "step": step,
+            "fingerprint": json.dumps(fingerprint),
+            "outcome": outcome,
+            "recorded_at": datetime.datetime.now(datetime.timezone.utc)
+        })
+        
+        
+    def _write_build_journal(self):
+        """Appends the recorded build step outcomes to the build journal
+        
+        Returns:
+            None - all changes in GCP
+        """
+        if not self._journal_records:
+            return None
+        journal_entries = pd.DataFrame(self._journal_records)
+        upload_to_bigquery(journal_entries, self.journal_table_id, 
+                           schema=[{"name": "step", "type": "STRING"},
+                                   {"name": "fingerprint", "type": "STRING"},
+                                   {"name": "outcome", "type": "STRING"},
+                                   {"name": "recorded_at", "type": "TIMESTAMP"}],
+                           write_disposition="WRITE_APPEND")
+        self._journal_records = []
+    
+    
+    def _get_person_summary_table_id(self, table):
+        """Gets the id of a source table's person summary table
+        
+        Args:
+            table: FDMTable, the source table
+            
+        Returns:
+            string, full id of [table_name]_fdm_person_summary
+        """
+        return f"{table.full_table_id}_fdm_person_summary"
+    
+    
+    def _get_person_summary_sql(self, table, relation, condition="TRUE"):
+        """Generates query summarising a source table's entries by person
+        
+        The summary has a row for each person_id with the earliest 
+        fdm_start_date (min_fdm_start_date), latest fdm_end_date - or 
+        fdm_start_date if the table has no end date - (max_fdm_end_date) and 
+        number of entries (n_events). Summaries of the entries without problems
+        are built when problem entries are separated, and the person and 
+        observation_period tables are built from them rather than the (much
+        larger) source tables.
+        
+        Args:
+            table: FDMTable, the source table
+            relation: string, table id in backticks/subquery/temp table name of
+                the entries to summarise
+            condition: string (default "TRUE"), SQL condition selecting the 
+                entries to summarise e.g. "fdm_problem = 0"
+                
+        Returns:
+            string, SQL query returning the summary
+        """
+        end_date_column = ("fdm_end_date" 
+                           if "fdm_end_date" in table.get_column_names()
+                           else "fdm_start_date")
+        return f"""
+            SELECT person_id, 
+                MIN(fdm_start_date) AS min_fdm_start_date,
+                MAX({end_date_column}) AS max_fdm_end_date,
+                COUNT(*) AS n_events
+            FROM {relation}
+            WHERE person_id IS NOT NULL AND {condition}
+            GROUP BY person_id
+        """
+    
+    
     def _build_person_table(self):
         """Builds person table for dataset
         
-        Collects all the unique person_ids in each of the source tables and 
-        generates a copy of the master person table with entries that match 
-        these ids. If a person table already exists, a fresh table is built and 
-        overwrites the existing person table.
+        Generates a copy of the master person table with the entries whose 
+        person_id appears in any of the source tables' entries without 
+        problems, in a single query. The person_ids are read from the source 
+        tables' person summaries (see `_get_person_summary_sql`), so it's run 
+        after problem entries are separated (problem rules read the master 
+        person table directly - see `_get_problem_entries_sql`). If a person 
+        table already exists, a fresh table is built and overwrites the 
+        existing person table.
         
         Returns:
             None - all changes in GCP
         """
-        # generate new table with unique person ids
         person_id_union_sql = "\nUNION ALL\n".join(
-            [f"SELECT person_id FROM `{table.full_table_id}`"
+            [f"SELECT person_id FROM `{self._get_person_summary_table_id(table)}`"
              for table in self.tables]
         )
-        person_ids_sql = f"""
-            WITH person_ids AS (
+        full_person_table_sql = f"""
+            SELECT person_id, * EXCEPT(person_id)
+            FROM `{MASTER_PERSON}`
+            WHERE person_id IN (
                 {person_id_union_sql}
             )
-            SELECT DISTINCT person_id
-            FROM person_ids
-        """
-        run_sql_query(person_ids_sql, destination=self.person_table_id) 
-        
-        # join columns from master person table in query
-        full_person_table_sql = f"""
-            SELECT a.person_id, b.* EXCEPT(person_id)
-            FROM `{self.person_table_id}` a
-            INNER JOIN `{MASTER_PERSON}` b
-            ON a.person_id = b.person_id
-            ORDER BY person_id
         """
         person_bq_table = run_sql_query(full_person_table_sql,  
-                                        destination=self.person_table_id)
+                                        destination=self.person_table_id,
+                                        cluster_by=["person_id"])
         
         print(f"    * Person table built with {person_bq_table.num_rows} "
               "entries\n")
@@ -195,72 +703,90 @@ class FDMDataset:
     def _build_observation_period_table(self):
         """Builds the observation period table
         
-        Creates a union of the start/end dates in all the source tables and 
-        calculates a MIN start date and MAX end date for each unique person_id. 
-        The process assumes all the error entries have already been removed 
-        (see _split_problem_entries_from_src_tables)
+        Creates a union of the per-person start/end dates of all the source 
+        tables (see `_get_person_summary_sql`) and calculates a MIN start date 
+        and MAX end date for each unique person_id. The summaries only cover
+        entries without problems, so the process assumes problem entries have 
+        already been separated (see _split_problem_entries_from_src_tables)
         
         Returns:
             None - all changes in GCP
         """
-        full_union_sql_list = []
-        for table in self.tables:
-            no_end_date = "fdm_end_date" not in table.get_column_names()
-            union_sql = f"""
-                SELECT person_id, fdm_start_date, 
-                    {"fdm_start_date AS fdm_end_date"
-                     if no_end_date else "fdm_end_date"}
-                FROM `{table.full_table_id}`  
-                WHERE person_id IS NOT NULL
+        full_union_sql = "\nUNION ALL\n".join([
+            f"""
+                SELECT person_id, min_fdm_start_date, max_fdm_end_date
+                FROM `{self._get_person_summary_table_id(table)}`
             """
-            full_union_sql_list.append(union_sql)
-                
-        full_union_sql = "\nUNION ALL\n".join(full_union_sql_list)
+            for table in self.tables
+        ])
             
         observation_period_sql = f"""
             WITH all_src_dates AS (
                 {full_union_sql}
             )
             SELECT person_id, 
-                MIN(fdm_start_date) AS observation_period_start_date,
-                MAX(fdm_end_date) AS observation_period_end_date 
+                MIN(min_fdm_start_date) AS observation_period_start_date,
+                MAX(max_fdm_end_date) AS observation_period_end_date 
             FROM all_src_dates
             GROUP BY person_id
         """
         obs_bq_table = run_sql_query(observation_period_sql, 
-                                     destination=self.observation_period_table_id)
+                                     destination=self.observation_period_table_id,
+                                     cluster_by=["person_id"])
         
         print(f"    * observation_period table built with {obs_bq_table.num_rows} "
               "entries\n")
         
         
-    def _build_data_dictionaries(self):
+    def _build_data_dictionaries(self, approximate=False):
         """Builds a data dict in GCP for each source table
         
         Simply takes all the tables in the `tables` attribute and calls the 
-        `build_data_dict` method for each 
+        `build_data_dict` method for each - data dicts for tables that haven't
+        changed since their last build are kept
+        
+        Args:
+            approximate: bool (default False), True uses approximate statistics
+                (see `FDMTable.build_data_dict`)
         
         Returns:
             None - all changes in GCP
         """
         for table in self.tables:
-            table.build_data_dict()
+            self._build_data_dictionary(table, approximate=approximate)
+            
+            
+    def _build_data_dictionary(self, table, approximate=False):
+        """Builds the data dict in GCP for a source table
+        
+        Args:
+            table: FDMTable, the source table
+            approximate: bool (default False), True uses approximate statistics
+                (see `FDMTable.build_data_dict`)
+        
+        Returns:
+            None - all changes in GCP
+        """
+        if table.build_data_dict(approximate=approximate):
             print(f"    * {table.table_id}_data_dict built")
+        else:
+            print(f"    * {table.table_id}_data_dict unchanged")
         
         
     def _add_problem_entries_column_to_table(self, table, extract_end_date, 
                                              includes_pre_natal):
         """Labels all problem entries in a table
         
-        Creates a "problems" column in the input table and labels any entries 
-        that have a "problem" - problems include:
+        Creates "problems" columns in the input table and labels any entries 
+        that have a "problem" (see `_get_problem_entries_sql`) - problems 
+        include:
         
         * No person_id
         * person_id doesn't appear in master person table
         * event date before birth date
         * event date after death date (+42 days)
         
-        and so on - read the code for the full list of "problems"
+        and so on - see `_get_problem_rules` for the full list of "problems"
         
         Args:
             table: FDMTable, table to which problems column is added
@@ -272,145 +798,173 @@ class FDMDataset:
         Returns:
             None - all changes in GCP
         """
-        if "fdm_problem" in table.get_column_names():
-            print(f"\tfdm_problem column already exists in {table.table_id}."
-                  " Dropping...")
-            table.drop_column("fdm_problem")
-         
-        no_person_id = "person_id IS NULL"
-        person_id_not_in_master = f"""
-            NOT EXISTS(
-                SELECT person_id
-                FROM `{self.person_table_id}` as person
-                WHERE person.person_id = src.person_id
-            )
+        self._drop_problem_columns(table)
+        problem_tab_sql = self._get_problem_entries_sql(table, 
+                                                        extract_end_date, 
+                                                        includes_pre_natal)
+        # clustered by fdm_problem first, so reads of entries with/without 
+        # problems only scan the blocks they need
+        run_sql_query(problem_tab_sql, destination=table.full_table_id,
+                      cluster_by=(["fdm_problem"] + self.cluster_by)[:4])
+        table._invalidate_metadata()
+        
+        
+    def _drop_problem_columns(self, table):
+        """Drops problem columns left in a table by a previous build
+        
+        Args:
+            table: FDMTable, the source table
+            
+        Returns:
+            None - all changes in GCP
         """
-        person_has_no_dob = f"""
-            EXISTS(
-                SELECT person_id
-                FROM `{self.person_table_id}` as person
-                WHERE person.person_id = src.person_id
-                    AND person.birth_datetime IS NULL
-            )
+        for column in ["fdm_problem", "fdm_problem_flags"]:
+            if column in table.get_column_names():
+                print(f"\t{column} column already exists in {table.table_id}."
+                      " Dropping...")
+                table.drop_column(column)
+                
+                
+    def _build_problem_codes_table(self):
+        """Builds the fdm_problem_codes lookup table
+        
+        Lists each problem code (see PROBLEM_CODES) with its bit in the 
+        fdm_problem_flags column and the problem it describes.
+        
+        Returns:
+            None - all changes in GCP
         """
-        no_fdm_start_date = "fdm_start_date is NULL"
-        fdm_start_before_pre_natal_period = f"""
-            EXISTS(
-                SELECT birth_datetime
-                FROM `{self.person_table_id}` AS person
-                WHERE src.person_id = person.person_id 
-                    AND DATETIME_ADD(
-                        src.fdm_start_date, 
-                        INTERVAL 294 DAY) < person.birth_datetime
-            )
-        """       
-        fdm_start_after_death = f"""
-            EXISTS(
-                SELECT death_datetime
-                FROM `{self.person_table_id}` AS person
-                WHERE src.person_id = person.person_id 
-                    AND person.death_datetime IS NOT NULL
-                    AND src.fdm_start_date > DATETIME_ADD(person.death_datetime,
-                                                            INTERVAL 42 DAY)
-            )
+        problem_structs = ",\n                ".join(
+            [f'STRUCT(0 AS fdm_problem, 0 AS fdm_problem_bit, '
+             f'"No problem" AS description)']
+            + [f'({code}, {1 << (code - 1)}, "{problem_text}")'
+               for problem_text, code in PROBLEM_CODES.items()]
+        )
+        problem_codes_sql = f"""
+            SELECT *
+            FROM UNNEST([
+                {problem_structs}
+            ])
         """
-        fdm_start_after_extract_end = f"""
-            EXISTS(
-                SELECT fdm_start_date
-                FROM `{self.person_table_id}` AS person
-                WHERE src.person_id = person.person_id 
-                    AND src.fdm_start_date > CAST("{extract_end_date}" AS DATETIME)
-            )
+        run_sql_query(problem_codes_sql, destination=self.problem_codes_table_id)
+        
+        
+    def _get_problem_rules(self, table, extract_end_date, includes_pre_natal):
+        """Lists the rules that identify problem entries, in order of priority
+        
+        Each rule is a plain predicate on the source table (aliased src) and 
+        the master person table LEFT JOINed on person_id (aliased person) - see 
+        `_get_problem_entries_sql`. Entries are labelled with the code (see 
+        PROBLEM_CODES) of the first rule they match. Rules on person columns
+        check the person exists, so entries are only flagged with the rules
+        they actually break.
+        
+        Args:
+            table: FDMTable, table the rules apply to
+            extract_end_date: string, end date of the data extract
+            includes_pre_natal: bool, True if entries within the pre-natal 
+                period aren't problems, False if they are
+                
+        Returns:
+            dict, problem message: SQL predicate pairs, in order of priority
         """
+        extract_end = f'CAST("{extract_end_date}" AS DATETIME)'
         messages_with_problem_cases = {
-            "Entry has no person_id": no_person_id,
-            "person_id isn't in master person table": person_id_not_in_master,
-            "person has no bith_datetime in master person table": person_has_no_dob,
-            "Entry has no fdm_start_date": no_fdm_start_date,
+            "Entry has no person_id": "src.person_id IS NULL",
+            "person_id isn't in master person table": 
+            "src.person_id IS NOT NULL AND person.person_id IS NULL",
+            "person has no bith_datetime in master person table": 
+            "person.person_id IS NOT NULL AND person.birth_datetime IS NULL",
+            "Entry has no fdm_start_date": "src.fdm_start_date IS NULL",
             "fdm_start_date is before person birth_datetime": 
-            fdm_start_before_pre_natal_period,
+            "DATETIME_ADD(src.fdm_start_date, INTERVAL 294 DAY) "
+            "< person.birth_datetime",
             "fdm_start_date is after death_datetime (+42 days)": 
-            fdm_start_after_death,
+            "person.death_datetime IS NOT NULL AND src.fdm_start_date "
+            "> DATETIME_ADD(person.death_datetime, INTERVAL 42 DAY)",
             "fdm_start_date is after the end date for the data extract":
-            fdm_start_after_extract_end
+            f"src.fdm_start_date > {extract_end}"
         }
         if "fdm_end_date" in table.get_column_names():
-            no_fdm_end_date = "fdm_end_date is NULL"
-            end_before_start = "fdm_end_date < fdm_start_date"
-            fdm_end_before_birth = f"""
-                EXISTS(
-                    SELECT birth_datetime
-                    FROM `{self.person_table_id}` AS person
-                    WHERE src.person_id = person.person_id 
-                        AND src.fdm_end_date < person.birth_datetime
-                )
-            """
-            fdm_end_after_death = f"""
-                EXISTS(
-                    SELECT death_datetime
-                    FROM `{self.person_table_id}` AS person
-                    WHERE src.person_id = person.person_id 
-                        AND person.death_datetime IS NOT NULL
-                        AND src.fdm_end_date > DATETIME_ADD(person.death_datetime, 
-                                                              INTERVAL 42 DAY)
-                )
-            """
-            fdm_end_after_extract_end = f"""
-                EXISTS(
-                    SELECT fdm_end_date
-                    FROM `{self.person_table_id}` AS person
-                    WHERE src.person_id = person.person_id 
-                        AND src.fdm_end_date > CAST("{extract_end_date}" AS DATETIME)
-                )
-            """
-            messages_with_problem_cases[
-                "Entry has no fdm_end_date"
-            ] = no_fdm_end_date
-            messages_with_problem_cases[
-                "fdm_end_date is before fdm_start_date"
-            ] = end_before_start
-            messages_with_problem_cases[
-                "fdm_end_date is before person birth_datetime" 
-            ] = fdm_end_before_birth
-            messages_with_problem_cases[
-                "fdm_end_date is after person death_datetime"
-            ] = fdm_end_after_death
-            messages_with_problem_cases[
-                "fdm_end_date is after extract end date"
-            ] = fdm_end_after_extract_end
-
+            messages_with_problem_cases.update({
+                "Entry has no fdm_end_date": "src.fdm_end_date IS NULL",
+                "fdm_end_date is before fdm_start_date": 
+                "src.fdm_end_date < src.fdm_start_date",
+                "fdm_end_date is before person birth_datetime": 
+                "src.fdm_end_date < person.birth_datetime",
+                "fdm_end_date is after person death_datetime":
+                "person.death_datetime IS NOT NULL AND src.fdm_end_date "
+                "> DATETIME_ADD(person.death_datetime, INTERVAL 42 DAY)",
+                "fdm_end_date is after extract end date":
+                f"src.fdm_end_date > {extract_end}"
+            })
         if not includes_pre_natal:
-            fdm_start_in_pre_natal_period = f"""
-                EXISTS(
-                    SELECT birth_datetime
-                    FROM `{self.person_table_id}` AS person
-                    WHERE src.person_id = person.person_id 
-                        AND src.fdm_start_date < person.birth_datetime
-                        AND DATETIME_ADD(
-                            src.fdm_start_date, 
-                            INTERVAL 300 DAY) >= person.birth_datetime
-                )
-            """       
             messages_with_problem_cases[
                 "fdm_start_date is before person birth_datetime - Note: Within pre-natal period" 
-            ] = fdm_start_in_pre_natal_period
-
+            ] = ("src.fdm_start_date < person.birth_datetime AND DATETIME_ADD("
+                 "src.fdm_start_date, INTERVAL 300 DAY) >= person.birth_datetime")
+        return messages_with_problem_cases
+    
+    
+    def _get_problem_entries_sql(self, table, extract_end_date, 
+                                 includes_pre_natal):
+        """Generates query labelling every entry of a table with its problems
+        
+        The master person table is LEFT JOINed once, and every rule (see 
+        `_get_problem_rules`) evaluated as a plain predicate. The master person
+        table is reduced to one row per person_id before the join (keeping a 
+        row with a birth_datetime where there is one), so duplicate person_ids
+        can't duplicate entries. Two columns are added:
+        
+        * fdm_problem - INTEGER code of the first problem the entry has (see 
+          PROBLEM_CODES and the fdm_problem_codes table), 0 if no problem
+        * fdm_problem_flags - INTEGER bitmask of every problem the entry has, 
+          bit (code - 1) set for each
+          
+        
+        Args:
+            table: FDMTable, table to be labelled
+            extract_end_date: string, end date of the data extract
+            includes_pre_natal: bool, True if entries within the pre-natal 
+                period aren't problems, False if they are
+                
+        Returns:
+            string, SQL query returning the table with fdm_problem and 
+                fdm_problem_flags columns
+        """
+        messages_with_problem_cases = self._get_problem_rules(table, 
+                                                              extract_end_date,
+                                                              includes_pre_natal)
         problem_col_cases = ("CASE " + " ".join([
-            f'WHEN {problem_sql} THEN "{problem_text}"'
+            f'WHEN {problem_sql} THEN {PROBLEM_CODES[problem_text]}'
             for problem_text, problem_sql in messages_with_problem_cases.items()
-        ]) + ' ELSE "No problem" END')
+        ]) + ' ELSE 0 END')
+        problem_flags = " | ".join([
+            f'IF({problem_sql}, {1 << (PROBLEM_CODES[problem_text] - 1)}, 0)'
+            for problem_text, problem_sql in messages_with_problem_cases.items()
+        ])
 
-        problem_tab_sql = f"""
-            SELECT {problem_col_cases} AS fdm_problem, *
+        return f"""
+            SELECT {problem_col_cases} AS fdm_problem, 
+                {problem_flags} AS fdm_problem_flags, 
+                src.*
             FROM `{table.full_table_id}` AS src
-            ORDER BY person_id
+            LEFT JOIN (
+                SELECT person_id, birth_datetime, death_datetime
+                FROM `{MASTER_PERSON}`
+                WHERE person_id IS NOT NULL
+                QUALIFY ROW_NUMBER() OVER (
+                    PARTITION BY person_id 
+                    ORDER BY birth_datetime DESC, death_datetime DESC
+                ) = 1
+            ) AS person
+            ON src.person_id = person.person_id
         """
-
-        run_sql_query(problem_tab_sql, destination=table.full_table_id)
             
             
     def _split_problem_entries_from_src_tables(self,  extract_end_date, 
-                                               includes_pre_natal):
+                                               includes_pre_natal, 
+                                               one_pass=True):
         """Splits source tables into those with/without problems
         
         Takes each source table with a problems column, and separates the 
@@ -422,34 +976,435 @@ class FDMDataset:
                 i.e. after conception but prior to birth should be counted 
                 as problems or not. True, pre-natal events aren't problems, 
                 False, they are.
+            one_pass: bool (default True), True splits each table with 
+                `_split_problem_entries_in_one_pass`, False adds the problems
+                column to the source table, then writes the problems table, 
+                then rewrites the source table
                 
         Returns:
             None - all changes in GCP
         """
         for table in self.tables:
+            self._split_problem_entries_from_table(table, extract_end_date, 
+                                                   includes_pre_natal, 
+                                                   one_pass=one_pass)
+            
+            
+    def _split_problem_entries_from_table(self, table, extract_end_date, 
+                                          includes_pre_natal, one_pass=True):
+        """Splits a source table into those with/without problems
+        
+        Args:
+            table: FDMTable, table to be split
+            extract_end_date: string, end date of the data extract
+            includes_pre_natal: bool, True if entries within the pre-natal 
+                period aren't problems, False if they are
+            one_pass: bool (default True), see 
+                `_split_problem_entries_from_src_tables`
+                
+        Returns:
+            None - all changes in GCP
+        """
+        self._drop_problem_views(table)
+        self._recombine_problem_entries(table)
+        if one_pass:
+            self._split_problem_entries_in_one_pass(table, 
+                                                    extract_end_date,
+                                                    includes_pre_natal)
+            return None
+        self._add_problem_entries_column_to_table(table,
+                                                  extract_end_date, 
+                                                  includes_pre_natal)
+        problem_table_sql = f"""
+            SELECT * FROM `{table.full_table_id}`
+            WHERE fdm_problem != 0
+        """
+        problem_table_id = f"{table.full_table_id}_fdm_problems"
+        problem_bq_table = run_sql_query(problem_table_sql, 
+                                         destination=problem_table_id,
+                                         cluster_by=self.cluster_by)
 
-            print(f"    {table.table_id}:")
-            self._add_problem_entries_column_to_table(table,
-                                                      extract_end_date, 
-                                                      includes_pre_natal)
-            problem_table_sql = f"""
-                SELECT * FROM `{table.full_table_id}`
-                WHERE fdm_problem != "No problem"
-                ORDER BY person_id
+        src_table_sql = f"""
+            SELECT * EXCEPT(fdm_problem, fdm_problem_flags) 
+            FROM `{table.full_table_id}`
+            WHERE fdm_problem = 0
+        """
+        src_bq_table = run_sql_query(src_table_sql, 
+                                     destination=table.full_table_id,
+                                     partition_by=self.partition_by,
+                                     cluster_by=self.cluster_by)
+        table._invalidate_metadata()
+        run_sql_query(self._get_person_summary_sql(table, 
+                                                   f"`{table.full_table_id}`"),
+                      destination=self._get_person_summary_table_id(table),
+                      cluster_by=["person_id"])
+        self._print_problem_counts(table, problem_bq_table.num_rows, 
+                                   src_bq_table.num_rows)
+            
+            
+    def _split_problem_entries_in_one_pass(self, table, extract_end_date, 
+                                           includes_pre_natal):
+        """Splits a source table into those with/without problems in one pass
+        
+        Runs a single script that labels every entry once (see 
+        `_get_problem_entries_sql`) into a temp table clustered by 
+        fdm_problem, then writes the problems table and the source table 
+        from it. Clustering means each write only reads the blocks of the 
+        temp table it needs, so the source table is read once instead of 
+        three times and the labelled table is never written over the source.
+        The tables are partitioned/clustered as set in `build`.
+        The person summary of the entries without problems (see 
+        `_get_person_summary_sql`) is written from it too.
+        
+        Args:
+            table: FDMTable, table to be split
+            extract_end_date: string, end date of the data extract
+            includes_pre_natal: bool, True if entries within the pre-natal 
+                period aren't problems, False if they are
+                
+        Returns:
+            None - all changes in GCP
+        """
+        self._drop_problem_columns(table)
+        problem_entries_sql = self._get_problem_entries_sql(
+            table, extract_end_date, includes_pre_natal
+        )
+        problem_table_id = f"{table.full_table_id}_fdm_problems"
+        summary_table_id = self._get_person_summary_table_id(table)
+        summary_sql = self._get_person_summary_sql(table, "fdm_labelled", 
+                                                   "fdm_problem = 0")
+        src_table_options_sql = get_partition_and_cluster_sql(
+            self.partition_by, 
+            table._get_table_schema_dict().get(self.partition_by),
+            self.cluster_by
+        )
+        # tables that are partitioned/clustered differently are written to 
+        # temp tables, then replaced (see `get_destination_for_spec`)
+        destinations = {
+            problem_table_id: get_destination_for_spec(
+                problem_table_id, cluster_by=self.cluster_by
+            ),
+            table.full_table_id: get_destination_for_spec(
+                table.full_table_id, self.partition_by, self.cluster_by
+            ),
+            summary_table_id: get_destination_for_spec(
+                summary_table_id, cluster_by=["person_id"]
+            )
+        }
+        split_script = f"""
+            CREATE TEMP TABLE fdm_labelled 
+            CLUSTER BY fdm_problem
+            AS {problem_entries_sql};
+            
+            CREATE OR REPLACE TABLE `{destinations[problem_table_id]}` 
+            {get_partition_and_cluster_sql(cluster_by=self.cluster_by)}
+            AS
+            SELECT * FROM fdm_labelled
+            WHERE fdm_problem != 0;
+            
+            CREATE OR REPLACE TABLE `{destinations[table.full_table_id]}` 
+            {src_table_options_sql}
+            AS
+            SELECT * EXCEPT(fdm_problem, fdm_problem_flags) FROM fdm_labelled
+            WHERE fdm_problem = 0;
+            
+            CREATE OR REPLACE TABLE `{destinations[summary_table_id]}` 
+            CLUSTER BY person_id
+            AS {summary_sql};
+        """
+        run_sql_query(split_script)
+        for table_id, destination in destinations.items():
+            if destination != table_id:
+                replace_table(table_id, destination)
+        table._invalidate_metadata()
+        problem_bq_table = CLIENT.get_table(problem_table_id)
+        src_bq_table = CLIENT.get_table(table.full_table_id)
+        self._print_problem_counts(table, problem_bq_table.num_rows, 
+                                   src_bq_table.num_rows)
+        
+        
+    def _print_problem_counts(self, table, n_problems, n_clean, flagged=False):
+        """Prints the number of entries with/without problems in a source table
+        
+        Printed in one go, so the counts for tables processed at the same time
+        aren't interleaved.
+        
+        Args:
+            table: FDMTable, the source table
+            n_problems: int, number of entries with problems
+            n_clean: int, number of entries without problems
+            flagged: bool (default False), True if problem entries were flagged
+                rather than split from the table
+            
+        Returns:
+            None
+        """
+        if flagged:
+            print(f"    {table.table_id}:\n"
+                  f"\t* {n_problems} problem entries identified and flagged "
+                  f"in {table.table_id}_fdm_problems\n"
+                  f"\t* {n_clean} entries in {table.table_id}_fdm_clean")
+        else:
+            print(f"    {table.table_id}:\n"
+                  f"\t* {n_problems} problem entries identified and removed "
+                  f"to {table.table_id}_fdm_problems\n"
+                  f"\t* {n_clean} entries remain in {table.table_id}")
+    
+    
+    def _flag_problem_entries_in_src_tables(self, extract_end_date, 
+                                            includes_pre_natal):
+        """Labels problem entries in source tables and creates views of them
+        
+        Alternative to `_split_problem_entries_from_src_tables` that leaves all
+        entries in each source table, labelled in its fdm_problem column (see
+        `_add_problem_entries_column_to_table`), and creates two views:
+        
+        * [table_name]_fdm_clean - entries without problems (without the 
+          fdm_problem column)
+        * [table_name]_fdm_problems - entries with problems
+        
+        The person summary of the entries without problems (see 
+        `_get_person_summary_sql`) is also built.
+        
+        Args:
+            extract_end_date: string, end date of the data extract
+            includes_pre_natal: bool, True if entries within the pre-natal 
+                period aren't problems, False if they are
+                
+        Returns:
+            None - all changes in GCP
+        """
+        for table in self.tables:
+            self._flag_problem_entries_in_table(table, extract_end_date, 
+                                                includes_pre_natal)
+            
+            
+    def _flag_problem_entries_in_table(self, table, extract_end_date, 
+                                       includes_pre_natal):
+        """Labels problem entries in a source table and creates views of them
+        
+        See `_flag_problem_entries_in_src_tables`.
+        
+        Args:
+            table: FDMTable, table to be labelled
+            extract_end_date: string, end date of the data extract
+            includes_pre_natal: bool, True if entries within the pre-natal 
+                period aren't problems, False if they are
+                
+        Returns:
+            None - all changes in GCP
+        """
+        self._recombine_problem_entries(table)
+        self._add_problem_entries_column_to_table(table,
+                                                  extract_end_date, 
+                                                  includes_pre_natal)
+        summary_table_id = self._get_person_summary_table_id(table)
+        summary_destination = get_destination_for_spec(summary_table_id, 
+                                                       cluster_by=["person_id"])
+        summary_sql = self._get_person_summary_sql(
+            table, f"`{table.full_table_id}`", "fdm_problem = 0"
+        )
+        views_sql = f"""
+            CREATE OR REPLACE VIEW `{table.full_table_id}_fdm_problems` AS
+            SELECT * FROM `{table.full_table_id}`
+            WHERE fdm_problem != 0;
+            
+            CREATE OR REPLACE VIEW `{table.full_table_id}_fdm_clean` AS
+            SELECT * EXCEPT(fdm_problem, fdm_problem_flags) 
+            FROM `{table.full_table_id}`
+            WHERE fdm_problem = 0;
+            
+            CREATE OR REPLACE TABLE `{summary_destination}` 
+            CLUSTER BY person_id
+            AS {summary_sql};
+        """
+        run_sql_query(views_sql)
+        if summary_destination != summary_table_id:
+            replace_table(summary_table_id, summary_destination)
+        table._invalidate_metadata()
+        
+        counts_sql = f"""
+            SELECT COUNTIF(fdm_problem != 0) AS n_problems,
+                COUNTIF(fdm_problem = 0) AS n_clean
+            FROM `{table.full_table_id}`
+        """
+        counts_df = read_sql_query(counts_sql)
+        self._print_problem_counts(table, counts_df.n_problems[0], 
+                                   counts_df.n_clean[0], flagged=True)
+            
+            
+    def _merge_delta_into_table(self, table, delta_table, extract_end_date, 
+                                includes_pre_natal):
+        """Merges the new rows of a source table into the dataset
+        
+        Runs a single script that labels the new rows (see 
+        `_get_problem_entries_sql`) into a temp table then, in one 
+        transaction:
+        
+        * inserts them into the source table and problems table - or - just 
+          the source table if problems are flagged (the views update themselves)
+        * records the fingerprints of the new rows as ingested (see 
+          `FDMTable.quick_build_delta`)
+        * MERGEs the new rows without problems into the table's person summary
+          (see `_get_person_summary_sql`)
+        * MERGEs people from the master person table into the person table, if 
+          they're new to the dataset
+        * MERGEs the new rows' dates into the observation_period table, 
+          extending existing periods and adding new ones
+          
+        The person and observation_period changes are computed from a summary 
+        of the new rows, rather than the rows themselves.
+          
+        The delta table is deleted afterwards. New rows are matched to the 
+        tables' columns by name - columns the tables don't have are dropped.
+        
+        Args:
+            table: FDMTable, the source table
+            delta_table: FDMTable, the source table's delta table (see 
+                `FDMTable._get_delta_table`)
+            extract_end_date: string, end date of the data extract
+            includes_pre_natal: bool, True if entries within the pre-natal 
+                period aren't problems, False if they are
+                
+        Returns:
+            None - all changes in GCP
+        """
+        problems_table_id = f"{table.full_table_id}_fdm_problems"
+        for table_id in [problems_table_id, 
+                         self._get_person_summary_table_id(table)]:
+            if not table._table_exists(table_id):
+                raise ValueError(f"{table_id} doesn't exist - run .build() "
+                                 "before .build_delta()")
+        labelled_sql = self._get_problem_entries_sql(
+            delta_table, extract_end_date, includes_pre_natal
+        )
+        delta_columns = delta_table.get_column_names()
+        labelled_columns = ["fdm_problem", "fdm_problem_flags"] + delta_columns
+        
+        def get_insert_sql(target_table_id, target_columns, condition):
+            columns = ", ".join(column for column in target_columns
+                                if column in labelled_columns)
+            return f"""
+                INSERT INTO `{target_table_id}` ({columns})
+                SELECT {columns} FROM fdm_labelled
+                WHERE {condition};
             """
-            problem_table_id = f"{table.full_table_id}_fdm_problems"
-            problem_bq_table = run_sql_query(problem_table_sql, 
-                                             destination=problem_table_id)
-            print(f"\t* {problem_bq_table.num_rows} problem entries identified "
-                  f"and removed to {table.table_id}_fdm_problems")
-
-            src_table_sql = f"""
-                SELECT * EXCEPT(fdm_problem) FROM `{table.full_table_id}`
-                WHERE fdm_problem = "No problem"
-                ORDER BY person_id
+        
+        if table._problems_table_is_view():
+            insert_sql = get_insert_sql(table.full_table_id, 
+                                        table.get_column_names(), "TRUE")
+        else:
+            problems_columns = table._get_table_metadata(
+                problems_table_id
+            )["schema"].keys()
+            insert_sql = (get_insert_sql(problems_table_id, problems_columns, 
+                                         "fdm_problem != 0")
+                          + get_insert_sql(table.full_table_id, 
+                                           table.get_column_names(), 
+                                           "fdm_problem = 0"))
+        if "fdm_row_fingerprint" in delta_columns:
+            insert_sql += f"""
+                INSERT INTO `{table.full_table_id}_fdm_ingested` 
+                    (fdm_row_fingerprint)
+                SELECT fdm_row_fingerprint FROM fdm_labelled;
             """
-            src_bq_table = run_sql_query(src_table_sql, 
-                                         destination=table.full_table_id)
-            print(f"\t* {src_bq_table.num_rows} entries remain in {table.table_id}")
+        delta_summary_sql = self._get_person_summary_sql(
+            delta_table, "fdm_labelled", "fdm_problem = 0"
+        )
+        merge_script = f"""
+            CREATE TEMP TABLE fdm_labelled AS {labelled_sql};
+            
+            CREATE TEMP TABLE fdm_delta_summary AS {delta_summary_sql};
+            
+            BEGIN TRANSACTION;
+            
+            {insert_sql}
+            
+            MERGE `{self._get_person_summary_table_id(table)}` AS summary
+            USING fdm_delta_summary AS delta
+            ON summary.person_id = delta.person_id
+            WHEN MATCHED THEN UPDATE SET 
+                min_fdm_start_date = LEAST(summary.min_fdm_start_date, 
+                                           delta.min_fdm_start_date),
+                max_fdm_end_date = GREATEST(summary.max_fdm_end_date, 
+                                            delta.max_fdm_end_date),
+                n_events = summary.n_events + delta.n_events
+            WHEN NOT MATCHED THEN INSERT (person_id, min_fdm_start_date,
+                                          max_fdm_end_date, n_events)
+            VALUES (delta.person_id, delta.min_fdm_start_date, 
+                    delta.max_fdm_end_date, delta.n_events);
+            
+            MERGE `{self.person_table_id}` AS person
+            USING (
+                SELECT person_id, * EXCEPT(person_id)
+                FROM `{MASTER_PERSON}`
+                WHERE person_id IN (SELECT person_id FROM fdm_delta_summary)
+            ) AS new_person
+            ON person.person_id = new_person.person_id
+            WHEN NOT MATCHED THEN INSERT ROW;
+            
+            MERGE `{self.observation_period_table_id}` AS obs
+            USING fdm_delta_summary AS delta
+            ON obs.person_id = delta.person_id
+            WHEN MATCHED AND (
+                delta.min_fdm_start_date < obs.observation_period_start_date 
+                OR delta.max_fdm_end_date > obs.observation_period_end_date
+            ) THEN UPDATE SET 
+                observation_period_start_date = LEAST(
+                    obs.observation_period_start_date, delta.min_fdm_start_date
+                ),
+                observation_period_end_date = GREATEST(
+                    obs.observation_period_end_date, delta.max_fdm_end_date
+                )
+            WHEN NOT MATCHED THEN INSERT (person_id, 
+                                          observation_period_start_date,
+                                          observation_period_end_date)
+            VALUES (delta.person_id, delta.min_fdm_start_date, 
+                    delta.max_fdm_end_date);
             
-        
\ No newline at end of file
+            COMMIT TRANSACTION;
+            
+            SELECT COUNTIF(fdm_problem != 0) AS n_problems,
+                COUNTIF(fdm_problem = 0) AS n_clean
+            FROM fdm_labelled;
+        """
+        counts_df = run_sql_query(merge_script).result().to_dataframe()
+        CLIENT.delete_table(delta_table.full_table_id)
+        table._invalidate_metadata()
+        print(f"    {table.table_id}:\n"
+              f"\t* {counts_df.n_clean[0]} new entries merged\n"
+              f"\t* {counts_df.n_problems[0]} new problem entries identified")
+        
+        
+    def _recombine_problem_entries(self, table):
+        """Recombines a source table with problem entries split by a previous 
+        build, before its problem entries are separated again
+        
+        Args:
+            table: FDMTable, the source table
+            
+        Returns:
+            None - all changes in GCP
+        """
+        if table._table_exists(f"{table.full_table_id}_fdm_problems"):
+            table.recombine(partition_by=self.partition_by, 
+                            cluster_by=self.cluster_by)
+            
+            
+    def _drop_problem_views(self, table):
+        """Drops the views created when problem entries are flagged
+        
+        Used before problem entries are split into their own table, in case 
+        the dataset was previously built with problem_storage="flag".
+        
+        Args:
+            table: FDMTable, the source table
+            
+        Returns:
+            None - all changes in GCP
+        """
+        for view_id in [f"{table.full_table_id}_fdm_problems", 
+                        f"{table.full_table_id}_fdm_clean"]:
+            if table._get_table_metadata(view_id).get("table_type") == "VIEW":
+                CLIENT.delete_table(view_id)
+        table._invalidate_metadata()
@@ -1,9 +1,12 @@
 # from google.cloud import bigquery
 import datetime
-from dateutil.parser import parse
+from FDMBuilder.FDM_date_parsing import *
 from FDMBuilder.FDM_helpers import *
 from google.cloud import bigquery
-from google.cloud.exceptions import NotFound
+from google.cloud.exceptions import BadRequest, Conflict, Forbidden, NotFound
+import copy
+import hashlib
+import json
 import numpy as np
 import pandas as pd
 import warnings
@@ -15,6 +18,9 @@ PROJECT = "yhcr-prd-phm-bia-core"
 CLIENT = bigquery.Client(project=PROJECT)
 DEMOGRAPHICS = f"{PROJECT}.CY_STAGING_DATABASE.src_DemoGraphics_MASTER"
 MASTER_PERSON = f"{PROJECT}.CY_FDM_MASTER.person"
+# Precision of HyperLogLog++ distinct counts in approximate data dicts - 
+# relative standard error of 1.04 / sqrt(2 ** 15) i.e. ~0.57%
+HLL_PRECISION = 15
 
     
 class FDMTable:
@@ -33,6 +39,15 @@ class FDMTable:
         source_table_id: string, id of source table in GCP. Can be in format
             project_id.dataset_id.table_id or dataset_id.table_id
         dataset_id: string, id of dataset in GCP where FDM is to be built
+        deferred: bool (default False), True records changes to the table as a
+            plan rather than rewriting the table for each change. The plan is 
+            compiled into a single query that rewrites the table when 
+            `.commit()`/`.build()`/`.quick_build()` runs (see `.explain()` to 
+            view the query). False rewrites the table as each change is made.
+        dataset_metadata: dict (default None), metadata of every table in 
+            dataset_id (see `get_dataset_metadata` in FDM_helpers) - if 
+            provided, it's used to check the tables exist and seeds the 
+            metadata cache, in place of calls to the BigQuery API
         
     Attributes:
         source_table_full_id: Full id of source table in GCP
@@ -40,17 +55,29 @@ class FDMTable:
         table_id = id of table alone i.e. without dataset/project id
         full_table_id = id of table with project and datatset ids i.e. in
             project_id.dataset_id.table_id format
+        deferred = if changes are recorded in a plan until committed
+        metadata_cache_hits = number of metadata lookups (existence/schema of 
+            the table and its problems table) answered from the cache
+        metadata_cache_misses = number of metadata lookups that required a 
+            call to the BigQuery API
     """
     
     
-    def __init__(self, source_table_id, dataset_id):
-            
-        if not check_table_exists(source_table_id):
+    def __init__(self, source_table_id, dataset_id, deferred=False, 
+                 dataset_metadata=None):
+        
+        if len(source_table_id.split(".")) == 2:
+            source_table_in_metadata = (dataset_metadata is not None and 
+                f"{PROJECT}.{source_table_id}" in dataset_metadata)
+        else:
+            source_table_in_metadata = (dataset_metadata is not None and
+                source_table_id in dataset_metadata)
+        if not source_table_in_metadata and not check_table_exists(source_table_id):
             raise ValueError(f"""
     {source_table_id} doesn't exist. Be sure to include the dataset id 
     (i.e. DATASET.TABLE) and double check spelling is correct.
             """)
-        if not check_dataset_exists(dataset_id):
+        if dataset_metadata is None and not check_dataset_exists(dataset_id):
             raise ValueError(f"""
     Dataset {dataset_id} doesn't exist. Double check spelling and GCP then 
     try again.
@@ -82,6 +109,52 @@ class FDMTable:
             f"\tFollow the guidance provided above and then re-run .build() when you've\n"
             f"\tresolved the issues preventing the build from completing."
         )
+        self.deferred = deferred
+        # the plan: table the changes are applied to, the changes (functions 
+        # that take a relation and return a SELECT statement) and the temp 
+        # tables they use
+        self._plan_base = self.full_table_id
+        self._plan = []
+        self._plan_temp_tables = []
+        self._plan_schema_dict = None
+        # metadata of the table and its problems table, by table id - cleared 
+        # at the start of each public call and whenever either table is 
+        # written to
+        self._metadata = {}
+        if dataset_metadata is not None:
+            for table_id in [self.full_table_id, 
+                             self.full_table_id + "_fdm_problems"]:
+                self._metadata[table_id] = dataset_metadata.get(
+                    table_id, {"exists": False}
+                )
+        self.metadata_cache_hits = 0
+        self.metadata_cache_misses = 0
+        # the metadata passed in is only trusted for the first public call - 
+        # later calls start with an empty cache (see `_scope_metadata_cache`)
+        self._metadata_seeded = dataset_metadata is not None
+        self._in_public_call = False
+        
+    def _scope_metadata_cache(func):
+        """Decorator Function - limits cached metadata to a single public call
+        
+        The table (or its problems table) can be changed between calls by other
+        FDMTable/FDMDataset objects, so cached metadata is cleared at the start
+        of each public call and only reused within it. Calls made from within 
+        another public call share its cache.
+        """
+        def return_fn(self, *args, **kwargs):
+            if self._in_public_call:
+                return func(self, *args, **kwargs)
+            if not self._metadata_seeded:
+                self._invalidate_metadata()
+            self._metadata_seeded = False
+            self._in_public_call = True
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                self._in_public_call = False
+                
+        return return_fn
         
     def _check_table_exists_in_dataset(func):
         """Decorator Function - ensures a copy of dataset exists
@@ -90,9 +163,10 @@ class FDMTable:
         dataset to work.
         """
         def return_fn(self, *args, **kwargs):
-            if not check_table_exists(self.full_table_id):
+            if (not self._has_pending_plan() 
+                    and not self._table_exists(self.full_table_id)):
                 raise ValueError(f"""
-    A copy of {self.full_table_id} doesn't yet exist in f"{self.dataset_id}.
+    A copy of {self.full_table_id} doesn't yet exist in {self.dataset_id}.
     Try running .copy_table_to_dataset() and then try again """)
             else:
                 return func(self, *args, **kwargs)
@@ -113,10 +187,12 @@ class FDMTable:
         
         This helper enforces the requirement that only a  complete table be 
         manipulated i.e. a table that has been "recombined" or  that doesn't 
-        have an associated  problems table.
+        have an associated  problems table. A problems view (problem entries
+        flagged in place) doesn't prevent changes.
         """
         def return_fn(self, *args, **kwargs):
-            if check_table_exists(self.full_table_id + "_fdm_problems"):
+            if (self._table_exists(self.full_table_id + "_fdm_problems")
+                    and not self._problems_table_is_view()):
                 raise ValueError(f"""
     A {self.table_id}_fdm_problems table exists in {self.dataset_id}. 
     {self.table_id} should be 'recombined' with problem entries 
@@ -127,6 +203,7 @@ class FDMTable:
                 
         return return_fn
         
+    @_scope_metadata_cache
     def check_build(self, verbose=True):
         """Checks all necessary parts of Table build have been completed
         
@@ -141,7 +218,7 @@ class FDMTable:
         Returns:
             A tuple of boolean values representing the 5 checks above
         """
-        table_exists = check_table_exists(self.full_table_id)
+        table_exists = self._table_exists(self.full_table_id)
         if table_exists:
             schema_dict = self._get_table_schema_dict()
             if "person_id" in schema_dict.keys():
@@ -152,7 +229,7 @@ class FDMTable:
                 person_id_is_int = False
             fdm_start_present = "fdm_start_date" in schema_dict.keys()
             fdm_end_present = "fdm_end_date" in schema_dict.keys()
-            problem_table_present = check_table_exists(self.full_table_id + "_fdm_problems")
+            problem_table_present = self._table_exists(self.full_table_id + "_fdm_problems")
         else:
             person_id_present = False
             fdm_start_present = False
@@ -162,6 +239,7 @@ class FDMTable:
                 fdm_start_present,  fdm_end_present, problem_table_present)
         
     
+    @_scope_metadata_cache
     def build(self):
         """Prepares table for FDM build with prompts and user input
         
@@ -197,14 +275,16 @@ class FDMTable:
             print(self._build_not_completed_message)
             return None
 
+        self.commit()
         print("_" * 80 + "\n")
         print(f"\t ##### BUILD PROCESS FOR {self.table_id} COMPLETE! #####\n")
     
     
+    @_scope_metadata_cache
     @_check_problems_table_doesnt_exist
     def quick_build(self, fdm_start_date_cols, fdm_start_date_format,
                     fdm_end_date_cols=None, fdm_end_date_format=None,
-                    verbose=True):
+                    verbose=True, n_workers=1, parse_cache=False):
         """Performs the table build process without verbose user input
 
         Adds the 3 basic FDM table features:  1. A person_id column  2. An Event 
@@ -230,18 +310,33 @@ class FDMTable:
                 None/left blank if fdm_end_date_cols is blank
             verbose: bool (default True), controls console output showing progress 
                 of build
+            n_workers: int (default 1), number of processes used to parse dates
+                that can't be parsed in BigQuery. None uses all available CPUs.
+            parse_cache: bool/DateParseCache (default False), True checks the 
+                dataset's on-disk cache of previously parsed dates before 
+                parsing (see `get_default_parse_cache` in FDM_date_parsing), 
+                False parses every date. A DateParseCache can also be provided.
+                Note a cache writes the raw date values of the source table to
+                disk (in DEFAULT_PARSE_CACHE_DIR for the dataset's cache).
                 
         Returns:
             None - all changes occurr in GCP
         """
         if verbose:
             print(f"Building {self.table_id}:")
+        if parse_cache is True:
+            parse_cache = get_default_parse_cache(self.dataset_id)
+        if parse_cache:
+            # the cache may be shared, so counts are reported for this build only
+            hits_before, misses_before = parse_cache.hits, parse_cache.misses
         self.copy_table_to_dataset(verbose=verbose)
         self._add_person_id_to_table(verbose=verbose)
         fdm_start_date_added = self._add_parsed_date_to_table(
             date_cols=fdm_start_date_cols,  
             date_format=fdm_start_date_format,  
-            date_column_name="fdm_start_date"
+            date_column_name="fdm_start_date",
+            n_workers=n_workers,
+            parse_cache=parse_cache
         )
         if fdm_start_date_added:
             print("    fdm_start_date column added")
@@ -251,7 +346,9 @@ class FDMTable:
             fdm_end_date_added = self._add_parsed_date_to_table(
                 date_cols=fdm_end_date_cols,  
                 date_format=fdm_end_date_format,  
-                date_column_name="fdm_end_date"
+                date_column_name="fdm_end_date",
+                n_workers=n_workers,
+                parse_cache=parse_cache
             )
             if fdm_end_date_added:
                 print("    fdm_end_date column added")
@@ -259,9 +356,164 @@ class FDMTable:
                 print("    fdm_end_date could not be parsed with inputs provided")
         else:
             print("    no fdm_end_date info provided")
+        if verbose and parse_cache:
+            print(f"    date parse cache: {parse_cache.hits - hits_before} hits, "
+                  f"{parse_cache.misses - misses_before} misses")
+        self.commit()
         print("Done.")
+        
+        
+    @_scope_metadata_cache
+    def quick_build_delta(self, fdm_start_date_cols, fdm_start_date_format,
+                          fdm_end_date_cols=None, fdm_end_date_format=None,
+                          watermark_column=None, verbose=True, n_workers=1, 
+                          parse_cache=False):
+        """Builds only the rows appended to the source table since the last build
+        
+        For append-only source tables that are refreshed with new rows. The 
+        rows of the source table that haven't been built yet are copied to a 
+        [table_name]_fdm_delta table in the dataset, which is given a person_id
+        and fdm_start_date/fdm_end_date as in `quick_build` - the table itself 
+        isn't changed. `FDMDataset.build_delta` then separates problem entries
+        from the delta and merges it into the dataset, so the cost of a refresh
+        depends on the number of new rows, not the size of the table.
+        
+        New rows are identified either:
+        
+        * by row fingerprint (default) - a FARM_FINGERPRINT of each source 
+          row's JSON is stored in [table_name]_fdm_ingested once the row is
+          merged, and rows with a stored fingerprint are skipped
+        * by watermark column - rows with a watermark_column value greater than
+          the greatest value in the table (and its problems table) are new
+          
+        If the table hasn't been built yet, it's built in full with 
+        `quick_build` (recording every row's fingerprint) - run 
+        `FDMDataset.build` after this first build.
+        
+        Limitations: changes to and deletions of rows already built aren't 
+        picked up; with fingerprints, a new row identical to a row already 
+        built is skipped; and changes made to the table after `quick_build` 
+        (e.g. renamed/added columns) aren't applied to the delta. Rebuild the 
+        table in full if any of these apply.
+
+        Args:
+            fdm_start_date_cols: string/list, see `quick_build`
+            fdm_start_date_format: string, see `quick_build`
+            fdm_end_date_cols: string/list (default None), see `quick_build`
+            fdm_end_date_format: string (default None), see `quick_build`
+            watermark_column: string (default None), name of a column that 
+                increases as rows are appended e.g. a load timestamp - None 
+                identifies new rows by fingerprint
+            verbose: bool (default True), controls console output showing 
+                progress of build
+            n_workers: int (default 1), see `quick_build`
+            parse_cache: bool/DateParseCache (default False), see `quick_build`
+                
+        Returns:
+            bool, True if new rows were staged in [table_name]_fdm_delta, 
+                otherwise False
+        """
+        build_args = dict(fdm_start_date_cols=fdm_start_date_cols, 
+                          fdm_start_date_format=fdm_start_date_format,
+                          fdm_end_date_cols=fdm_end_date_cols, 
+                          fdm_end_date_format=fdm_end_date_format,
+                          verbose=verbose, n_workers=n_workers, 
+                          parse_cache=parse_cache)
+        ingested_table_id = f"{self.full_table_id}_fdm_ingested"
+        if not self._table_exists(self.full_table_id):
+            if verbose:
+                print(f"{self.table_id} not yet built - building in full")
+            # fingerprints are taken from the copy, so rows appended to the 
+            # source during the build aren't recorded
+            self.copy_table_to_dataset()
+            self.commit()
+            if watermark_column is None:
+                run_sql_query(f"""
+                    SELECT FARM_FINGERPRINT(TO_JSON_STRING(src)) 
+                        AS fdm_row_fingerprint
+                    FROM `{self.full_table_id}` AS src
+                """, destination=ingested_table_id)
+            self.quick_build(**build_args)
+            return False
+        
+        if verbose:
+            print(f"Building new rows of {self.table_id}:")
+        delta_sql = self._get_delta_rows_sql(watermark_column)
+        delta_table = self._get_delta_table()
+        delta_bq_table = run_sql_query(delta_sql, 
+                                       destination=delta_table.full_table_id)
+        if delta_bq_table.num_rows == 0:
+            CLIENT.delete_table(delta_table.full_table_id)
+            if verbose:
+                print("    no new rows")
+            return False
+        if verbose:
+            print(f"    {delta_bq_table.num_rows} new rows staged in "
+                  f"{delta_table.table_id}")
+        delta_table._add_person_id_to_table(verbose=verbose)
+        for date_cols, date_format, date_column_name in [
+            (fdm_start_date_cols, fdm_start_date_format, "fdm_start_date"),
+            (fdm_end_date_cols, fdm_end_date_format, "fdm_end_date")
+        ]:
+            if date_cols is None:
+                continue
+            date_added = delta_table._add_parsed_date_to_table(
+                date_cols=date_cols,  
+                date_format=date_format,  
+                date_column_name=date_column_name,
+                n_workers=n_workers,
+                parse_cache=parse_cache
+            )
+            if verbose and date_added:
+                print(f"    {date_column_name} column added")
+            elif verbose:
+                print(f"    {date_column_name} could not be parsed with inputs "
+                      "provided")
+        delta_table.commit()
+        if verbose:
+            print("Done.")
+        return True
     
     
+    def commit(self):
+        """Applies any planned changes to the table
+        
+        Compiles all changes recorded since the last commit (including a copy 
+        from the source table) into a single query that rewrites the table, 
+        then deletes any temp tables the changes used. Does nothing if there 
+        are no planned changes i.e. if the FDMTable isn't deferred.
+        
+        Returns:
+            None - changes occurr in GCP
+        """
+        if self._has_pending_plan():
+            run_sql_query(self._get_plan_sql(), destination=self.full_table_id)
+            self._invalidate_metadata()
+        self._plan_base = self.full_table_id
+        self._plan = []
+        self._plan_schema_dict = None
+        for temp_table_id in self._plan_temp_tables:
+            CLIENT.delete_table(temp_table_id, not_found_ok=True)
+        self._plan_temp_tables = []
+        
+        
+    def explain(self):
+        """Shows the query that will apply any planned changes to the table
+        
+        Returns:
+            string, the SQL query run by `.commit()` - None if there are no
+                planned changes
+        """
+        if not self._has_pending_plan():
+            print(f"No planned changes to {self.table_id}")
+            return None
+        plan_sql = self._get_plan_sql()
+        print(f"{len(self._plan)} planned change(s) to {self.table_id} "
+              f"from {self._plan_base}:\n{plan_sql}")
+        return plan_sql
+    
+    
+    @_scope_metadata_cache
     @_check_table_exists_in_dataset
     def get_column_names(self):
         """Lists the table's column names
@@ -270,8 +522,7 @@ class FDMTable:
             list, strings detailing each column name
         """
         
-        table = CLIENT.get_table(self.full_table_id)
-        return [field.name for field in table.schema]
+        return list(self._get_table_schema_dict().keys())
             
             
     @_check_table_exists_in_dataset
@@ -292,16 +543,27 @@ class FDMTable:
              ...
         }
         
+        If the table has uncommitted changes, the schema is that of the 
+        planned table, taken from a dry run of the plan's query.
+        
         Requres no arguments.
 
         Returns:
             dict, column name: colum data type pairs 
         """
-        table = CLIENT.get_table(self.full_table_id)
-        return {field.name: field.field_type  
-                for field in table.schema}
+        if self._has_pending_plan():
+            if self._plan_schema_dict is None:
+                job_config = bigquery.QueryJobConfig(dry_run=True, 
+                                                     use_query_cache=False)
+                query_job = CLIENT.query(self._get_plan_sql(), 
+                                         job_config=job_config)
+                self._plan_schema_dict = {field.name: field.field_type 
+                                          for field in query_job.schema}
+            return self._plan_schema_dict
+        return self._get_table_metadata(self.full_table_id)["schema"]
                                                                                                           
     
+    @_scope_metadata_cache
     @_check_table_exists_in_dataset
     @_check_problems_table_doesnt_exist
     def add_column(self, column_sql):
@@ -329,13 +591,13 @@ class FDMTable:
         )
         ```
         """
-        add_column_sql = f"""
+        self._rewrite_table(lambda relation: f"""
             SELECT *, {column_sql}
-            FROM `{self.full_table_id}`
-        """
-        run_sql_query(add_column_sql, destination=self.full_table_id)
+            FROM {relation}
+        """)
     
     
+    @_scope_metadata_cache
     @_check_table_exists_in_dataset
     @_check_problems_table_doesnt_exist
     def drop_column(self, column):
@@ -347,13 +609,17 @@ class FDMTable:
         Returns:
             None - changes occurr in GCP
         """
-        drop_column_sql = f"""
-            ALTER TABLE `{self.full_table_id}`
-            DROP COLUMN {column}
-        """
-        run_sql_query(drop_column_sql)
+        if self.deferred:
+            self._rewrite_table(lambda relation: f"""
+                SELECT * EXCEPT({column})
+                FROM {relation}
+            """)
+            return None
+        drop_columns_in_bigquery(self.full_table_id, [column])
+        self._invalidate_metadata()
     
     
+    @_scope_metadata_cache
     @_check_table_exists_in_dataset
     @_check_problems_table_doesnt_exist
     def rename_columns(self, names_map, verbose=True):
@@ -375,11 +641,28 @@ class FDMTable:
         )
         ```
         """
-        rename_columns_in_bigquery(table_id=self.full_table_id,
-                                   names_map=names_map,
-                                   verbose=verbose)
+        if not self.deferred:
+            rename_columns_in_bigquery(table_id=self.full_table_id,
+                                       names_map=names_map,
+                                       verbose=verbose)
+            self._invalidate_metadata()
+            return None
+        alias_string = ", ".join(f"{old_name} AS {new_name}" 
+                                 for old_name, new_name in names_map.items())
+        if len(names_map) == len(self.get_column_names()):
+            self._rewrite_table(lambda relation: f"""
+                SELECT {alias_string}
+                FROM {relation}
+            """)
+        else:
+            old_names_string = ", ".join(names_map.keys())
+            self._rewrite_table(lambda relation: f"""
+                SELECT {alias_string}, * EXCEPT({old_names_string})
+                FROM {relation}
+            """)
         
         
+    @_scope_metadata_cache
     @_check_table_exists_in_dataset
     @_check_problems_table_doesnt_exist
     def head(self, n=10):
@@ -394,14 +677,15 @@ class FDMTable:
         """
         head_sql = f"""
             SELECT *
-            FROM `{self.full_table_id}`
+            FROM {self._get_relation_sql()}
             LIMIT {n}
         """
-        return pd.read_gbq(head_sql)
+        return read_sql_query(head_sql)
     
     
+    @_scope_metadata_cache
     @_check_table_exists_in_dataset
-    def build_data_dict(self):
+    def build_data_dict(self, approximate=False, force=False):
         """Creates table with basic data dictionary in table dataset
 
         Generates a "data dictionary" as a separate table in BigQuery named 
@@ -410,78 +694,298 @@ class FDMTable:
         information on the actual data: if the column is numeric/DateTime a 
         min/max is detailed (plus a mean for non DateTime columns), or some 
         examples of unique values for non-numeric columns.
+        
+        All columns are summarised by a single query, scanning the table once
+        (see `_get_data_dict_sql`).
+        
+        Setting approximate to True uses BigQuery's approximate aggregate 
+        functions, which are much cheaper on large tables and give richer 
+        descriptions:
+        
+        * Unique values are counted with HyperLogLog++ at precision 
+          HLL_PRECISION, with a relative standard error of ~0.57% (so ~95% 
+          of counts are within 1.1% of the exact count). Counts are prefixed 
+          with "~".
+        * INTEGER/FLOAT/DATETIME columns include the 25th percentile, median 
+          and 75th percentile from APPROX_QUANTILES. The quantiles are 
+          approximate (BigQuery doesn't publish a bound, but the rank error is 
+          small for large tables), while min, max and mean remain exact.
+        * Other columns list the 5 most common values with their counts from 
+          APPROX_TOP_COUNT. Counts are exact when a column has few distinct 
+          values, but values (and their counts) may be missed or overstated 
+          when the column has very many distinct values.
+          
+        A fingerprint of the table (see `_get_table_fingerprint`) is stored as 
+        the description of the data dict table. If the table hasn't changed 
+        since the data dict was last built, it isn't rebuilt. If the table has
+        the same number of rows and its schema has changed (e.g. columns have 
+        been added by the FDM build), only the new/changed columns are 
+        summarised, along with a checksum of every column. The rest of the 
+        data dict is kept, apart from columns whose checksum shows their 
+        values have changed, which are summarised again. Set force to True to 
+        rebuild the whole data dict.
 
-        Requires no arguments.
+        Args:
+            approximate: bool (default False), True uses approximate 
+                aggregates, False exact aggregates
+            force: bool (default False), True rebuilds the whole data dict even
+                if the table hasn't changed
                 
         Returns:
-            None - changes occurr in GCP
+            bool, True if the data dict was (re)built, False if the table was 
+                unchanged and the existing data dict kept
         """
+        self.commit()
+        data_dict_id = self.full_table_id + "_data_dict"
+        fingerprint = self._get_table_fingerprint(approximate=approximate)
+        previous_fingerprint = None
+        if not force and check_table_exists(data_dict_id):
+            try:
+                previous_fingerprint = json.loads(
+                    CLIENT.get_table(data_dict_id).description
+                )
+            except (TypeError, ValueError):
+                previous_fingerprint = None
+        # the stored fingerprint also has the column checksums (see below)
+        if (previous_fingerprint is not None 
+                and {key: value for key, value in previous_fingerprint.items()
+                     if key != "column_checksums"} == fingerprint):
+            return False
+        
+        keep_previous_descriptions = (
+            previous_fingerprint is not None
+            and previous_fingerprint.get("num_rows") == fingerprint["num_rows"]
+            and previous_fingerprint.get("approximate") == approximate
+            and previous_fingerprint.get("schema_hash") != fingerprint["schema_hash"]
+            and "column_checksums" in previous_fingerprint
+        )
         schema_dict = self._get_table_schema_dict()
-        data_dict = {
-            "variable_name": [],
-            "data_type": [],
-            "description": [],
+        if keep_previous_descriptions:
+            previous_data_dict_df = read_sql_query(f"""
+                SELECT variable_name, data_type, description
+                FROM `{data_dict_id}`
+            """)
+            descriptions = {
+                (row.variable_name, row.data_type): row.description
+                for row in previous_data_dict_df.itertuples()
+                if schema_dict.get(row.variable_name) == row.data_type
+            }
+        else:
+            descriptions = {}
+        
+        # every column is checksummed in the same scan as the summaries, so 
+        # kept descriptions of columns whose values have changed (e.g. a 
+        # re-parsed fdm_start_date) can be found and rebuilt
+        columns_to_summarise = {
+            col_name: col_dtype for col_name, col_dtype in schema_dict.items()
+            if (col_name, col_dtype) not in descriptions
         }
-        for col_name, col_dtype in schema_dict.items():
-            data_dict["variable_name"].append(col_name)
-            data_dict["data_type"].append(col_dtype)
-            n_unique_values_sql = f"""
-                SELECT COUNT(DISTINCT {col_name}) AS n, 
-                FROM `{self.full_table_id}`
-                WHERE {col_name} IS NOT NULL
-            """
-            n_unique_values_df = pd.read_gbq(n_unique_values_sql)
-            n_unique_values = n_unique_values_df.n[0]
+        summary = read_sql_query(
+            self._get_data_dict_sql(columns_to_summarise, approximate=approximate,
+                                    checksum_columns=list(schema_dict.keys()))
+        ).iloc[0]
+        # checksums are shortened to fit the data dict table's description
+        column_checksums = {
+            col_name: hashlib.sha256(
+                str(summary[f"k{j}_checksum"]).encode()
+            ).hexdigest()[:16]
+            for j, col_name in enumerate(schema_dict.keys())
+        }
+        descriptions.update(self._get_column_descriptions(
+            summary, columns_to_summarise, approximate
+        ))
+        previous_checksums = (previous_fingerprint or {}).get("column_checksums", {})
+        changed_columns = {
+            col_name: col_dtype for col_name, col_dtype in schema_dict.items()
+            if col_name not in columns_to_summarise 
+            and column_checksums[col_name] != previous_checksums.get(col_name)
+        }
+        if changed_columns:
+            changed_summary = read_sql_query(
+                self._get_data_dict_sql(changed_columns, approximate=approximate)
+            ).iloc[0]
+            descriptions.update(self._get_column_descriptions(
+                changed_summary, changed_columns, approximate
+            ))
+        fingerprint["column_checksums"] = column_checksums
             
-            if col_dtype in ["INTEGER", "DATETIME", "FLOAT"]:
-                data_sql = f"SELECT MIN({col_name}) AS min_val, "
-                data_sql += f"MAX({col_name}) AS max_val"
-                if col_dtype != "DATETIME":
-                    data_sql += f", AVG({col_name}) AS mean_val"
-                data_sql += f" FROM `{self.full_table_id}`"
-                data_sql += f" WHERE {col_name} IS NOT NULL"
-                data_df = pd.read_gbq(data_sql)
+        data_dict_df = pd.DataFrame({
+            "variable_name": list(schema_dict.keys()),
+            "data_type": list(schema_dict.values()),
+            "description": [descriptions[col] for col in schema_dict.items()]
+        })
+        data_dict_table = upload_to_bigquery(
+            data_dict_df, 
+            destination=data_dict_id,
+            schema=[{"name":"variable_name", "type":"STRING"},
+                    {"name":"data_type", "type":"STRING"},
+                    {"name":"description", "type":"STRING"}]
+        )
+        data_dict_table.description = json.dumps(fingerprint)
+        CLIENT.update_table(data_dict_table, ["description"])
+        return True
+    
+    
+    def _get_column_descriptions(self, summary, schema_dict, approximate=False):
+        """Describes columns from their aggregates for the data dict
+        
+        Args:
+            summary: pandas.Series, the row of column aggregates returned by
+                `_get_data_dict_sql`
+            schema_dict: dict, column name: column data type pairs of the 
+                summarised columns, in the order passed to `_get_data_dict_sql`
+            approximate: bool (default False), if approximate aggregates were 
+                used
                 
+        Returns:
+            dict, (column name, column data type): description pairs
+        """
+        descriptions = {}
+        for i, (col_name, col_dtype) in enumerate(schema_dict.items()):
+            n_unique_values = summary[f"c{i}_n"]
+            
+            if approximate and col_dtype in ["INTEGER", "DATETIME", "FLOAT"]:
+                quantiles = summary[f"c{i}_quantiles"]
+                quantiles = [None] * 5 if quantiles is None else list(quantiles)
+                description = f"~{n_unique_values} Unique Values - "
+                description += f"Min: {summary[f'c{i}_min']}, "
+                description += f"P25: {quantiles[1]}, "
+                description += f"Median: {quantiles[2]}, "
+                description += f"P75: {quantiles[3]}, "
+                description += f"Max: {summary[f'c{i}_max']}"
+                if col_dtype != "DATETIME":
+                    description += f", Mean: {summary[f'c{i}_mean']}"
+            elif approximate:
+                top_values = summary[f"c{i}_top_values"]
+                top_values = [] if top_values is None else [
+                    f"{top_value['value']} ({top_value['count']})" 
+                    for top_value in top_values
+                    if top_value["value"] is not None
+                ]
+                description = f"~{n_unique_values} unique Values - Most common: " 
+                description += ", ".join(top_values[:5])
+            elif col_dtype in ["INTEGER", "DATETIME", "FLOAT"]:
                 description = f"{n_unique_values} Unique Values - "
-                description = f"Min: {data_df.min_val[0]}, "
-                description += f"Max: {data_df.max_val[0]}"
+                description += f"Min: {summary[f'c{i}_min']}, "
+                description += f"Max: {summary[f'c{i}_max']}"
                 if col_dtype != "DATETIME":
-                    description += f", Mean: {data_df.mean_val[0]}, "
-            elif n_unique_values > 20:
-                unique_values_sql = f"""WITH src AS (
-                    SELECT * FROM `{self.full_table_id}`
-                    WHERE {col_name} IS NOT NULL
-                    LIMIT 1000
+                    description += f", Mean: {summary[f'c{i}_mean']}"
+            else:
+                values = summary[f"c{i}_values"]
+                values = [] if values is None else list(values)
+                if n_unique_values > 20:
+                    description = f"{n_unique_values} unique Values - Examples: " 
+                    description += ", ".join(values[:5])
+                else:
+                    description = f"{n_unique_values} unique Values: " 
+                    description += ", ".join(values)
+            descriptions[(col_name, col_dtype)] = description
+        return descriptions
+    
+    
+    @_check_table_exists_in_dataset
+    def _get_table_fingerprint(self, approximate=False):
+        """Summarises the current state of the table to detect changes
+        
+        Args:
+            approximate: bool (default False), if the data dict for the table
+                uses approximate statistics - recorded so that switching 
+                between exact/approximate triggers a rebuild
+                
+        Returns:
+            dict, containing the table's last modified time, number of rows, 
+                a hash of the schema (column names and data types) and 
+                approximate
+        """
+        metadata = self._get_table_metadata(self.full_table_id)
+        schema_hash = hashlib.sha256(
+            json.dumps(list(metadata["schema"].items())).encode()
+        ).hexdigest()
+        return {
+            "modified": (metadata["modified"].isoformat() 
+                         if metadata["modified"] else None),
+            "num_rows": metadata["num_rows"],
+            "schema_hash": schema_hash,
+            "approximate": approximate
+        }
+    
+    
+    def _get_data_dict_sql(self, schema_dict, approximate=False, 
+                           checksum_columns=()):
+        """Generates a query summarising every column of the table in one scan
+        
+        For each column the query counts the distinct values, then either 
+        takes the min/max (plus mean for non DATETIME columns) of INTEGER/
+        FLOAT/DATETIME columns, or up to 21 distinct example values (as 
+        STRINGs) of any other column. Aggregates for the column at position i 
+        in the schema are aliased c{i}_n, c{i}_min, c{i}_max, c{i}_mean and 
+        c{i}_values.
+        
+        If approximate, distinct values are counted with HyperLogLog++, 
+        INTEGER/FLOAT/DATETIME columns also get approximate quartiles 
+        (c{i}_quantiles) and other columns get their 6 most common values with
+        counts (c{i}_top_values) in place of example values - see 
+        `build_data_dict`.
+        
+        A checksum of the values of each of checksum_columns (order 
+        independent) is also taken, aliased k{j}_checksum for the column at 
+        position j.
+        
+        Args:
+            schema_dict: dict, column name: column data type pairs (see 
+                `_get_table_schema_dict`)
+            approximate: bool (default False), True uses approximate aggregates
+            checksum_columns: list (default ()), names of columns to checksum
+                
+        Returns:
+            string, SQL query returning a single row of column aggregates
+        """
+        aggregates = []
+        for i, (col_name, col_dtype) in enumerate(schema_dict.items()):
+            col = f"`{col_name}`"
+            if col_dtype in ["RECORD", "STRUCT", "JSON"]:
+                col = f"TO_JSON_STRING({col})"
+            if approximate:
+                # HLL_COUNT only accepts INTEGER/NUMERIC/STRING/BYTES values
+                hll_col = col if col_dtype == "INTEGER" else f"CAST({col} AS STRING)"
+                aggregates.append(
+                    f"HLL_COUNT.EXTRACT(HLL_COUNT.INIT({hll_col}, {HLL_PRECISION})) "
+                    f"AS c{i}_n"
                 )
-                SELECT ARRAY_AGG(DISTINCT {col_name}) AS unique_values 
-                FROM src
-                """
-                unique_values_df = pd.read_gbq(unique_values_sql)
-                values = unique_values_df.unique_values[0]
-                description = f"{n_unique_values} unique Values - Examples: " 
-                description += ", ".join(
-                    [str(val) for val in values[:5]]
+            else:
+                aggregates.append(f"COUNT(DISTINCT {col}) AS c{i}_n")
+            if col_dtype in ["INTEGER", "DATETIME", "FLOAT"]:
+                aggregates.append(f"MIN({col}) AS c{i}_min")
+                aggregates.append(f"MAX({col}) AS c{i}_max")
+                if col_dtype != "DATETIME":
+                    aggregates.append(f"AVG({col}) AS c{i}_mean")
+                if approximate:
+                    aggregates.append(
+                        f"APPROX_QUANTILES({col}, 4) AS c{i}_quantiles"
+                    )
+            elif approximate:
+                # 6 values, as NULL may be one of the most common
+                aggregates.append(
+                    f"APPROX_TOP_COUNT(CAST({col} AS STRING), 6) AS c{i}_top_values"
                 )
             else:
-                unique_values_sql = f"""
-                    SELECT ARRAY_AGG(DISTINCT {col_name}) AS unique_values 
-                    FROM `{self.full_table_id}`
-                    WHERE {col_name} IS NOT NULL
-                """
-                unique_values_df = pd.read_gbq(unique_values_sql)
-                values = unique_values_df.unique_values[0]
-                description = f"{n_unique_values} unique Values: " 
-                description += ", ".join(
-                    [str(val) for val in values]
+                aggregates.append(
+                    f"ARRAY_AGG(DISTINCT CAST({col} AS STRING) IGNORE NULLS "
+                    f"LIMIT 21) AS c{i}_values"
                 )
-            data_dict["description"].append(description)
-        data_dict_df = pd.DataFrame(data_dict)
-        data_dict_df.to_gbq(destination_table=self.full_table_id + "_data_dict", 
-                            project_id=PROJECT, 
-                            if_exists="replace", 
-                            progress_bar=False)
+        for j, col_name in enumerate(checksum_columns):
+            aggregates.append(
+                f"SUM(CAST(FARM_FINGERPRINT(TO_JSON_STRING(`{col_name}`)) "
+                f"AS BIGNUMERIC)) AS k{j}_checksum"
+            )
+        aggregates_sql = ",\n                ".join(aggregates)
+        return f"""
+            SELECT {aggregates_sql}
+            FROM `{self.full_table_id}`
+        """
     
     
+    @_scope_metadata_cache
     def copy_table_to_dataset(self, overwrite_existing=False, verbose=False):
         """Creates a copy of the source table in the FDMTable dataset
         
@@ -489,7 +993,8 @@ class FDMTable:
         dataset specified when initialising the FDMTable object. Includes options
         to overwrite an existing table with the same name in the specified dataset.
         If a copy of the table already exists in the dataset and `overwrite_existing` 
-        is False, nothing happens.
+        is False, nothing happens. The copy is a table clone where possible, so
+        no data is scanned (see `clone_table` in FDM_helpers).
         
         Args:
             overwrite_existing: bool, True/False overwrites/leaves an existing 
@@ -502,23 +1007,102 @@ class FDMTable:
             None - changes occurr in GCP
         """
         
-        src_copy_exists = check_table_exists(self.full_table_id)
+        src_copy_exists = self._table_exists(self.full_table_id)
         
         if src_copy_exists and not overwrite_existing:
             if verbose:
                 print(f"    using existing copy of {self.table_id} in " 
                       f"{self.dataset_id}")
+        elif self.deferred:
+            # the copy is fused into the plan's query
+            self._plan_base = self.source_table_full_id
+            self._plan = []
+            self._plan_schema_dict = None
+            if verbose:
+                print(f"    {self.table_id} copy to {self.dataset_id} planned")
         else:
-            copy_table_sql = f"""
-                SELECT * 
-                FROM `{self.source_table_full_id}`
-            """
-            run_sql_query(copy_table_sql, destination=self.full_table_id)
+            copy_method = clone_table(self.source_table_full_id, 
+                                      self.full_table_id)
+            self._invalidate_metadata()
             if verbose:
-                print(f"    {self.table_id} copied to {self.dataset_id}")
+                print(f"    {self.table_id} copied to {self.dataset_id} "
+                      f"(via {copy_method})")
             
     
-    def recombine(self):
+    @_scope_metadata_cache
+    @_check_table_exists_in_dataset
+    def snapshot(self):
+        """Saves a checkpoint of the table that can be restored later
+        
+        Creates a table snapshot named [table_name]_fdm_snapshot in the 
+        dataset, replacing any existing snapshot. Snapshots are metadata only 
+        - nothing is scanned and storage is only billed for data that later
+        changes in the table - so are a cheap way to checkpoint before risky 
+        edits. Any planned changes are committed first.
+        
+        Returns:
+            None - changes occurr in GCP
+            
+        Example:
+        ```python
+        my_table.snapshot()
+        my_table.add_column("SPLIT(string_col, "/")[OFFSET(0)] AS first_item")
+        # something went wrong - go back to the table before the new column
+        my_table.restore()
+        ```
+        """
+        self.commit()
+        snapshot_id = self.full_table_id + "_fdm_snapshot"
+        snapshot_sql = f"""
+            CREATE SNAPSHOT TABLE `{snapshot_id}`
+            CLONE `{self.full_table_id}`
+        """
+        try:
+            try:
+                run_sql_query(snapshot_sql)
+            except Conflict:
+                # snapshots can't be replaced in place, so the existing 
+                # snapshot is dropped and the new one created in its place
+                CLIENT.delete_table(snapshot_id)
+                run_sql_query(snapshot_sql)
+        except (BadRequest, Forbidden) as error:
+            if not is_unsupported_copy_error(error):
+                raise
+            clone_table(self.full_table_id, snapshot_id)
+        
+        
+    @_scope_metadata_cache
+    def restore(self, delete_snapshot=False):
+        """Restores the table to the checkpoint saved with `snapshot`
+        
+        Discards any planned changes. Restoring from a snapshot is also a clone
+        where possible, so no data is scanned.
+        
+        Args:
+            delete_snapshot: bool (default False), True deletes the snapshot 
+                once restored, False keeps it so it can be restored again
+                
+        Returns:
+            None - changes occurr in GCP
+        """
+        snapshot_id = self.full_table_id + "_fdm_snapshot"
+        if not check_table_exists(snapshot_id):
+            raise ValueError(f"{self.table_id} has no snapshot in "
+                             f"{self.dataset_id} - run .snapshot() first")
+        self._plan_base = self.full_table_id
+        self._plan = []
+        self._plan_schema_dict = None
+        for temp_table_id in self._plan_temp_tables:
+            CLIENT.delete_table(temp_table_id, not_found_ok=True)
+        self._plan_temp_tables = []
+        clone_table(snapshot_id, self.full_table_id)
+        self._invalidate_metadata()
+        if delete_snapshot:
+            CLIENT.delete_table(snapshot_id)
+            
+            
+    @_scope_metadata_cache
+    def recombine(self, partition_by=None, cluster_by=None):
         """Re-combines source data and problems tables
 
         After running an FDMDataset build, entries that have "problems" (e.g. 
@@ -529,28 +1113,315 @@ class FDMTable:
         problem entries, to ensure the data remains in the correct format, and 
         subsequent changes that might correct certain "problems" are not missed. 
         `recombine` stiches the source and problems tables back together, retaining 
-        a `problems` column that details which of the entries have an associated 
-        "problem".
+        the `fdm_problem` code and `fdm_problem_flags` columns that detail which of
+        the entries have an associated "problem" (see the fdm_problem_codes table).
+        
+        If problem entries were flagged in place rather than removed (see 
+        `problem_storage` in `FDMDataset.build`) the problems table is a view 
+        and there's nothing to recombine.
+        
+        The recombined table keeps the source table's partitioning and 
+        clustering, unless others are given. Problem entries with a NULL date
+        or a date outside BigQuery's partition range are stored in the 
+        __NULL__/__UNPARTITIONED__ partitions.
 
-        Requires no arguments.
+        Args:
+            partition_by: string (default None), date column the recombined 
+                table is partitioned by, per month - None keeps the table's 
+                existing partitioning
+            cluster_by: list (default None), columns the recombined table is 
+                clustered by - None keeps the table's existing clustering, [] 
+                doesn't cluster it
                 
         Returns:
             None - changes occurr in GCP
         """
-        if not check_table_exists(self.full_table_id + "_fdm_problems"):
+        if not self._table_exists(self.full_table_id + "_fdm_problems"):
             raise ValueError(f"{self.table_id} has no corresponding fdm "
-                             "problems table in {self.dataset_id}")
+                             f"problems table in {self.dataset_id}")
+        if self._problems_table_is_view():
+            return None
+        self.commit()
+        # problem columns (fdm_problem and fdm_problem_flags) are set to 0 -
+        # "No problem" - for the source entries. Older problems tables have a
+        # STRING fdm_problem column, which is left NULL
+        problems_schema = self._get_table_metadata(
+            self.full_table_id + "_fdm_problems"
+        )["schema"]
+        column_names = self.get_column_names()
+        problem_columns = ", ".join(
+            f"{0 if data_type in ['INTEGER', 'INT64'] else 'NULL'} AS {column}"
+            for column, data_type in problems_schema.items()
+            if column not in column_names
+        )
         recombine_sql = f"""
             SELECT * 
             FROM {self.full_table_id + "_fdm_problems"}
             UNION ALL
-            SELECT NULL AS fdm_problem, *
+            SELECT {problem_columns}, *
             FROM {self.full_table_id}
         """
-        run_sql_query(recombine_sql, destination=self.full_table_id)
+        metadata = self._get_table_metadata(self.full_table_id)
+        if partition_by is None and metadata["partition_by"] in column_names:
+            partition_by = metadata["partition_by"]
+        if cluster_by is None:
+            cluster_by = metadata["cluster_by"]
+        run_sql_query(recombine_sql, destination=self.full_table_id, 
+                      partition_by=partition_by, cluster_by=cluster_by or [])
         CLIENT.delete_table(self.full_table_id + "_fdm_problems")
+        self._invalidate_metadata()
+        
         
+    def _get_table_metadata(self, table_id):
+        """Gets metadata for the table or its problems table, using the cache
         
+        Args:
+            table_id: string, full id of the table or its problems table
+            
+        Returns:
+            dict, containing "exists" (bool) and, if the table exists, its 
+                "schema" (column name: column data type pairs), "modified" 
+                time, "num_rows", "table_type", "partition_by" (the column it's
+                partitioned by, or None) and "cluster_by" (list of the columns
+                it's clustered by)
+        """
+        if table_id in self._metadata:
+            self.metadata_cache_hits += 1
+            return self._metadata[table_id]
+        self.metadata_cache_misses += 1
+        try:
+            table = CLIENT.get_table(table_id)
+            metadata = {
+                "exists": True,
+                "schema": {field.name: field.field_type 
+                           for field in table.schema},
+                "modified": table.modified,
+                "num_rows": table.num_rows,
+                "table_type": table.table_type,
+                "partition_by": (table.time_partitioning.field 
+                                 if table.time_partitioning else None),
+                "cluster_by": table.clustering_fields or []
+            }
+        except NotFound:
+            metadata = {"exists": False}
+        self._metadata[table_id] = metadata
+        return metadata
+    
+    
+    def _table_exists(self, table_id):
+        """Checks the table or its problems table exists, using the cache
+        
+        Args:
+            table_id: string, full id of the table or its problems table
+            
+        Returns:
+            bool, True if the table exists, otherwise False
+        """
+        return self._get_table_metadata(table_id)["exists"]
+    
+    
+    def _problems_table_is_view(self):
+        """Checks if the problems "table" is a view of flagged entries
+        
+        Returns:
+            bool, True if [table_name]_fdm_problems is a view, otherwise False
+        """
+        problems_metadata = self._get_table_metadata(
+            self.full_table_id + "_fdm_problems"
+        )
+        return problems_metadata.get("table_type") == "VIEW"
+    
+    
+    def _invalidate_metadata(self):
+        """Clears cached metadata - must be called whenever the table or its 
+        problems table is written to (including from FDMDataset)
+        
+        Returns:
+            None
+        """
+        self._metadata = {}
+    
+    
+    def _change_column_types(self, types_map, try_alter=True):
+        """Changes data types of columns, or adds the change to the plan
+        
+        Args:
+            types_map: dict, column name: new data type pairs
+            try_alter: bool (default True), False rewrites the table without 
+                first trying ALTER TABLE (see `change_column_types_in_bigquery`
+                in FDM_helpers)
+            
+        Returns:
+            None - changes occurr in GCP
+        """
+        if not self.deferred:
+            change_column_types_in_bigquery(self.full_table_id, types_map,
+                                            try_alter=try_alter)
+            self._invalidate_metadata()
+            return None
+        cast_string = ", ".join(f"CAST({column} AS {data_type}) AS {column}"
+                                for column, data_type in types_map.items())
+        self._rewrite_table(lambda relation: f"""
+            SELECT * REPLACE({cast_string})
+            FROM {relation}
+        """)
+    
+    
+    def _get_delta_table(self):
+        """Gets an FDMTable for the table's [table_name]_fdm_delta table
+        
+        The delta table holds new source rows staged by `quick_build_delta`. 
+        The FDMTable shares the table's settings, so the usual build steps can 
+        be applied to it.
+        
+        Returns:
+            FDMTable, for the delta table
+        """
+        delta_table = copy.copy(self)
+        delta_table.table_id = f"{self.table_id}_fdm_delta"
+        delta_table.full_table_id = f"{self.full_table_id}_fdm_delta"
+        delta_table._plan_base = delta_table.full_table_id
+        delta_table._plan = []
+        delta_table._plan_temp_tables = []
+        delta_table._plan_schema_dict = None
+        delta_table._metadata = {}
+        delta_table._metadata_seeded = False
+        delta_table._in_public_call = False
+        return delta_table
+    
+    
+    def _get_delta_rows_sql(self, watermark_column=None):
+        """Generates query selecting source rows that haven't been built yet
+        
+        See `quick_build_delta`.
+        
+        Args:
+            watermark_column: string (default None), name of a column that 
+                increases as rows are appended - None identifies new rows by 
+                fingerprint, which are kept in an fdm_row_fingerprint column
+                
+        Returns:
+            string, SQL query returning the new source rows
+        """
+        ingested_table_id = f"{self.full_table_id}_fdm_ingested"
+        if watermark_column is None:
+            if not self._table_exists(ingested_table_id):
+                raise ValueError(f"""
+    There's no record of the rows already built in {self.table_id}. Either 
+    provide a watermark_column -- or -- delete {self.table_id} from 
+    {self.dataset_id} and re-run quick_build_delta to rebuild it in full.
+                """)
+            return f"""
+                SELECT src.*, 
+                    FARM_FINGERPRINT(TO_JSON_STRING(src)) AS fdm_row_fingerprint
+                FROM `{self.source_table_full_id}` AS src
+                WHERE FARM_FINGERPRINT(TO_JSON_STRING(src)) NOT IN (
+                    SELECT fdm_row_fingerprint 
+                    FROM `{ingested_table_id}`
+                )
+            """
+        if watermark_column not in self.get_column_names():
+            raise ValueError(f"{watermark_column} isn't a column of "
+                             f"{self.table_id}")
+        built_watermarks_sql = (f"SELECT {watermark_column} "
+                                f"FROM `{self.full_table_id}`")
+        problems_table_id = f"{self.full_table_id}_fdm_problems"
+        if self._table_exists(problems_table_id):
+            built_watermarks_sql += (f"\nUNION ALL\nSELECT {watermark_column} "
+                                     f"FROM `{problems_table_id}`")
+        return f"""
+            WITH built AS (
+                SELECT MAX({watermark_column}) AS max_watermark
+                FROM ({built_watermarks_sql})
+            )
+            SELECT src.*
+            FROM `{self.source_table_full_id}` AS src
+            CROSS JOIN built
+            WHERE built.max_watermark IS NULL 
+                OR src.{watermark_column} > built.max_watermark
+        """
+    
+    
+    def _has_pending_plan(self):
+        """Checks if the table has planned changes that aren't yet committed
+        
+        Returns:
+            bool, True if there are uncommitted changes, otherwise False
+        """
+        return bool(self._plan) or self._plan_base != self.full_table_id
+    
+    
+    def _get_plan_sql(self):
+        """Compiles the planned changes to the table into a single query
+        
+        Each change is a SELECT statement from the result of the previous 
+        change, so changes are nested as subqueries from the plan base - 
+        BigQuery merges these into a single scan of the table.
+        
+        Returns:
+            string, SQL query returning the table with all changes applied
+        """
+        plan_sql = f"""
+            SELECT *
+            FROM `{self._plan_base}`
+        """
+        for select_fn in self._plan:
+            plan_sql = select_fn(f"({plan_sql})")
+        return plan_sql
+    
+    
+    def _get_relation_sql(self):
+        """Gets the table, with any planned changes, for use in a FROM clause
+        
+        Returns:
+            string, the table id in backticks -- or -- the plan's query in 
+                brackets if there are planned changes
+        """
+        if self._has_pending_plan():
+            return f"({self._get_plan_sql()})"
+        return f"`{self.full_table_id}`"
+    
+    
+    def _rewrite_table(self, select_fn, materialise=False):
+        """Rewrites the table, or adds the rewrite to the plan if deferred
+        
+        Args:
+            select_fn: function, takes a relation (table id in backticks or a 
+                subquery in brackets) and returns a SELECT statement from that
+                relation giving the rewritten table
+            materialise: bool (default False), True commits the plan straight 
+                away if deferred e.g. when the rewrite isn't deterministic and 
+                the rewritten table will be read before the plan is committed
+                
+        Returns:
+            None - changes occurr in GCP
+        """
+        if not self.deferred:
+            run_sql_query(select_fn(f"`{self.full_table_id}`"),
+                          destination=self.full_table_id)
+            self._invalidate_metadata()
+            return None
+        self._plan.append(select_fn)
+        self._plan_schema_dict = None
+        if materialise:
+            self.commit()
+    
+    
+    def _delete_temp_table(self, temp_table_id):
+        """Deletes a temp table, or after the plan is committed if deferred
+        
+        Args:
+            temp_table_id: string, full id of the temp table
+            
+        Returns:
+            None - changes occurr in GCP
+        """
+        if self._has_pending_plan():
+            self._plan_temp_tables.append(temp_table_id)
+        else:
+            CLIENT.delete_table(temp_table_id, not_found_ok=True)
+    
+    
     def _add_person_id_to_table(self, verbose=False):
         """Adds person_id column to the table
 
@@ -580,12 +1451,9 @@ class FDMTable:
             if person_id_dtype != "INTEGER":
                 if verbose:
                     print(f"    converting person_id to INTEGER")
-                convert_person_id_sql = f"""
-                    SELECT CAST(person_id AS INTEGER) AS person_id, 
-                        * EXCEPT(person_id)
-                    FROM `{self.full_table_id}` 
-                """
-                run_sql_query(convert_person_id_sql, destination=self.full_table_id)
+                # no other type can be ALTERed to INTEGER, so always rewrite
+                self._change_column_types({"person_id": "INTEGER"}, 
+                                          try_alter=False)
             elif verbose:
                 print(f"    {self.table_id} already contains person_id column")
         else:
@@ -593,15 +1461,19 @@ class FDMTable:
                 identifier = "digest"
             else:
                 identifier = "EDRN" 
-            add_person_id_sql = f"""
+            self._rewrite_table(lambda relation: f"""
                 SELECT demo.person_id, src.*
-                FROM `{self.full_table_id}` src
+                FROM {relation} src
                 LEFT JOIN `{DEMOGRAPHICS}` demo
                 ON src.{identifier} = demo.{identifier}
+            """)
+            person_id_sql = f"""
+                SELECT person_id 
+                FROM {self._get_relation_sql()}
+                WHERE person_id IS NOT NULL
+                LIMIT 1
             """
-            run_sql_query(add_person_id_sql, destination=self.full_table_id)
-            person_id_df = pd.read_gbq(f"SELECT person_id FROM {self.full_table_id}")
-            if person_id_df.person_id.isna().all():
+            if read_sql_query(person_id_sql).empty:
                 raise ValueError(
                     "none of identifier column entries have corresponding " 
                     "person_id - join\nresulted in all NULL values"
@@ -610,75 +1482,130 @@ class FDMTable:
                 print("    person_id column added")
             
             
-    def _get_fdm_date_df(self, date_cols, yearfirst, dayfirst):
-        """Reads and parses dates from source table as pandas DataFrame
-
-        Reads data from table containing date information into pandas DataFrame 
-        and parses with the dateutil parser. UUID required in dataframe, as 
-        parsed dates need to be added back to table.
-
+    def _get_date_info_sql(self, date_cols, as_string=False, table_alias=None):
+        """Generates the SQL expression that selects the unparsed date info
+        
         Args:
             date_cols: string/list, either a string naming a column that contains
                 all the date information (day & month & year) or a list naming 
                 column names or static values containing the day/month/year info
-            yearfirst: bool, if the year appears first in the date info - supersedes
-                dayfirst so yearfirst=True always assumes year info appears first
-                followed by day/month. If False, assumes year appears last.
-            dayfirst: bool, if day appears before month. Superseeded by yearfirst 
-                i.e. yearfirst=True, dayfirst=True means Year/day/month format
+            as_string: bool, if a single date column should be cast to a STRING
+                (lists of columns are always concatenated into a STRING)
+            table_alias: string (default: None), alias of the table in the query
+                the expression is used in, prefixed to column names if provided
                 
         Returns:
-            pandas DataFrame, containing UUID column and parsed_date column with
-                datetimes
+            string, SQL expression
         """
-
         schema_dict = self._get_table_schema_dict()
+        prefix = f"{table_alias}." if table_alias else ""
         if type(date_cols) == list and len(date_cols) == 3:
             cast_cols_sql = []
             for col in date_cols:
                 if col in schema_dict.keys() and schema_dict[col] == "STRING":
-                    cast_cols_sql.append(col)
+                    cast_cols_sql.append(f"{prefix}{col}")
                 elif col in schema_dict.keys(): 
-                    cast_cols_sql.append(f"CAST({col} AS STRING)")
+                    cast_cols_sql.append(f"CAST({prefix}{col} AS STRING)")
                 else:
                     cast_cols_sql.append(f'"{col}"')
             to_concat_sql = ', "-", '.join(cast_cols_sql) 
+            return f"CONCAT({to_concat_sql})"
+        elif as_string and schema_dict[date_cols] != "STRING":
+            return f"CAST({prefix}{date_cols} AS STRING)"
+        else:
+            return f"{prefix}{date_cols}"
+            
+            
+    def _get_fdm_date_df(self, date_cols, date_format, distinct_dates=True, 
+                         unparsed_date_column=None, n_workers=1, 
+                         parse_cache=None):
+        """Reads and parses dates from source table as pandas DataFrame
+
+        Streams data from table containing date information in batches (see 
+        `read_sql_batches` in FDM_helpers) and parses each batch with the 
+        vectorised date parser (see `parse_dates` in FDM_date_parsing), so only
+        the parsed dates are kept in memory. By default only the distinct date 
+        values are read and parsed, giving a map of raw value -> parsed date to 
+        join back onto the table. Otherwise every row is read alongside its 
+        UUID, as parsed dates need to be added back to table. If a parse_cache
+        is provided, only dates not already in the cache are parsed.
+
+        Args:
+            date_cols: string/list, either a string naming a column that contains
+                all the date information (day & month & year) or a list naming 
+                column names or static values containing the day/month/year info
+            date_format: string, format the date appears in one of "DMY"/"MDY"/
+                "YMD"/"YDM"  D being day,  M month and Y year.
+            distinct_dates: bool (default True), True reads each distinct date
+                value once, False reads every row with its UUID
+            unparsed_date_column: string (default: None), name of a partially
+                parsed date column - if provided, only date values from rows 
+                where this column is NULL are read. Requires distinct_dates.
+            n_workers: int (default 1), number of processes used to parse 
+                dates - see `ShardedDateParser` in FDM_date_parsing
+            parse_cache: DateParseCache (default None), cache of previously
+                parsed dates - see `DateParseCache` in FDM_date_parsing
+                
+        Returns:
+            pandas DataFrame, containing raw_date column (STRING date info) -- or
+                -- UUID column if distinct_dates is False, and parsed_date column 
+                with datetimes
+        """
+        # date info is read as STRINGs - avoids INTEGER columns with NULLs being
+        # read as floats
+        date_info_sql = self._get_date_info_sql(date_cols, as_string=True)
+        if distinct_dates:
+            key_col = "raw_date"
+            unparsed_sql = (f"AND {unparsed_date_column} IS NULL" 
+                            if unparsed_date_column else "")
             sql = f"""
-                SELECT uuid, CONCAT({to_concat_sql}) AS date
-                FROM `{self.full_table_id}`
+                SELECT DISTINCT {date_info_sql} AS date
+                FROM {self._get_relation_sql()}
+                WHERE {date_info_sql} IS NOT NULL {unparsed_sql}
             """
         else:
+            key_col = "uuid"
             sql = f"""
-                SELECT uuid, {date_cols} AS date
-                FROM `{self.full_table_id}`
+                SELECT uuid, {date_info_sql} AS date
+                FROM {self._get_relation_sql()}
             """
-
-        dates_df = pd.read_gbq(query=sql, project_id=PROJECT)
         
-        def date_is_short(date):
-            if type(date) is str and len(date) <= 8:
-                return True
-            elif not date:
-                return True
-            else:
-                return False
-        if all(dates_df.date.apply(date_is_short)):
+        # parse batch by batch, keeping only the key and parsed date from each
+        parsed_dfs = []
+        all_years_short = True
+        with ShardedDateParser(n_workers=n_workers) as date_parser:
+            for dates_df in read_sql_batches(sql):
+                all_years_short &= dates_have_short_years(dates_df.date)
+                if distinct_dates:
+                    dates_df["raw_date"] = dates_df.date
+                if parse_cache is not None:
+                    dates_df["parsed_date"] = parse_cache.parse(
+                        dates_df.date, 
+                        date_format=date_format,
+                        date_parser=date_parser
+                    )
+                else:
+                    yearfirst, dayfirst = DATE_FORMAT_SETTINGS[date_format]
+                    dates_df["parsed_date"] = date_parser.parse(
+                        dates_df.date, 
+                        yearfirst=yearfirst,
+                        dayfirst=dayfirst
+                    )
+                parsed_dfs.append(dates_df[[key_col, "parsed_date"]])
+        if not parsed_dfs:
+            return pd.DataFrame({key_col: [], "parsed_date": []})
+        
+        if all_years_short:
                 print("""
     WARNING: 2 character years are ambiguous e.g. 75 will be parsed as 1975 but 
     70 will be parsed as 2070. Consider converting year.
                 """)
-        def parse_date(x):
-            if type(x) is datetime.datetime:
-                x = x.date
-            try:
-                return parse(str(x), dayfirst=dayfirst, yearfirst=yearfirst)
-            except:
-                return None
-        dates_df["parsed_date"] = dates_df.date.apply(parse_date)
-        return dates_df[["uuid", "parsed_date"]]
+        return pd.concat(parsed_dfs, ignore_index=True)
 
 
-    def _add_parsed_date_to_table(self, date_cols, date_format, date_column_name):
+    def _add_parsed_date_to_table(self, date_cols, date_format, date_column_name,
+                                  distinct_dates=True, sql_pushdown=True,
+                                  n_workers=1, parse_cache=False):
         """Adds date info to table in datetime format
 
         Takes date information from specified column(s), parses datetime 
@@ -686,6 +1613,17 @@ class FDMTable:
         argument. If date_cols is a single column that already contains
         datetimes/dates, the function simply creates a new colum and copies
         the data across, naming it using date_column_name.
+        
+        By default, dates are first parsed in BigQuery: common unambiguous 
+        formats (see `get_date_parsing_sql` in FDM_date_parsing) are parsed 
+        as the column is added, in a single query. Only the dates that can't be 
+        parsed in SQL are then read and parsed client side.
+        
+        Source date columns usually hold far fewer distinct values than rows, 
+        so by default only the distinct values are parsed client side, and the 
+        parsed dates are joined back onto the table by their raw value. Setting 
+        distinct_dates to False instead tags each row with a UUID, and parses 
+        and joins every row (without SQL parsing).
 
         Args:
             date_cols: string/list, either a string naming a column that contains
@@ -694,6 +1632,19 @@ class FDMTable:
             date_format: string, format the date appears in one of "DMY"/"MDY"/
                 "YMD"/"YDM"  D being day,  M month and Y year.
             date_column_name: string, name to give the new parsed DATETIME column
+            distinct_dates: bool (default True), True parses each distinct date
+                value once, False parses every row
+            sql_pushdown: bool (default True), True parses dates in BigQuery 
+                where possible, False parses all dates client side. Ignored if
+                distinct_dates is False.
+            n_workers: int (default 1), number of processes used to parse dates
+                client side. Dates are split into shards and parsed in parallel
+                if more than 1, None uses all available CPUs.
+            parse_cache: bool/DateParseCache (default False), True checks the 
+                dataset's on-disk cache of previously parsed dates before 
+                parsing (see `get_default_parse_cache` in FDM_date_parsing), 
+                False parses every date. A DateParseCache can also be provided.
+                Note a cache writes raw date values to disk.
                 
         Returns:
             bool, True if parsed date column successfully added to table, 
@@ -710,57 +1661,123 @@ class FDMTable:
                              "cols or static values containing day/month/year "
                              "info\n    2. string naming one column containing "
                              "date info")
-            
-        date_format_settings = {
-            "YMD": [True, False],
-            "YDM": [True, True],
-            "DMY": [False, True],
-            "MDY": [False, False]
-        }
         
         schema_dict = self._get_table_schema_dict()
         if type(date_cols) == str and schema_dict[date_cols] in ["DATE", "DATETIME"]:
             self.add_column(f"{date_cols} as {date_column_name}")
             return True
-
-        if "uuid" not in self.get_column_names():
-            add_uuid_sql = f"""
+        
+        sql_pushdown = sql_pushdown and distinct_dates
+        if sql_pushdown:
+            self._add_sql_parsed_date_to_table(date_cols, date_format, 
+                                               date_column_name)
+        elif not distinct_dates and "uuid" not in self.get_column_names():
+            # UUIDs must be stored before they're read, so the plan is committed
+            self._rewrite_table(lambda relation: f"""
                 SELECT GENERATE_UUID() AS uuid, *
-                FROM `{self.full_table_id}`
-            """
-            run_sql_query(add_uuid_sql, destination=self.full_table_id)
+                FROM {relation}
+            """, materialise=True)
 
-        yearfirst, dayfirst = date_format_settings[date_format]
-        dates_df = self._get_fdm_date_df(date_cols, 
-                                           yearfirst=yearfirst,
-                                           dayfirst=dayfirst)
+        if parse_cache is True:
+            parse_cache = get_default_parse_cache(self.dataset_id)
+        elif parse_cache is False:
+            parse_cache = None
+        dates_df = self._get_fdm_date_df(
+            date_cols, 
+            date_format=date_format,
+            distinct_dates=distinct_dates,
+            unparsed_date_column=date_column_name if sql_pushdown else None,
+            n_workers=n_workers,
+            parse_cache=parse_cache
+        )
         
         if dates_df.parsed_date.isna().all():
-            self.drop_column("uuid")
-            return False
+            if not distinct_dates:
+                self.drop_column("uuid")
+            if not sql_pushdown:
+                return False
+            n_parsed_sql = f"""
+                SELECT COUNT({date_column_name}) AS n
+                FROM {self._get_relation_sql()}
+            """
+            if read_sql_query(n_parsed_sql).n[0] == 0:
+                self.drop_column(date_column_name)
+                return False
+            return True
         
-        temp_dates_id = f"{PROJECT}.{self.dataset_id}.tmp_dates"
-        dates_df.to_gbq(destination_table=temp_dates_id,
-                        project_id=PROJECT,
-                        table_schema=[{"name":"parsed_date", "type":"DATETIME"}],
-                        if_exists="replace",
-                        progress_bar=False)
-
-        join_dates_sql = f"""
-            SELECT dates.parsed_date AS {date_column_name}, src.*
-            FROM `{self.full_table_id}` AS src
-            LEFT JOIN `{temp_dates_id}` as dates
-            ON src.uuid = dates.uuid
-        """
-        run_sql_query(join_dates_sql, destination=self.full_table_id)
+        temp_dates_id = (f"{PROJECT}.{self.dataset_id}."
+                         f"tmp_dates_{self.table_id}_{date_column_name}")
+        if distinct_dates:
+            table_schema = [{"name":"raw_date", "type":"STRING"},
+                            {"name":"parsed_date", "type":"DATETIME"}]
+            join_on_sql = (self._get_date_info_sql(date_cols, as_string=True,
+                                                   table_alias="src")
+                           + " = dates.raw_date")
+        else:
+            table_schema = [{"name":"uuid", "type":"STRING"},
+                            {"name":"parsed_date", "type":"DATETIME"}]
+            join_on_sql = "src.uuid = dates.uuid"
+        upload_to_bigquery(dates_df, destination=temp_dates_id, 
+                           schema=table_schema)
+        
+        if sql_pushdown:
+            # only fill in the dates that couldn't be parsed in SQL
+            self._rewrite_table(lambda relation: f"""
+                SELECT COALESCE(src.{date_column_name}, dates.parsed_date) 
+                        AS {date_column_name}, 
+                    src.* EXCEPT({date_column_name})
+                FROM {relation} AS src
+                LEFT JOIN `{temp_dates_id}` as dates
+                ON {join_on_sql}
+            """)
+        else:
+            self._rewrite_table(lambda relation: f"""
+                SELECT dates.parsed_date AS {date_column_name}, src.*
+                FROM {relation} AS src
+                LEFT JOIN `{temp_dates_id}` as dates
+                ON {join_on_sql}
+            """)
 
-        self.drop_column("uuid")
+        if not distinct_dates:
+            self.drop_column("uuid")
 
-        CLIENT.delete_table(temp_dates_id)
+        self._delete_temp_table(temp_dates_id)
         
         return True
     
     
+    def _add_sql_parsed_date_to_table(self, date_cols, date_format, 
+                                      date_column_name):
+        """Adds a date column parsed in BigQuery to the table
+        
+        Compiles the date info and format into a SQL expression (see 
+        `get_date_parsing_sql` in FDM_date_parsing) and adds the parsed date 
+        column to the table in a single query. Dates that can't be parsed in SQL
+        are left NULL.
+        
+        Args:
+            date_cols: string/list, either a string naming a column that contains
+                all the date information (day & month & year) or a list naming 
+                column names or static values containing the day/month/year info
+            date_format: string, format the date appears in one of "DMY"/"MDY"/
+                "YMD"/"YDM"  D being day,  M month and Y year.
+            date_column_name: string, name to give the new parsed DATETIME column
+                
+        Returns:
+            None - changes occurr in GCP
+        """
+        date_info_sql = self._get_date_info_sql(date_cols, as_string=True)
+        date_parsing_sql = get_date_parsing_sql("fdm_raw_date", date_format)
+        self._rewrite_table(lambda relation: f"""
+            SELECT {date_parsing_sql} AS {date_column_name}, 
+                * EXCEPT(fdm_raw_date)
+            FROM (
+                SELECT {date_info_sql} AS fdm_raw_date, *
+                FROM {relation}
+            )
+        """)
+        
+        
     def _copy_table_to_dataset_w_inputs(self): 
         """copies table to dataset with user input options
         
@@ -774,10 +1791,10 @@ class FDMTable:
             None - all changes occurr in GCP
         """
         
-        if check_table_exists(self.full_table_id + "_fdm_problems"):
+        if self._table_exists(self.full_table_id + "_fdm_problems"):
             self.recombine()
         overwrite_existing = False
-        if check_table_exists(self.full_table_id):
+        if self._table_exists(self.full_table_id):
             response = input(f"""
         A copy of {self.table_id} already exists in {self.dataset_id}. 
         You can continue with the existing {self.table_id} table in {self.dataset_id}
@@ -815,12 +1832,8 @@ class FDMTable:
             person_id_dtype = self._get_table_schema_dict()["person_id"]
             if person_id_dtype != "INTEGER":
                 print(f"    converting person_id to INTEGER")
-                convert_person_id_sql = f"""
-                    SELECT CAST(person_id AS INTEGER) AS person_id, 
-                        * EXCEPT(person_id)
-                    FROM `{self.full_table_id}` 
-                """
-                run_sql_query(convert_person_id_sql, destination=self.full_table_id)
+                self._change_column_types({"person_id": "INTEGER"}, 
+                                          try_alter=False)
             return True
         
         col_names_list_string = "".join(
@@ -0,0 +1,653 @@
+from concurrent.futures import ProcessPoolExecutor
+import datetime
+from dateutil.parser import parse
+from functools import lru_cache
+from itertools import repeat
+import numpy as np
+import os
+import pandas as pd
+import re
+import sqlite3
+import time
+
+# Set global variables
+# [yearfirst, dayfirst] arguments passed to the dateutil parser for each of the
+# date formats accepted by FDMTable
+DATE_FORMAT_SETTINGS = {
+    "YMD": [True, False],
+    "YDM": [True, True],
+    "DMY": [False, True],
+    "MDY": [False, False]
+}
+# Time suffixes that can follow a date in a parse-able "shape", as pairs of
+# shape (see get_date_shape_formats) and format string
+TIME_SHAPE_FORMATS = {
+    "": "",
+    " 99:99:99": " %H:%M:%S",
+    "T99:99:99": "T%H:%M:%S",
+    " 99:99": " %H:%M"
+}
+# Range of dates that can be held in pandas' (nanosecond) datetime64 columns
+DATETIME64_MIN = datetime.datetime(1677, 9, 22)
+DATETIME64_MAX = datetime.datetime(2262, 4, 11)
+# Directory of the per-dataset caches of parsed dates (see 
+# `get_default_parse_cache`) - set with the FDM_PARSE_CACHE_DIR environment 
+# variable
+DEFAULT_PARSE_CACHE_DIR = os.environ.get(
+    "FDM_PARSE_CACHE_DIR", 
+    os.path.join(os.path.expanduser("~"), ".fdm_builder")
+)
+_DEFAULT_PARSE_CACHES = {}
+DATE_SHAPE_REGEX = re.compile(
+    r"^(?P<first>9{4}|9{1,2}|a{3,9})(?P<sep>[-/. ])(?P<second>9{4}|9{1,2}|a{3,9})"
+    r"(?P=sep)(?P<third>9{4}|9{1,2}|a{3,9})(?P<time>.*)$"
+)
+
+
+def parse_date_with_dateutil(date, yearfirst, dayfirst):
+    """Parses a single date with the dateutil parser
+
+    The original (row by row) parser used by FDMTable - used by `parse_dates`
+    for any values that can't be parsed with a format-specific parser. Any
+    timezone information is discarded, as parsed dates are stored as DATETIMEs.
+    Values that are already datetimes are returned as they are (time included),
+    as in `parse_dates`.
+
+    Args:
+        date: any, value containing date info - converted to a string before
+            parsing
+        yearfirst: bool, if the year appears first in the date info - see
+            dateutil.parser.parse
+        dayfirst: bool, if day appears before month - see dateutil.parser.parse
+
+    Returns:
+        datetime.datetime, parsed date -- or -- None, if date can't be parsed
+    """
+    if isinstance(date, datetime.datetime):
+        return date.replace(tzinfo=None)
+    try:
+        parsed_date = parse(str(date), dayfirst=dayfirst, yearfirst=yearfirst)
+        return parsed_date.replace(tzinfo=None)
+    except:
+        return None
+
+
+@lru_cache(maxsize=None)
+def get_date_layout_formats(layout, sep, dayfirst):
+    """Lists format strings that parse a date layout as dateutil would
+
+    A "layout" describes the date elements in the order they appear, with each
+    element one of "Y" (4 digit year), "N" (1 or 2 digit day/month), "b"
+    (abbreviated month name) or "B" (full month name). Where the day and month
+    are both numbers, the dateutil parser resolves their order using `dayfirst`
+    but swaps the order if the day/month can't otherwise be valid e.g. 13/01/2002
+    is always 13th Jan. The returned formats should be tried in order, and each
+    only applied to values that failed to parse with the formats preceding it.
+
+    Args:
+        layout: tuple, 3 strings detailing the date elements as described above
+        sep: string, separator between the date elements - empty string for
+            a compact date e.g. 20020115
+        dayfirst: bool, if day appears before month - see dateutil.parser.parse
+
+    Returns:
+        list, format strings in order of preference -- or -- None if the
+            layout is ambiguous and should be left to the dateutil parser
+    """
+    month_formats = {"b": "%b", "B": "%B"}
+    has_month_name = any(element in month_formats for element in layout)
+    # compact dates must be numeric (and year first), and space separated 
+    # numbers are left to dateutil as they can be mistaken for times
+    if sep == "" and layout != ("Y", "N", "N"):
+        return None
+    if sep == " " and not has_month_name:
+        return None
+    if layout == ("Y", "N", "N"):
+        ymd = f"%Y{sep}%m{sep}%d"
+        ydm = f"%Y{sep}%d{sep}%m"
+        return [ydm, ymd] if dayfirst else [ymd]
+    if layout == ("N", "N", "Y"):
+        dmy = f"%d{sep}%m{sep}%Y"
+        mdy = f"%m{sep}%d{sep}%Y"
+        return [dmy, mdy] if dayfirst else [mdy, dmy]
+    if not has_month_name or "Y" not in layout:
+        return None
+    month_position = [i for i, element in enumerate(layout)
+                      if element in month_formats][0]
+    year_position = layout.index("Y")
+    if month_position == 0 and year_position == 2:
+        element_formats = [month_formats[layout[0]], "%d", "%Y"]
+    elif month_position == 1 and year_position == 2:
+        element_formats = ["%d", month_formats[layout[1]], "%Y"]
+    elif month_position == 1 and year_position == 0:
+        element_formats = ["%Y", month_formats[layout[1]], "%d"]
+    else:
+        return None
+    return [sep.join(element_formats)]
+
+
+@lru_cache(maxsize=None)
+def get_date_shape_formats(shape, dayfirst):
+    """Lists format strings that can parse all the dates with a given shape
+
+    A date's "shape" is the date string with every digit replaced by 9 and
+    every letter replaced with "a" e.g. "15-Jan-2002" has shape "99-aaa-9999".
+
+    Args:
+        shape: string, the date shape
+        dayfirst: bool, if day appears before month - see dateutil.parser.parse
+
+    Returns:
+        list, format strings in order of preference (see
+            get_date_layout_formats) -- or -- None if dates of this shape should
+            be left to the dateutil parser
+    """
+    element_kinds = {"9999": "Y", "99": "N", "9": "N", "aaa": "b"}
+    if shape[:8] == "99999999":
+        layout, sep, time_shape = ("Y", "N", "N"), "", shape[8:]
+    else:
+        match = DATE_SHAPE_REGEX.match(shape)
+        if not match:
+            return None
+        layout = tuple(element_kinds.get(match.group(element), "B")
+                       for element in ["first", "second", "third"])
+        sep, time_shape = match.group("sep"), match.group("time")
+    if time_shape not in TIME_SHAPE_FORMATS:
+        return None
+    date_formats = get_date_layout_formats(layout, sep, dayfirst)
+    if date_formats is None:
+        return None
+    return [date_format + TIME_SHAPE_FORMATS[time_shape]
+            for date_format in date_formats]
+
+
+def to_datetime_series(dates):
+    """Converts a series of python datetimes into a datetime64 series if possible
+    
+    Args:
+        dates: pandas.Series, containing datetimes and/or missing values
+        
+    Returns:
+        pandas.Series, with datetime64[ns] dtype -- or -- with object dtype and 
+            missing values as None, if any dates are outside the range of pandas' 
+            datetime64 (these are kept as python datetimes, as they are by the 
+            dateutil parser)
+    """
+    is_in_bounds = dates.apply(
+        lambda date: pd.isna(date) or DATETIME64_MIN <= date <= DATETIME64_MAX
+    )
+    if is_in_bounds.all():
+        return pd.to_datetime(dates).astype("datetime64[ns]")
+    return dates.astype(object).where(dates.notna(), None)
+
+
+def dates_have_short_years(dates):
+    """Checks if every date could only contain a 2 character year
+
+    Args:
+        dates: pandas.Series, unparsed date info
+
+    Returns:
+        bool, True if every date is either empty or a string 8 characters long
+            or less, otherwise False
+    """
+    def date_is_short(date):
+        if type(date) is str and len(date) <= 8:
+            return True
+        elif pd.isna(date) or not date:
+            return True
+        else:
+            return False
+    # only the distinct values need checking
+    return all(date_is_short(date) for date in pd.unique(dates))
+
+
+def parse_dates(dates, yearfirst, dayfirst):
+    """Parses a series of dates, grouping values by shape to parse in bulk
+
+    Vectorised equivalent of applying `parse_date_with_dateutil` to each value.
+    Each distinct value is only parsed once. Values are grouped by "shape" (see
+    get_date_shape_formats) and each group with an unambiguous shape is parsed
+    with a single format-specific `pandas.to_datetime` call. Any values left
+    over - those with unusual shapes, or that don't fit the format for their
+    shape - are parsed one by one with the dateutil parser.
+
+    Args:
+        dates: pandas.Series, date info to be parsed
+        yearfirst: bool, if the year appears first in the date info - see
+            dateutil.parser.parse
+        dayfirst: bool, if day appears before month - see dateutil.parser.parse
+
+    Returns:
+        pandas.Series, parsed dates with the same index as `dates`. Dates that
+            can't be parsed are NaT/None
+    """
+    if pd.api.types.is_datetime64_any_dtype(dates):
+        if getattr(dates.dt, "tz", None) is not None:
+            dates = dates.dt.tz_localize(None)
+        return dates.rename("parsed_date")
+
+    codes, uniques = pd.factorize(dates)
+    unique_dates = pd.Series(uniques, dtype=object).astype(str)
+    shapes = (unique_dates.str.replace(r"\d", "9", regex=True)
+              .str.replace(r"[A-Za-z]", "a", regex=True))
+    parsed_uniques = pd.Series(pd.NaT, index=unique_dates.index,
+                               dtype="datetime64[ns]")
+    is_parsed = pd.Series(False, index=unique_dates.index)
+    
+    # values that are already datetimes are kept as they are (see 
+    # `parse_date_with_dateutil`) rather than re-parsed from strings
+    is_datetime = pd.Series([isinstance(date, datetime.datetime) 
+                             for date in uniques], index=unique_dates.index)
+    if is_datetime.any():
+        datetime_parsed = to_datetime_series(pd.Series(
+            [date.replace(tzinfo=None) for date in uniques[is_datetime.to_numpy()]],
+            index=unique_dates.index[is_datetime], dtype=object
+        ))
+        if datetime_parsed.dtype == object:
+            parsed_uniques = parsed_uniques.astype(object).where(
+                parsed_uniques.notna(), None
+            )
+        parsed_uniques[datetime_parsed.index] = datetime_parsed
+        is_parsed[is_datetime] = True
+
+    for shape, shape_dates in unique_dates[~is_datetime].groupby(
+            shapes[~is_datetime], sort=False):
+        date_formats = get_date_shape_formats(shape, dayfirst)
+        if date_formats is None:
+            continue
+        to_parse = shape_dates
+        for date_format in date_formats:
+            parsed = pd.to_datetime(to_parse, format=date_format,
+                                    errors="coerce")
+            parsed = parsed[(parsed >= DATETIME64_MIN) 
+                            & (parsed <= DATETIME64_MAX)]
+            parsed_uniques[parsed.index] = parsed.astype("datetime64[ns]")
+            is_parsed[parsed.index] = True
+            to_parse = to_parse[~to_parse.index.isin(parsed.index)]
+            if to_parse.empty:
+                break
+
+    leftover_dates = unique_dates[~is_parsed]
+    if not leftover_dates.empty:
+        leftover_parsed = to_datetime_series(leftover_dates.apply(
+            parse_date_with_dateutil, yearfirst=yearfirst, dayfirst=dayfirst
+        ))
+        if leftover_parsed.dtype == object:
+            parsed_uniques = parsed_uniques.astype(object).where(
+                parsed_uniques.notna(), None
+            )
+        parsed_uniques[leftover_parsed.index] = leftover_parsed
+
+    # append a missing value to be taken by missing dates (code -1)
+    missing_date = None if parsed_uniques.dtype == object else np.datetime64("NaT")
+    parsed_uniques = np.append(parsed_uniques.to_numpy(), missing_date)
+    return pd.Series(parsed_uniques.take(codes), index=dates.index,
+                     name="parsed_date")
+
+
+def shard_dates(dates, n_shards, shard_by="hash"):
+    """Splits a series of dates into shards to be parsed separately
+    
+    Args:
+        dates: pandas.Series, date info to be parsed
+        n_shards: int, number of shards to split dates into
+        shard_by: string, one of "hash" (default) or "range". "hash" buckets 
+            dates by a hash of their value, so repeated values all fall in the 
+            same shard and are only parsed once. "range" splits dates into 
+            contiguous ranges of rows.
+            
+    Returns:
+        list, pandas.Series for each shard (empty shards are excluded) - the 
+            index of the original series is kept
+    """
+    if shard_by == "hash":
+        shard_ids = (pd.util.hash_pandas_object(dates, index=False).to_numpy() 
+                     % n_shards)
+    elif shard_by == "range":
+        shard_ids = np.arange(len(dates)) * n_shards // max(len(dates), 1)
+    else:
+        raise ValueError('shard_by must be one of "hash" or "range"')
+    shards = [dates[shard_ids == shard_id] for shard_id in range(n_shards)]
+    return [shard for shard in shards if not shard.empty]
+
+
+class ShardedDateParser:
+    """Parses dates in shards using a pool of worker processes
+    
+    Splits each series of dates passed to `.parse()` into shards (see 
+    shard_dates) and parses each shard with `parse_dates` in a separate 
+    process, before merging the results. Should be used as a context manager 
+    so the worker processes are shut down once parsing is complete. With 1 
+    worker, or only a few dates, dates are parsed in the current process.
+    
+    Args:
+        n_workers: int (default 1), number of worker processes. None uses the 
+            number of CPUs.
+        n_shards: int (default None), number of shards each series of dates 
+            is split into - None uses n_workers
+        shard_by: string, one of "hash" (default) or "range" - see shard_dates
+        min_shard_size: int (default 10000), dates are parsed in the current 
+            process if each shard would contain fewer dates than this
+            
+    Example:
+    ```python
+    with ShardedDateParser(n_workers=8) as date_parser:
+        parsed_dates = date_parser.parse(dates, yearfirst=False, dayfirst=True)
+    ```
+    """
+    def __init__(self, n_workers=1, n_shards=None, shard_by="hash", 
+                 min_shard_size=10000):
+        self.n_workers = n_workers or os.cpu_count()
+        self.n_shards = n_shards
+        self.shard_by = shard_by
+        self.min_shard_size = min_shard_size
+        self._executor = None
+        
+        
+    def __enter__(self):
+        if self.n_workers != 1:
+            self._executor = ProcessPoolExecutor(max_workers=self.n_workers)
+        return self
+    
+    
+    def __exit__(self, *exc_info):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+            
+            
+    def parse(self, dates, yearfirst, dayfirst):
+        """Parses a series of dates, in parallel shards where worthwhile
+        
+        Args:
+            dates: pandas.Series, date info to be parsed
+            yearfirst: bool, if the year appears first in the date info - see
+                dateutil.parser.parse
+            dayfirst: bool, if day appears before month - see 
+                dateutil.parser.parse
+                
+        Returns:
+            pandas.Series, parsed dates with the same index as `dates` (see 
+                parse_dates)
+        """
+        n_shards = self.n_shards or self.n_workers
+        if (self._executor is None 
+                or len(dates) < n_shards * self.min_shard_size):
+            return parse_dates(dates, yearfirst=yearfirst, dayfirst=dayfirst)
+        positional_dates = dates.reset_index(drop=True)
+        shards = shard_dates(positional_dates, n_shards, self.shard_by)
+        parsed_shards = self._executor.map(parse_dates, shards, 
+                                           repeat(yearfirst), repeat(dayfirst))
+        parsed_dates = pd.concat(list(parsed_shards)).sort_index()
+        parsed_dates.index = dates.index
+        return parsed_dates
+
+
+class DateParseCache:
+    """Persistent on-disk cache of parsed dates, shared across tables and runs
+    
+    Stores the parsed date for each (raw date string, date format) pair in a 
+    sqlite database, so dates that appear across source tables and rebuilds are
+    only ever parsed once. Note the raw date strings - values from the source 
+    tables - are written to disk, so the database should be kept somewhere 
+    suitable for the source data. Dates that couldn't be parsed are cached too. Once 
+    the cache holds more than `max_entries` dates, the least recently used 
+    dates are evicted. Hits and misses are counted for every lookup.
+    
+    Note: the dateutil parser fills in missing date parts (e.g. the day in 
+    "Jan 2002") from the current date, so cached results for such dates keep
+    the date they were first parsed on.
+    
+    Args:
+        path: string, location of the sqlite database - created if it 
+            doesn't already exist
+        max_entries: int (default 1000000), maximum number of cached dates
+        
+    Attributes:
+        hits: int, number of date lookups found in the cache
+        misses: int, number of date lookups that required parsing
+        
+    Example:
+    ```python
+    parse_cache = DateParseCache("date_parse_cache.sqlite")
+    parsed_dates = parse_cache.parse(dates, date_format="DMY")
+    print(parse_cache.stats())
+    ```
+    """
+    def __init__(self, path, max_entries=1000000):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.executescript("""
+            CREATE TABLE IF NOT EXISTS parsed_dates (
+                raw_date TEXT NOT NULL,
+                date_format TEXT NOT NULL,
+                parsed_date TEXT,
+                last_used INTEGER NOT NULL,
+                PRIMARY KEY (raw_date, date_format)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS parsed_dates_last_used 
+                ON parsed_dates (last_used);
+        """)
+        
+        
+    def parse(self, dates, date_format, date_parser=None):
+        """Parses dates, only parsing those that aren't already cached
+        
+        Args:
+            dates: pandas.Series, STRING date info to be parsed
+            date_format: string, one of "YMD", "YDM", "DMY", "MDY" - see 
+                DATE_FORMAT_SETTINGS
+            date_parser: ShardedDateParser (default None), used to parse any 
+                dates not in the cache - None uses `parse_dates`
+                
+        Returns:
+            pandas.Series, parsed dates with the same index as `dates` (see 
+                parse_dates)
+        """
+        yearfirst, dayfirst = DATE_FORMAT_SETTINGS[date_format]
+        if dates.dropna().empty:
+            return pd.Series(pd.NaT, index=dates.index, dtype="datetime64[ns]")
+        unique_dates = pd.Series(dates.dropna().unique(), dtype=object).astype(str)
+        cached_dates = self._lookup(unique_dates, date_format)
+        self.hits += len(cached_dates)
+        self.misses += len(unique_dates) - len(cached_dates)
+        
+        new_dates = unique_dates[~unique_dates.isin(cached_dates.index)]
+        new_dates.index = new_dates.values
+        if date_parser is None:
+            new_parsed = parse_dates(new_dates, yearfirst=yearfirst, 
+                                     dayfirst=dayfirst)
+        else:
+            new_parsed = date_parser.parse(new_dates, yearfirst=yearfirst, 
+                                           dayfirst=dayfirst)
+        self._store(new_parsed, date_format)
+        
+        parsed_map = to_datetime_series(pd.concat([
+            to_datetime_series(cached_dates).astype(object), 
+            new_parsed.astype(object)
+        ]))
+        return to_datetime_series(dates.map(parsed_map))
+    
+    
+    def stats(self):
+        """Summarises use of the cache
+        
+        Returns:
+            dict, containing hits, misses, hit rate and number of cached dates
+        """
+        n_entries = self._connection.execute(
+            "SELECT COUNT(*) FROM parsed_dates"
+        ).fetchone()[0]
+        n_lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / n_lookups if n_lookups else None,
+            "entries": n_entries
+        }
+    
+    
+    def clear(self):
+        """Removes all dates from the cache and resets the hit/miss counts"""
+        with self._connection:
+            self._connection.execute("DELETE FROM parsed_dates")
+        self.hits = 0
+        self.misses = 0
+        
+        
+    def _lookup(self, unique_dates, date_format):
+        """Finds cached dates and marks them as recently used
+        
+        Args:
+            unique_dates: pandas.Series, distinct STRING dates to look up
+            date_format: string, format the dates were parsed with
+            
+        Returns:
+            pandas.Series, parsed dates (python datetimes or None) indexed by
+                raw date string, for the dates found in the cache
+        """
+        with self._connection:
+            self._connection.execute(
+                "CREATE TEMP TABLE IF NOT EXISTS lookup_dates "
+                "(raw_date TEXT PRIMARY KEY)"
+            )
+            self._connection.execute("DELETE FROM lookup_dates")
+            self._connection.executemany(
+                "INSERT INTO lookup_dates VALUES (?)",
+                ((raw_date,) for raw_date in unique_dates)
+            )
+            rows = self._connection.execute("""
+                SELECT cache.raw_date, cache.parsed_date
+                FROM lookup_dates lookup
+                INNER JOIN parsed_dates cache
+                ON cache.raw_date = lookup.raw_date AND cache.date_format = ?
+            """, (date_format,)).fetchall()
+            self._connection.execute("""
+                UPDATE parsed_dates SET last_used = ?
+                WHERE date_format = ? 
+                    AND raw_date IN (SELECT raw_date FROM lookup_dates)
+            """, (time.time_ns(), date_format))
+        return pd.Series(
+            [datetime.datetime.fromisoformat(parsed_date) if parsed_date else None
+             for _, parsed_date in rows],
+            index=[raw_date for raw_date, _ in rows],
+            dtype=object
+        )
+    
+    
+    def _store(self, parsed_dates, date_format):
+        """Adds newly parsed dates to the cache, evicting old dates if required
+        
+        Args:
+            parsed_dates: pandas.Series, parsed dates indexed by raw date string
+            date_format: string, format the dates were parsed with
+            
+        Returns:
+            None
+        """
+        if parsed_dates.empty:
+            return None
+        last_used = time.time_ns()
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO parsed_dates VALUES (?, ?, ?, ?)",
+                ((raw_date, date_format, 
+                  None if pd.isna(parsed_date) else parsed_date.isoformat(" "),
+                  last_used)
+                 for raw_date, parsed_date in parsed_dates.items())
+            )
+            n_entries = self._connection.execute(
+                "SELECT COUNT(*) FROM parsed_dates"
+            ).fetchone()[0]
+            if n_entries > self.max_entries:
+                self._connection.execute("""
+                    DELETE FROM parsed_dates
+                    WHERE (raw_date, date_format) IN (
+                        SELECT raw_date, date_format
+                        FROM parsed_dates
+                        ORDER BY last_used
+                        LIMIT ?
+                    )
+                """, (n_entries - self.max_entries,))
+        
+        
+def get_default_parse_cache(dataset_id):
+    """Gets the DateParseCache shared by the FDMTables of a dataset
+    
+    Each dataset has its own cache, so dates from one dataset's source tables 
+    are never stored alongside (or read by builds of) another's.
+    
+    Args:
+        dataset_id: string, id of the dataset the FDMTables are built in
+    
+    Returns:
+        DateParseCache, stored as date_parse_cache_[dataset_id].sqlite in 
+            DEFAULT_PARSE_CACHE_DIR
+    """
+    if dataset_id not in _DEFAULT_PARSE_CACHES:
+        _DEFAULT_PARSE_CACHES[dataset_id] = DateParseCache(os.path.join(
+            DEFAULT_PARSE_CACHE_DIR, f"date_parse_cache_{dataset_id}.sqlite"
+        ))
+    return _DEFAULT_PARSE_CACHES[dataset_id]
+
+
+def get_date_parsing_sql(date_info_col, date_format):
+    """Compiles SQL that parses dates in BigQuery as `parse_dates` would
+    
+    Generates a CASE expression with a branch for each unambiguous date shape 
+    (see get_date_layout_formats). Each branch checks the date info matches 
+    the shape exactly, then tries the formats for the shape in order with 
+    SAFE.PARSE_DATETIME. Dates that don't match any of the shapes, or can't be 
+    parsed using the formats for their shape, are left NULL - these should be 
+    parsed client side with `parse_dates`.
+    
+    Args:
+        date_info_col: string, name of a STRING column containing the unparsed
+            date info
+        date_format: string, one of "YMD", "YDM", "DMY", "MDY" - see 
+            DATE_FORMAT_SETTINGS
+            
+    Returns:
+        string, SQL expression giving the parsed DATETIME
+    """
+    yearfirst, dayfirst = DATE_FORMAT_SETTINGS[date_format]
+    element_regexes = {"Y": r"[1-9]\d{3}", "N": r"\d{1,2}", 
+                       "b": "[A-Za-z]{3}", "B": "[A-Za-z]{4,9}"}
+    layouts = [("Y", "N", "N"), ("N", "N", "Y")]
+    for month in ["b", "B"]:
+        layouts += [("N", month, "Y"), (month, "N", "Y"), ("Y", month, "N")]
+    
+    when_sql_list = []
+    for time_shape, time_format in TIME_SHAPE_FORMATS.items():
+        time_regex = time_shape.replace("99", r"\d{2}")
+        for sep in ["-", "/", ".", " ", ""]:
+            sep_regex = r"\." if sep == "." else sep
+            for layout in layouts:
+                date_formats = get_date_layout_formats(layout, sep, dayfirst)
+                if date_formats is None:
+                    continue
+                if sep:
+                    date_regex = sep_regex.join(element_regexes[element] 
+                                                for element in layout)
+                else:
+                    date_regex = r"[1-9]\d{7}"
+                parse_sql_list = [
+                    f'SAFE.PARSE_DATETIME("{date_format + time_format}", '
+                    f'{date_info_col})'
+                    for date_format in date_formats
+                ]
+                if len(parse_sql_list) > 1:
+                    parse_sql = f"COALESCE({', '.join(parse_sql_list)})"
+                else:
+                    parse_sql = parse_sql_list[0]
+                when_sql_list.append(
+                    f'WHEN REGEXP_CONTAINS({date_info_col}, '
+                    f'r"^{date_regex}{time_regex}$") THEN {parse_sql}'
+                )
+    when_sql = "\n".join(when_sql_list)
+    return f"CASE\n{when_sql}\nELSE NULL END"
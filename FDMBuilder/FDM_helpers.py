@@ -1,18 +1,43 @@
 # from google.cloud import bigquery
 from google.cloud import bigquery
+from google.cloud.exceptions import BadRequest, Forbidden, NotFound
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import datetime
+import io
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import warnings
+try:
+    from google.cloud import bigquery_storage
+except ImportError:
+    bigquery_storage = None
 warnings.filterwarnings("ignore", category=UserWarning)
 warnings.filterwarnings("ignore", category=SyntaxWarning)
 
 # Set global variables
 PROJECT = "yhcr-prd-phm-bia-core"
 CLIENT = bigquery.Client(project=PROJECT)
+# INFORMATION_SCHEMA data types that differ from the types in table schemas
+# returned by the bigquery library
+LEGACY_DATA_TYPES = {
+    "INT64": "INTEGER",
+    "FLOAT64": "FLOAT",
+    "BOOL": "BOOLEAN",
+    "STRUCT": "RECORD"
+}
+# error reasons BigQuery gives when a table can't be cloned/copied a particular
+# way (see `clone_table`)
+UNSUPPORTED_COPY_REASONS = {"invalid", "invalidQuery", "accessDenied"}
 
 
 def rename_columns_in_bigquery(table_id, names_map, verbose=True):
     """Renames columns of a table in bigquery
+    
+    Renames are metadata only where possible, using a single ALTER TABLE 
+    statement. If that fails (e.g. names are being swapped) the table is 
+    rewritten with the columns aliased.
 
     Args:
         table_id: string, full id (project_id.dataset_id.table_id) of the table 
@@ -23,7 +48,7 @@ def rename_columns_in_bigquery(table_id, names_map, verbose=True):
             suppress all console output
 
     Returns:
-        None - changes occurr in GCP
+        string, the method used: "alter" or "rewrite"
 
     Example:
     ```python
@@ -43,6 +68,14 @@ def rename_columns_in_bigquery(table_id, names_map, verbose=True):
         alias_list.append(f"{old_name} AS {new_name}")
         if verbose:
             print(f"\t{old_name} -> {new_name}")
+    
+    rename_sql = ", ".join(f"RENAME COLUMN {old_name} TO {new_name}"
+                           for old_name, new_name in names_map.items())
+    if try_alter_table(table_id, rename_sql):
+        if verbose:
+            print("\tRenaming Complete (ALTER TABLE)\n")
+        return "alter"
+    
     alias_string = ", ".join(alias_list)
     old_names_string = ", ".join(names_map.keys())
     n_table_cols = len(get_table_schema_dict(table_id))
@@ -60,7 +93,106 @@ def rename_columns_in_bigquery(table_id, names_map, verbose=True):
 
     run_sql_query(sql=sql, destination=table_id)
     if verbose:
-        print("\tRenaming Complete\n")
+        print("\tRenaming Complete (table rewritten)\n")
+    return "rewrite"
+
+
+def drop_columns_in_bigquery(table_id, columns, verbose=False):
+    """Drops columns from a table in bigquery
+    
+    Drops are metadata only where possible, using a single ALTER TABLE 
+    statement. If that fails (e.g. a column is used to partition/cluster the
+    table) the table is rewritten without the columns.
+    
+    Args:
+        table_id: string, full id (project_id.dataset_id.table_id) of the table 
+            containing the columns to be dropped
+        columns: list, strings naming the columns to be dropped
+        verbose: bool, True to output the method used to console
+        
+    Returns:
+        string, the method used: "alter" or "rewrite"
+    """
+    drop_sql = ", ".join(f"DROP COLUMN {column}" for column in columns)
+    if try_alter_table(table_id, drop_sql):
+        method = "alter"
+    else:
+        sql = f"""
+            SELECT * EXCEPT({", ".join(columns)})
+            FROM `{table_id}`
+        """
+        run_sql_query(sql=sql, destination=table_id)
+        method = "rewrite"
+    if verbose:
+        print(f"\tDropped {', '.join(columns)} ({method})")
+    return method
+
+
+def change_column_types_in_bigquery(table_id, types_map, verbose=False, 
+                                    try_alter=True):
+    """Changes the data types of columns of a table in bigquery
+    
+    BigQuery can change column types without a rewrite only when the new type
+    can hold every value of the old type e.g. INTEGER -> NUMERIC/FLOAT. This 
+    is tried first, with a single ALTER TABLE statement. Otherwise (e.g. 
+    STRING -> INTEGER) the table is rewritten with the columns CAST to the new 
+    types.
+    
+    Args:
+        table_id: string, full id (project_id.dataset_id.table_id) of the table 
+            containing the columns to be changed
+        types_map: dict, key-value pairs are strings, keys naming the columns 
+            and values the new data types e.g. {"person_id": "INTEGER"}
+        verbose: bool, True to output the method used to console
+        try_alter: bool (default True), False skips the ALTER TABLE attempt 
+            and rewrites the table - for changes known not to be possible 
+            without a rewrite e.g. STRING -> INTEGER
+        
+    Returns:
+        string, the method used: "alter" or "rewrite"
+    """
+    alter_sql = ", ".join(f"ALTER COLUMN {column} SET DATA TYPE {data_type}"
+                          for column, data_type in types_map.items())
+    if try_alter and try_alter_table(table_id, alter_sql):
+        method = "alter"
+    else:
+        cast_string = ", ".join(f"CAST({column} AS {data_type}) AS {column}"
+                                for column, data_type in types_map.items())
+        sql = f"""
+            SELECT * REPLACE({cast_string})
+            FROM `{table_id}`
+        """
+        run_sql_query(sql=sql, destination=table_id)
+        method = "rewrite"
+    if verbose:
+        print(f"\tChanged data types of {', '.join(types_map.keys())} ({method})")
+    return method
+
+
+def try_alter_table(table_id, alter_sql):
+    """Attempts a metadata only change to a table with ALTER TABLE
+    
+    Args:
+        table_id: string, full id (project_id.dataset_id.table_id) of the table
+        alter_sql: string, comma separated ALTER TABLE actions e.g. 
+            "RENAME COLUMN a TO b, RENAME COLUMN c TO d"
+            
+    Returns:
+        bool, True if the table was altered, False if BigQuery rejected the 
+            change as invalid for the table (the table is left unchanged) - 
+            any other error is raised
+    """
+    try:
+        run_sql_query(f"""
+            ALTER TABLE `{table_id}`
+            {alter_sql}
+        """)
+        return True
+    except BadRequest as error:
+        if any(reason.get("reason") == "invalidQuery" 
+               for reason in error.errors):
+            return False
+        raise
     
     
 def clear_dataset(dataset_id, containing=None):
@@ -84,19 +216,33 @@ def clear_dataset(dataset_id, containing=None):
         CLIENT.delete_table(full_table_id, not_found_ok=True)
         
         
-def run_sql_query(sql, destination=None):
+def run_sql_query(sql, destination=None, partition_by=None, cluster_by=None):
     """Quick way to run sql queries with bigquery library
     
     Can be used to run sql queries exactly as they would run using the 
     BigQuery SQL Workspace. By setting the "destination" argument, the results
     of a query can be stored as a new table/overwrite an existing table at the
     table id specified.
+    
+    The stored table can be partitioned by month on a date column and/or 
+    clustered. If neither is specified and the table already exists, it keeps
+    its partitioning and clustering (minus any columns the results no longer
+    have) - the table is only looked up if BigQuery rejects the results as 
+    partitioned/clustered differently. BigQuery can't overwrite a table with 
+    results partitioned/clustered differently, so if the partitioning/
+    clustering changes the results are stored in a temp table that then 
+    replaces the table.
 
     Args:
         sql: string, the SQL command to be run
         destination: string (default: None), a table id where the results
             of the SQL command will be stored, if None then results aren't 
             stored
+        partition_by: string (default: None), name of a DATE/DATETIME/TIMESTAMP
+            column to partition the stored table by, one partition per month
+        cluster_by: list (default: None), names of up to 4 columns to cluster 
+            the stored table by - [] stores the table unclustered, rather than
+            keeping an existing table's partitioning/clustering
 
     Returns:
         bigquery.table.Table, containing table object of the stored results of 
@@ -117,25 +263,398 @@ def run_sql_query(sql, destination=None):
     query = run_sql_query(
         sql = "UPDATE example.table.id SET value = 100 WHERE value > 100"
     )
+    
+    # stores results partitioned by month of event_date, clustered by person_id
+    table = run_sql_query(
+        sql = "SELECT * FROM `example.table.id`",
+        destination = "destination.for.results",
+        partition_by = "event_date",
+        cluster_by = ["person_id"]
+    )
     ```
     """
     
-    if destination:
-        job_config = bigquery.QueryJobConfig(
-            destination=destination, 
-            write_disposition="WRITE_TRUNCATE"
-        )
+    if not destination:
+        query_job = CLIENT.query(sql)  # Make an API request.
+        query_job.result()  # Wait for the job to complete.
+        return query_job
+    
+    if partition_by is None and cluster_by is None:
+        # most tables are written with the same (or no) partitioning/clustering 
+        # as the existing table, so the write is tried without looking it up
+        try:
+            write_query_results(sql, destination)
+            return CLIENT.get_table(destination)
+        except BadRequest as error:
+            # results partitioned/clustered differently from the existing 
+            # table are rejected as "invalid" - as are other invalid writes, 
+            # so the error is only handled if the existing table has a 
+            # partitioning/clustering the results didn't match
+            if not any(reason.get("reason") == "invalid" 
+                       for reason in error.errors):
+                raise
+            existing_table = CLIENT.get_table(destination)
+            partitioning = existing_table.time_partitioning
+            cluster_by = existing_table.clustering_fields
+            if get_table_spec(partitioning, cluster_by) == get_table_spec():
+                raise
+        if (partitioning is not None and partitioning.field) or cluster_by:
+            # dry run to check the results still have the columns
+            dry_run_config = bigquery.QueryJobConfig(dry_run=True)
+            result_columns = [field.name for field in 
+                              CLIENT.query(sql, job_config=dry_run_config).schema]
+            if (partitioning is not None and partitioning.field 
+                    and partitioning.field not in result_columns):
+                partitioning = None
+            if cluster_by:
+                cluster_by = [column for column in cluster_by 
+                              if column in result_columns] or None
     else:
-        job_config=None
+        partitioning = (bigquery.TimePartitioning(
+            type_=bigquery.TimePartitioningType.MONTH, field=partition_by
+        ) if partition_by is not None else None)
+        try:
+            existing_table = CLIENT.get_table(destination)
+        except NotFound:
+            existing_table = None
+    
+    spec_changed = existing_table is not None and (
+        get_table_spec(existing_table.time_partitioning, 
+                       existing_table.clustering_fields)
+        != get_table_spec(partitioning, cluster_by)
+    )
+    write_query_results(sql, 
+                        f"{destination}_fdm_tmp" if spec_changed else destination,
+                        partitioning=partitioning, cluster_by=cluster_by)
+    if spec_changed:
+        replace_table(destination, f"{destination}_fdm_tmp")
     
+    result_table = CLIENT.get_table(destination)
+    return result_table
+
+
+def write_query_results(sql, destination, partitioning=None, cluster_by=None):
+    """Stores the results of a query in a table, overwriting any existing table
+    
+    Args:
+        sql: string, the SQL query to be run
+        destination: string, full id of the table to store the results in
+        partitioning: bigquery.TimePartitioning (default None), time 
+            partitioning of the stored table
+        cluster_by: list (default None), names of the columns the stored table 
+            is clustered by
+            
+    Returns:
+        bigquery.job.QueryJob, the completed query job
+    """
+    job_config = bigquery.QueryJobConfig(
+        destination=destination, 
+        write_disposition="WRITE_TRUNCATE",
+        time_partitioning=partitioning,
+        clustering_fields=cluster_by or None
+    )
     query_job = CLIENT.query(sql, job_config=job_config)  # Make an API request.
     query_job.result()  # Wait for the job to complete.
+    return query_job
+
+
+def get_table_spec(partitioning=None, cluster_by=None):
+    """Summarises a table's partitioning and clustering for comparison
     
-    if destination:
-        result_table = CLIENT.get_table(destination)
-        return result_table
+    Args:
+        partitioning: bigquery.TimePartitioning (default None), time 
+            partitioning of a table/query job -- or -- None if not partitioned
+        cluster_by: list (default None), names of the columns the table is 
+            clustered by
+            
+    Returns:
+        tuple, partitioning type (e.g. "MONTH") and column (None if not 
+            partitioned), and tuple of clustering columns
+    """
+    if partitioning is None:
+        partitioning_spec = None
     else:
-        return query_job
+        partitioning_spec = (partitioning.type_, partitioning.field)
+    return (partitioning_spec, tuple(cluster_by or ()))
+
+
+def get_destination_for_spec(table_id, partition_by=None, cluster_by=None):
+    """Gets where to write a table that will be partitioned/clustered
+    
+    BigQuery can't replace a table with one partitioned/clustered differently 
+    (e.g. with CREATE OR REPLACE TABLE in a script). If the table exists with 
+    a different partitioning/clustering, the new table should be written to a
+    temp table that then replaces it (see `replace_table`).
+    
+    Args:
+        table_id: string, full id of the table to be written
+        partition_by: string (default None), name of the column the new table 
+            is partitioned by (per month)
+        cluster_by: list (default None), names of the columns the new table is
+            clustered by
+            
+    Returns:
+        string, full id of the table to write to - table_id, or table_id with 
+            "_fdm_tmp" appended if it needs replacing
+    """
+    try:
+        existing_table = CLIENT.get_table(table_id)
+    except NotFound:
+        return table_id
+    partitioning = (bigquery.TimePartitioning(
+        type_=bigquery.TimePartitioningType.MONTH, field=partition_by
+    ) if partition_by is not None else None)
+    if (get_table_spec(existing_table.time_partitioning, 
+                       existing_table.clustering_fields)
+            == get_table_spec(partitioning, cluster_by)):
+        return table_id
+    return f"{table_id}_fdm_tmp"
+
+
+def replace_table(table_id, replacement_table_id):
+    """Replaces a table with another table in the same dataset
+    
+    Used when a table's partitioning/clustering changes, which neither a query
+    nor a copy can do in place. The table is deleted and the replacement is 
+    renamed to take its place (renaming doesn't scan or copy any data). 
+    Between the delete and the rename the table doesn't exist - anything 
+    reading it then fails - and if the rename fails the data is left in the 
+    replacement table.
+    
+    Args:
+        table_id: string, full id of the table to be replaced
+        replacement_table_id: string, full id of the table replacing it
+        
+    Returns:
+        None - all changes in GCP
+    """
+    CLIENT.delete_table(table_id, not_found_ok=True)
+    run_sql_query(f"""
+        ALTER TABLE `{replacement_table_id}` 
+        RENAME TO `{table_id.split(".")[-1]}`
+    """)
+
+
+def get_partition_and_cluster_sql(partition_by=None, partition_type=None, 
+                                  cluster_by=None):
+    """Generates the PARTITION BY/CLUSTER BY clauses of a CREATE TABLE statement
+    
+    Equivalent of the partition_by/cluster_by arguments of `run_sql_query` for
+    tables created in SQL scripts.
+    
+    Args:
+        partition_by: string (default None), name of a column to partition the 
+            table by, one partition per month
+        partition_type: string (default None), data type of the partition_by 
+            column - one of "DATE", "DATETIME", "TIMESTAMP"
+        cluster_by: list (default None), names of up to 4 columns to cluster 
+            the table by
+            
+    Returns:
+        string, the clauses (empty if the table isn't partitioned/clustered)
+    """
+    truncate_functions = {"DATE": "DATE_TRUNC", 
+                          "DATETIME": "DATETIME_TRUNC", 
+                          "TIMESTAMP": "TIMESTAMP_TRUNC"}
+    clauses = []
+    if partition_by is not None:
+        if partition_type not in truncate_functions:
+            raise ValueError(f"Can't partition by {partition_by} - must be a "
+                             "DATE, DATETIME or TIMESTAMP column")
+        clauses.append(f"PARTITION BY {truncate_functions[partition_type]}"
+                       f"({partition_by}, MONTH)")
+    if cluster_by:
+        clauses.append(f"CLUSTER BY {', '.join(cluster_by)}")
+    return "\n".join(clauses)
+
+
+def is_unsupported_copy_error(error):
+    """Checks if an error means BigQuery can't clone/copy a table this way
+    
+    e.g. the source is a view, or is in another region, or cloning isn't 
+    permitted - as opposed to errors in the request itself (quota, network 
+    etc.), which shouldn't be retried another way.
+    
+    Args:
+        error: Exception, raised by a clone/copy
+        
+    Returns:
+        bool, True if the table should be copied another way
+    """
+    return (isinstance(error, (BadRequest, Forbidden))
+            and any(reason.get("reason") in UNSUPPORTED_COPY_REASONS 
+                    for reason in error.errors))
+
+
+def clone_table(source_table_id, destination_table_id):
+    """Copies a table as cheaply as BigQuery allows
+    
+    Tries, in order: 
+    
+    1. a table clone - metadata only, no bytes scanned or billed, storage 
+       only billed for data that later changes
+    2. a copy job - no bytes scanned or billed
+    3. a `SELECT *` query - scans and bills the full table, but works for 
+       any source (e.g. views)
+    
+    The next method is only tried if BigQuery rejects the previous one (see 
+    `is_unsupported_copy_error`) - other errors are raised. Any existing table
+    at destination_table_id is overwritten, and is left as it was if every 
+    method fails.
+
+    Args:
+        source_table_id: string, full id of the table (or table snapshot) to 
+            be copied
+        destination_table_id: string, full id of the copy
+
+    Returns:
+        string, the method used: "clone", "copy" or "query"
+    """
+    try:
+        run_sql_query(f"""
+            CREATE OR REPLACE TABLE `{destination_table_id}` 
+            CLONE `{source_table_id}`
+        """)
+        return "clone"
+    except (BadRequest, Forbidden) as error:
+        if not is_unsupported_copy_error(error):
+            raise
+    try:
+        job_config = bigquery.CopyJobConfig(write_disposition="WRITE_TRUNCATE")
+        CLIENT.copy_table(source_table_id, destination_table_id, 
+                          job_config=job_config).result()
+        return "copy"
+    except (BadRequest, Forbidden) as error:
+        if not is_unsupported_copy_error(error):
+            raise
+    run_sql_query(f"SELECT * FROM `{source_table_id}`", 
+                  destination=destination_table_id)
+    return "query"
+
+
+def iter_bigquery_batches(sql, batch_size=100000):
+    """Streams the results of a sql query as Arrow record batches
+    
+    Uses the BigQuery Storage Read API if the google-cloud-bigquery-storage 
+    library is installed, otherwise pages through results with the REST API. 
+    Only a few batches are held in memory at any one time, so results larger
+    than memory can be processed batch by batch.
+    
+    Args:
+        sql: string, the SQL query to be run
+        batch_size: int (default 100000), number of rows per page when reading
+            via the REST API (the Storage Read API sets its own batch sizes)
+            
+    Returns:
+        generator, yielding pyarrow.RecordBatch objects
+    """
+    rows = CLIENT.query(sql).result(page_size=batch_size)
+    if bigquery_storage is not None:
+        bqstorage_client = bigquery_storage.BigQueryReadClient()
+    else:
+        bqstorage_client = None
+    for record_batch in rows.to_arrow_iterable(bqstorage_client=bqstorage_client):
+        yield record_batch
+        
+        
+def read_sql_batches(sql, batch_size=100000, batch_reader=iter_bigquery_batches):
+    """Iterates over the results of a sql query as pandas DataFrames
+    
+    Shared streaming read layer for anything that downloads query results - 
+    avoids holding a large result in memory all at once. 
+    
+    Args:
+        sql: string, the SQL query to be run
+        batch_size: int (default 100000), number of rows per batch (see 
+            iter_bigquery_batches)
+        batch_reader: function (default iter_bigquery_batches), takes sql and
+            batch_size arguments and returns an iterator of pyarrow.RecordBatch
+            objects - can be swapped for a local stand-in for testing (see 
+            `get_local_batch_reader` in testing_helpers)
+    
+    Returns:
+        generator, yielding a pandas.DataFrame for each batch of results
+        
+    Example:
+    ```python
+    # counts the rows in a large table without loading the whole table
+    n_rows = 0
+    for batch_df in read_sql_batches("SELECT * FROM `example.table.id`"):
+        n_rows += len(batch_df)
+    ```
+    """
+    for record_batch in batch_reader(sql, batch_size):
+        yield record_batch.to_pandas()
+        
+        
+def upload_to_bigquery(data, destination, schema, 
+                       write_disposition="WRITE_TRUNCATE"):
+    """Uploads a DataFrame/Arrow table to BigQuery with a load job
+    
+    Shared upload layer for anything that writes local data to BigQuery. The 
+    data is serialised to Parquet in memory and submitted as a single load job,
+    which is much faster than the row based uploads used by `to_gbq` for large
+    tables. Providing the schema explicitly means column types don't need to 
+    be inferred from the data (e.g. columns that are entirely NULL).
+    
+    Args:
+        data: pandas.DataFrame/pyarrow.Table, the data to be uploaded
+        destination: string, full id (project_id.dataset_id.table_id) of the
+            table to upload the data to
+        schema: list, containing a dict for each column with "name" and "type"
+            keys e.g. [{"name":"parsed_date", "type":"DATETIME"}] - matched to
+            the data's columns by name
+        write_disposition: string (default "WRITE_TRUNCATE"), what to do if the
+            destination table exists: "WRITE_TRUNCATE" replaces the table, 
+            "WRITE_APPEND" adds the data to it
+            
+    Returns:
+        bigquery.table.Table, containing table object of the uploaded table
+        
+    Example:
+    ```python
+    table = upload_to_bigquery(
+        data = pd.DataFrame({"id": [1, 2], "name": ["a", "b"]}),
+        destination = "project_id.dataset_id.table_id",
+        schema = [{"name":"id", "type":"INTEGER"}, 
+                  {"name":"name", "type":"STRING"}]
+    )
+    ```
+    """
+    if isinstance(data, pd.DataFrame):
+        data = pa.Table.from_pandas(data, preserve_index=False)
+    parquet_file = io.BytesIO()
+    pq.write_table(data, parquet_file, coerce_timestamps="us", 
+                   allow_truncated_timestamps=True)
+    parquet_file.seek(0)
+    
+    job_config = bigquery.LoadJobConfig(
+        source_format=bigquery.SourceFormat.PARQUET,
+        schema=[bigquery.SchemaField(field["name"], field["type"]) 
+                for field in schema],
+        write_disposition=write_disposition
+    )
+    load_job = CLIENT.load_table_from_file(parquet_file, destination, 
+                                           job_config=job_config)
+    load_job.result()  # Wait for the job to complete.
+    return CLIENT.get_table(destination)
+        
+        
+def read_sql_query(sql, batch_reader=iter_bigquery_batches):
+    """Reads the (small) results of a sql query into a pandas DataFrame
+    
+    Args:
+        sql: string, the SQL query to be run
+        batch_reader: function (default iter_bigquery_batches), see 
+            read_sql_batches
+            
+    Returns:
+        pandas.DataFrame, containing the query results
+    """
+    batch_dfs = list(read_sql_batches(sql, batch_reader=batch_reader))
+    if not batch_dfs:
+        return pd.DataFrame()
+    return pd.concat(batch_dfs, ignore_index=True)
 
         
 def check_dataset_exists(dataset_id):
@@ -199,6 +718,157 @@ def get_table_schema_dict(full_table_id):
             for field in table.schema}
                                                                                                           
     
+def get_dataset_metadata(dataset_id):
+    """Gets the metadata of every table in a dataset with a single query
+    
+    Reads table types, column names and data types, partitioning and 
+    clustering columns, row counts and last modified times for all tables in 
+    the dataset from INFORMATION_SCHEMA and __TABLES__ - far quicker than 
+    calling the API for each table in turn.
+    
+    Args:
+        dataset_id: string, id of the dataset (with or without project id - 
+            if no project id is given, PROJECT is used)
+        
+    Returns:
+        dict, full table id: metadata pairs, where metadata is a dict with 
+            "exists" (always True), "schema" (column name: column data type 
+            pairs, as in `get_table_schema_dict`), "modified" (datetime), 
+            "num_rows", "table_type" (e.g. "TABLE", "VIEW"), "partition_by" 
+            (name of the column the table is partitioned by, or None) and 
+            "cluster_by" (list of the columns the table is clustered by)
+    """
+    if "." in dataset_id:
+        dataset_path = dataset_id
+    else:
+        dataset_path = f"{PROJECT}.{dataset_id}"
+    metadata_sql = f"""
+        SELECT tables.table_name, tables.table_type, 
+            columns.column_name, columns.data_type, 
+            columns.is_partitioning_column, columns.clustering_ordinal_position,
+            storage.row_count, storage.last_modified_time
+        FROM `{dataset_path}.INFORMATION_SCHEMA.TABLES` AS tables
+        LEFT JOIN `{dataset_path}.INFORMATION_SCHEMA.COLUMNS` AS columns
+        ON tables.table_name = columns.table_name
+        LEFT JOIN `{dataset_path}.__TABLES__` AS storage
+        ON tables.table_name = storage.table_id
+        ORDER BY tables.table_name, columns.ordinal_position
+    """
+    dataset_metadata = {}
+    for row in read_sql_query(metadata_sql).itertuples():
+        full_table_id = f"{dataset_path}.{row.table_name}"
+        if full_table_id not in dataset_metadata:
+            if pd.isna(row.last_modified_time):
+                modified = None
+            else:
+                modified = datetime.datetime.fromtimestamp(
+                    row.last_modified_time / 1000, tz=datetime.timezone.utc
+                )
+            dataset_metadata[full_table_id] = {
+                "exists": True,
+                "schema": {},
+                "modified": modified,
+                "num_rows": None if pd.isna(row.row_count) else int(row.row_count),
+                # named as in the bigquery library's Table.table_type
+                "table_type": ("TABLE" if row.table_type == "BASE TABLE" 
+                               else row.table_type),
+                "partition_by": None,
+                "cluster_by": []
+            }
+            clustering_positions = {}
+        if not pd.isna(row.column_name):
+            dataset_metadata[full_table_id]["schema"][row.column_name] = (
+                get_legacy_data_type(row.data_type)
+            )
+            if row.is_partitioning_column == "YES":
+                dataset_metadata[full_table_id]["partition_by"] = row.column_name
+            if not pd.isna(row.clustering_ordinal_position):
+                clustering_positions[row.column_name] = (
+                    row.clustering_ordinal_position
+                )
+                dataset_metadata[full_table_id]["cluster_by"] = sorted(
+                    clustering_positions, key=clustering_positions.get
+                )
+    return dataset_metadata
+
+
+def get_legacy_data_type(data_type):
+    """Converts an INFORMATION_SCHEMA data type to a table schema data type
+    
+    e.g. "INT64" -> "INTEGER", "STRUCT<a STRING>" -> "RECORD". Arrays take 
+    the type of their elements, as in table schemas.
+    
+    Args:
+        data_type: string, data type from INFORMATION_SCHEMA.COLUMNS
+        
+    Returns:
+        string, the data type as it appears in table schemas from the bigquery 
+            library
+    """
+    if data_type.startswith("ARRAY<"):
+        data_type = data_type[len("ARRAY<"):-1]
+    # remove parameters e.g. STRING(10), NUMERIC(10, 2), STRUCT<...>
+    base_type = data_type.split("<")[0].split("(")[0].strip()
+    return LEGACY_DATA_TYPES.get(base_type, base_type)
+
+
+def run_dag(nodes, max_workers=1):
+    """Runs functions in order of their dependencies, concurrently where possible
+    
+    Each function is run (without arguments) once all the functions it depends
+    on have finished. Functions that don't depend on each other run at the same
+    time in a pool of threads - useful for submitting independent BigQuery jobs
+    together, as each thread spends most of its time waiting for its job. If a 
+    function raises an error, functions that are running are left to finish 
+    (their changes aren't undone), no more are started, and the error is raised.
+    
+    Functions that run at the same time mustn't share objects that aren't 
+    thread safe - e.g. an FDMTable, whose metadata cache isn't synchronised, 
+    should only be used by one node at a time (or by nodes that depend on 
+    each other).
+    
+    Args:
+        nodes: dict, node name: (function, list of names of nodes it depends 
+            on) pairs
+        max_workers: int (default 1), maximum number of functions run at once
+        
+    Returns:
+        dict, node name: value returned by its function pairs
+        
+    Example:
+    ```python
+    run_dag({
+        "a": (lambda: run_sql_query(a_sql, destination=a_id), []),
+        "b": (lambda: run_sql_query(b_sql, destination=b_id), []),
+        "a_and_b": (lambda: run_sql_query(a_and_b_sql), ["a", "b"])
+    }, max_workers=2)
+    ```
+    """
+    for name, (function, dependencies) in nodes.items():
+        unknown_dependencies = set(dependencies) - set(nodes.keys())
+        if unknown_dependencies:
+            raise ValueError(f"{name} depends on unknown nodes: "
+                             f"{', '.join(unknown_dependencies)}")
+    results = {}
+    waiting = dict(nodes)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        running = {}
+        while waiting or running:
+            ready = [name for name, (_, dependencies) in waiting.items() 
+                     if all(dependency in results 
+                            for dependency in dependencies)]
+            for name in ready:
+                function, _ = waiting.pop(name)
+                running[executor.submit(function)] = name
+            if not running:
+                raise ValueError("Circular dependencies between nodes: "
+                                 f"{', '.join(waiting.keys())}")
+            done, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+    return results
+    
+    
 def build_id_map_error_table(id_a, id_b, map_table, destination_dataset):
     
     count_a = f"COUNT({id_a}) OVER (PARTITION BY {id_a})"
@@ -1,8 +1,15 @@
 import datetime
+from FDMBuilder.FDM_date_parsing import *
 from FDMBuilder.FDM_helpers import *
+from FDMBuilder.FDMDataset import FDMDataset, MASTER_PERSON, PROBLEM_CODES
 from google.cloud import bigquery
 import pandas as pd
 import numpy as np 
+import pyarrow as pa
+import re
+import sqlite3
+import time
+import types
 
 
 # Set global variables
@@ -61,3 +68,657 @@ def sub_random_days(date, upper=3652):
     """
     n_rand_days = int(np.random.choice(range(upper)))
     return date - pd.offsets.DateOffset(days=n_rand_days)
+
+
+def get_local_batch_reader(df):
+    """Creates a local stand-in for reading query results from BigQuery
+    
+    The returned function can be passed as the `batch_reader` argument of 
+    `read_sql_batches`/`read_sql_query` (see FDM_helpers), to stream the 
+    contents of a local DataFrame in place of the results of a query. 
+    
+    Args:
+        df: pandas.DataFrame, data to be returned in place of query results
+        
+    Returns:
+        function, taking sql and batch_size arguments (sql is ignored) and 
+            returning an iterator of pyarrow.RecordBatch objects
+            
+    Example:
+    ```python
+    reader = get_local_batch_reader(pd.DataFrame({"date": ["15-Jan-2002"]}))
+    for batch_df in read_sql_batches("SELECT ...", batch_reader=reader):
+        print(batch_df)
+    ```
+    """
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    
+    def local_batch_reader(sql, batch_size):
+        return iter(table.to_batches(max_chunksize=batch_size))
+    
+    return local_batch_reader
+
+
+def benchmark_date_parsing(n=100000, date_format="DMY", 
+                           date_string_format="%d-%B-%Y"):
+    """Compares speed of the row by row and vectorised date parsers
+    
+    Generates n random date strings and times parsing them with dateutil one
+    row at a time (the original FDMTable parser) and with `parse_dates`.
+    
+    Args:
+        n: int, number of dates to generate
+        date_format: string, one of "YMD", "YDM", "DMY", "MDY" - passed to
+            both parsers
+        date_string_format: string, strftime format used to write the random 
+            dates as strings e.g. "%d-%B-%Y" gives "15-January-2002"
+        
+    Returns:
+        dict, seconds taken by each parser, the speedup and whether the two
+            parsers gave identical results
+    """
+    yearfirst, dayfirst = DATE_FORMAT_SETTINGS[date_format]
+    dates = generate_random_dates(n).dt.strftime(date_string_format).astype(object)
+    
+    start = time.time()
+    dateutil_parsed = dates.apply(parse_date_with_dateutil, 
+                                  yearfirst=yearfirst, 
+                                  dayfirst=dayfirst)
+    dateutil_seconds = time.time() - start
+    
+    start = time.time()
+    vectorised_parsed = parse_dates(dates, yearfirst=yearfirst, dayfirst=dayfirst)
+    vectorised_seconds = time.time() - start
+    
+    results = {
+        "dateutil_seconds": dateutil_seconds,
+        "vectorised_seconds": vectorised_seconds,
+        "speedup": dateutil_seconds / vectorised_seconds,
+        "results_match": bool(
+            (pd.to_datetime(dateutil_parsed) == vectorised_parsed).all()
+        )
+    }
+    print(f"Parsed {n} dates formatted {date_string_format}:\n"
+          f"    dateutil: {dateutil_seconds:.2f}s\n"
+          f"    vectorised: {vectorised_seconds:.2f}s\n"
+          f"    speedup: x{results['speedup']:.1f}\n"
+          f"    results match: {results['results_match']}")
+    return results
+
+
+def benchmark_upload(destination, n=1000000):
+    """Compares speed of uploading dates with to_gbq and upload_to_bigquery
+    
+    Generates n random raw/parsed date pairs (like the tmp_dates table used when
+    adding parsed dates to a table) and times uploading them to BigQuery with 
+    `DataFrame.to_gbq` and with the Parquet load job in `upload_to_bigquery`.
+    
+    Args:
+        destination: string, full id (project_id.dataset_id.table_id) of a 
+            table to upload to - overwritten by each upload and then deleted
+        n: int, number of rows to upload
+        
+    Returns:
+        dict, seconds taken by each upload method, rows per second for the 
+            load job and the speedup
+    """
+    dates_df = pd.DataFrame({"parsed_date": generate_random_dates(n)})
+    dates_df["raw_date"] = dates_df.parsed_date.dt.strftime("%d-%b-%Y")
+    table_schema = [{"name":"raw_date", "type":"STRING"},
+                    {"name":"parsed_date", "type":"DATETIME"}]
+    
+    start = time.time()
+    dates_df.to_gbq(destination_table=destination,
+                    project_id=PROJECT,
+                    table_schema=table_schema,
+                    if_exists="replace",
+                    progress_bar=False)
+    to_gbq_seconds = time.time() - start
+    
+    start = time.time()
+    upload_to_bigquery(dates_df, destination=destination, schema=table_schema)
+    load_job_seconds = time.time() - start
+    CLIENT.delete_table(destination, not_found_ok=True)
+    
+    results = {
+        "to_gbq_seconds": to_gbq_seconds,
+        "load_job_seconds": load_job_seconds,
+        "load_job_rows_per_second": n / load_job_seconds,
+        "speedup": to_gbq_seconds / load_job_seconds
+    }
+    print(f"Uploaded {n} rows:\n"
+          f"    to_gbq: {to_gbq_seconds:.2f}s\n"
+          f"    load job: {load_job_seconds:.2f}s "
+          f"({results['load_job_rows_per_second']:.0f} rows/s)\n"
+          f"    speedup: x{results['speedup']:.1f}")
+    return results
+
+
+def get_legacy_problem_entries_sql(person_table_id, table, extract_end_date,
+                                   includes_pre_natal=False):
+    """Generates the original problem entries query, with EXISTS subqueries
+    
+    The original form of `FDMDataset._get_problem_entries_sql`, with each rule
+    a correlated EXISTS subquery against the person table. Kept as a 
+    reference to check the join-based rules against (see 
+    `compare_problem_entries_sql`).
+    
+    Args:
+        person_table_id: string, full id of the person table to check against
+        table: FDMTable, table to be labelled
+        extract_end_date: string, end date of the data extract
+        includes_pre_natal: bool (default False), True if entries within the 
+            pre-natal period aren't problems, False if they are
+            
+    Returns:
+        string, SQL query returning the table with an fdm_problem column
+    """
+    no_person_id = "person_id IS NULL"
+    person_id_not_in_master = f"""
+        NOT EXISTS(
+            SELECT person_id
+            FROM `{person_table_id}` as person
+            WHERE person.person_id = src.person_id
+        )
+    """
+    person_has_no_dob = f"""
+        EXISTS(
+            SELECT person_id
+            FROM `{person_table_id}` as person
+            WHERE person.person_id = src.person_id
+                AND person.birth_datetime IS NULL
+        )
+    """
+    no_fdm_start_date = "fdm_start_date is NULL"
+    fdm_start_before_pre_natal_period = f"""
+        EXISTS(
+            SELECT birth_datetime
+            FROM `{person_table_id}` AS person
+            WHERE src.person_id = person.person_id 
+                AND DATETIME_ADD(
+                    src.fdm_start_date, 
+                    INTERVAL 294 DAY) < person.birth_datetime
+        )
+    """       
+    fdm_start_after_death = f"""
+        EXISTS(
+            SELECT death_datetime
+            FROM `{person_table_id}` AS person
+            WHERE src.person_id = person.person_id 
+                AND person.death_datetime IS NOT NULL
+                AND src.fdm_start_date > DATETIME_ADD(person.death_datetime,
+                                                        INTERVAL 42 DAY)
+        )
+    """
+    fdm_start_after_extract_end = f"""
+        EXISTS(
+            SELECT fdm_start_date
+            FROM `{person_table_id}` AS person
+            WHERE src.person_id = person.person_id 
+                AND src.fdm_start_date > CAST("{extract_end_date}" AS DATETIME)
+        )
+    """
+    messages_with_problem_cases = {
+        "Entry has no person_id": no_person_id,
+        "person_id isn't in master person table": person_id_not_in_master,
+        "person has no bith_datetime in master person table": person_has_no_dob,
+        "Entry has no fdm_start_date": no_fdm_start_date,
+        "fdm_start_date is before person birth_datetime": 
+        fdm_start_before_pre_natal_period,
+        "fdm_start_date is after death_datetime (+42 days)": 
+        fdm_start_after_death,
+        "fdm_start_date is after the end date for the data extract":
+        fdm_start_after_extract_end
+    }
+    if "fdm_end_date" in table.get_column_names():
+        no_fdm_end_date = "fdm_end_date is NULL"
+        end_before_start = "fdm_end_date < fdm_start_date"
+        fdm_end_before_birth = f"""
+            EXISTS(
+                SELECT birth_datetime
+                FROM `{person_table_id}` AS person
+                WHERE src.person_id = person.person_id 
+                    AND src.fdm_end_date < person.birth_datetime
+            )
+        """
+        fdm_end_after_death = f"""
+            EXISTS(
+                SELECT death_datetime
+                FROM `{person_table_id}` AS person
+                WHERE src.person_id = person.person_id 
+                    AND person.death_datetime IS NOT NULL
+                    AND src.fdm_end_date > DATETIME_ADD(person.death_datetime, 
+                                                          INTERVAL 42 DAY)
+            )
+        """
+        fdm_end_after_extract_end = f"""
+            EXISTS(
+                SELECT fdm_end_date
+                FROM `{person_table_id}` AS person
+                WHERE src.person_id = person.person_id 
+                    AND src.fdm_end_date > CAST("{extract_end_date}" AS DATETIME)
+            )
+        """
+        messages_with_problem_cases[
+            "Entry has no fdm_end_date"
+        ] = no_fdm_end_date
+        messages_with_problem_cases[
+            "fdm_end_date is before fdm_start_date"
+        ] = end_before_start
+        messages_with_problem_cases[
+            "fdm_end_date is before person birth_datetime" 
+        ] = fdm_end_before_birth
+        messages_with_problem_cases[
+            "fdm_end_date is after person death_datetime"
+        ] = fdm_end_after_death
+        messages_with_problem_cases[
+            "fdm_end_date is after extract end date"
+        ] = fdm_end_after_extract_end
+
+    if not includes_pre_natal:
+        fdm_start_in_pre_natal_period = f"""
+            EXISTS(
+                SELECT birth_datetime
+                FROM `{person_table_id}` AS person
+                WHERE src.person_id = person.person_id 
+                    AND src.fdm_start_date < person.birth_datetime
+                    AND DATETIME_ADD(
+                        src.fdm_start_date, 
+                        INTERVAL 300 DAY) >= person.birth_datetime
+            )
+        """       
+        messages_with_problem_cases[
+            "fdm_start_date is before person birth_datetime - Note: Within pre-natal period" 
+        ] = fdm_start_in_pre_natal_period
+
+    problem_col_cases = ("CASE " + " ".join([
+        f'WHEN {problem_sql} THEN "{problem_text}"'
+        for problem_text, problem_sql in messages_with_problem_cases.items()
+    ]) + ' ELSE "No problem" END')
+
+    problem_tab_sql = f"""
+        SELECT {problem_col_cases} AS fdm_problem, *
+        FROM `{table.full_table_id}` AS src
+        ORDER BY person_id
+    """
+
+    return problem_tab_sql
+
+
+def compare_problem_entries_sql(fdm_dataset, extract_end_date, 
+                                includes_pre_natal=False):
+    """Checks the join-based problem rules label entries as the original rules
+    
+    Regression test for `FDMDataset._get_problem_entries_sql`: runs it (with 
+    problem codes mapped back to their text - see PROBLEM_CODES) and the
+    original EXISTS based query (see `get_legacy_problem_entries_sql`) against
+    each table in the dataset, and counts the labelled rows that appear a 
+    different number of times in each result. Both read the master person 
+    table, and require source tables without problems columns e.g. the 
+    tutorial test tables (see build_tutorial_test_tables.py).
+    
+    Args:
+        fdm_dataset: FDMDataset, dataset with the `tables` attribute set (see 
+            `FDMDataset._get_fdm_tables`)
+        extract_end_date: string, end date of the data extract
+        includes_pre_natal: bool (default False), passed to both queries
+        
+    Returns:
+        dict, table id: number of differing rows - all 0 if the rules match
+        
+    Example:
+    ```python
+    fdm_dataset = FDMDataset("CY_FDM_BUILDER_TESTS")
+    fdm_dataset._get_fdm_tables(excluded_tables=[])
+    compare_problem_entries_sql(fdm_dataset, extract_end_date="2022-12-31")
+    ```
+    """
+    n_differences = {}
+    for table in fdm_dataset.tables:
+        legacy_sql = get_legacy_problem_entries_sql(MASTER_PERSON,
+                                                    table, 
+                                                    extract_end_date, 
+                                                    includes_pre_natal)
+        coded_sql = fdm_dataset._get_problem_entries_sql(table, 
+                                                         extract_end_date, 
+                                                         includes_pre_natal)
+        problem_text_cases = ("CASE fdm_problem " + " ".join([
+            f'WHEN {code} THEN "{problem_text}"'
+            for problem_text, code in PROBLEM_CODES.items()
+        ]) + ' ELSE "No problem" END')
+        joined_sql = f"""
+            SELECT {problem_text_cases} AS fdm_problem, 
+                * EXCEPT(fdm_problem, fdm_problem_flags)
+            FROM ({coded_sql})
+        """
+        compare_sql = f"""
+            WITH legacy AS (
+                SELECT TO_JSON_STRING(legacy_rows) AS row_json, COUNT(*) AS n
+                FROM ({legacy_sql}) AS legacy_rows
+                GROUP BY row_json
+            ),
+            joined AS (
+                SELECT TO_JSON_STRING(joined_rows) AS row_json, COUNT(*) AS n
+                FROM ({joined_sql}) AS joined_rows
+                GROUP BY row_json
+            )
+            SELECT COUNT(*) AS n
+            FROM legacy
+            FULL OUTER JOIN joined
+            ON legacy.row_json = joined.row_json
+            WHERE legacy.n IS DISTINCT FROM joined.n
+        """
+        n_differences[table.table_id] = int(read_sql_query(compare_sql).n[0])
+        print(f"    {table.table_id}: {n_differences[table.table_id]} "
+              "differing rows")
+    return n_differences
+
+
+def check_problem_entries_sql(extract_end_date="2022-12-31"):
+    """Checks the structure of the problem entries query, without BigQuery
+    
+    Generates `FDMDataset._get_problem_entries_sql` for a stand-in table, with 
+    and without an fdm_end_date column and with includes_pre_natal True and 
+    False, and checks that:
+    
+        1. the fdm_problem CASE has a WHEN for each expected rule, in order of 
+           problem code, and an ELSE 0
+        2. fdm_problem_flags sets bit (code - 1) for each rule, with the same
+           predicate as the rule's WHEN
+        3. rules only refer to the src and person aliases, and rules testing a
+           person column IS NULL check the person exists
+        4. the master person table is LEFT JOINed exactly once
+    
+    Complements `compare_problem_entries_locally` and 
+    `compare_problem_entries_sql`, which check the labels the query produces.
+    
+    Args:
+        extract_end_date: string (default "2022-12-31"), end date of the data
+            extract used in the generated query
+            
+    Returns:
+        None - raises an AssertionError describing the first failed check
+        
+    Example:
+    ```python
+    check_problem_entries_sql()
+    ```
+    """
+    # only the query building methods are used, so no dataset is needed
+    fdm_dataset = FDMDataset.__new__(FDMDataset)
+    start_codes = list(range(1, 8))
+    end_codes = list(range(8, 13))
+    pre_natal_code = PROBLEM_CODES[
+        "fdm_start_date is before person birth_datetime - Note: Within "
+        "pre-natal period"
+    ]
+    for has_end_date in [True, False]:
+        for includes_pre_natal in [True, False]:
+            column_names = ["person_id", "fdm_start_date"]
+            if has_end_date:
+                column_names.append("fdm_end_date")
+            table = types.SimpleNamespace(
+                full_table_id=f"{PROJECT}.CHECK_DATASET.check_table",
+                get_column_names=lambda column_names=column_names: column_names
+            )
+            sql = fdm_dataset._get_problem_entries_sql(table, extract_end_date,
+                                                       includes_pre_natal)
+            case = f"end date: {has_end_date}, pre-natal: {includes_pre_natal}"
+            
+            expected_codes = (start_codes 
+                              + (end_codes if has_end_date else [])
+                              + ([] if includes_pre_natal else [pre_natal_code]))
+            case_sql = re.search(r"CASE (.*) ELSE 0 END AS fdm_problem,", sql, 
+                                 re.DOTALL)
+            assert case_sql is not None, f"{case}: no fdm_problem CASE"
+            rules = re.findall(r"WHEN (.*?) THEN (\d+)", case_sql.group(1))
+            rule_codes = [int(code) for _, code in rules]
+            assert rule_codes == expected_codes, (
+                f"{case}: rule codes {rule_codes}, expected {expected_codes}"
+            )
+            
+            flags_sql = re.search(r"AS fdm_problem,(.*) AS fdm_problem_flags", 
+                                  sql, re.DOTALL)
+            assert flags_sql is not None, f"{case}: no fdm_problem_flags"
+            flags = re.findall(r"IF\((.*?), (\d+), 0\)", flags_sql.group(1))
+            assert len(flags) == len(rules), (
+                f"{case}: {len(flags)} flags for {len(rules)} rules"
+            )
+            for (rule_sql, code), (flag_sql, bit) in zip(rules, flags):
+                assert flag_sql == rule_sql, (
+                    f"{case}: flag and rule predicates differ for code {code}"
+                )
+                assert int(bit) == 1 << (int(code) - 1), (
+                    f"{case}: code {code} sets bit value {bit}"
+                )
+                
+            for rule_sql, code in rules:
+                aliases = set(re.findall(r"\b(\w+)\.\w+", rule_sql))
+                assert aliases <= {"src", "person"}, (
+                    f"{case}: code {code} refers to {aliases - {'src', 'person'}}"
+                )
+                tests_person_null = re.search(
+                    r"person\.(?!person_id)\w+ IS NULL", rule_sql
+                )
+                assert (not tests_person_null 
+                        or "person.person_id IS NOT NULL" in rule_sql), (
+                    f"{case}: code {code} doesn't check the person exists"
+                )
+                
+            assert sql.count("JOIN") == 1 and "LEFT JOIN" in sql, (
+                f"{case}: expected a single LEFT JOIN"
+            )
+            assert f"FROM `{MASTER_PERSON}`" in sql, (
+                f"{case}: master person table isn't joined"
+            )
+    print("    problem entries query checks passed")
+
+
+def get_sqlite_problem_entries_sql(sql, table_ids):
+    """Translates a problem entries query from BigQuery SQL to sqlite
+    
+    Only handles the SQL used by `FDMDataset._get_problem_entries_sql` and 
+    `get_legacy_problem_entries_sql` - DATETIME_ADD with a DAY interval, CAST
+    of a string AS DATETIME, IF, QUALIFY, double quoted strings and backticked
+    table ids. Datetimes are compared as sqlite "YYYY-MM-DD HH:MM:SS" strings.
+    
+    Args:
+        sql: string, BigQuery SQL query
+        table_ids: dict, full table id: sqlite table name pairs
+        
+    Returns:
+        string, the query in sqlite SQL
+    """
+    for table_id, table_name in table_ids.items():
+        sql = sql.replace(f"`{table_id}`", table_name)
+    sql = re.sub(r'"([^"]*)"', 
+                 lambda match: "'" + match.group(1).replace("'", "''") + "'", 
+                 sql)
+    sql = re.sub(r"CAST\(('[^']*') AS DATETIME\)", r"datetime(\1)", sql)
+    sql = re.sub(r"DATETIME_ADD\(\s*([\w.]+),\s*INTERVAL (\d+) DAY\)", 
+                 r"datetime(\1, '+\2 days')", sql)
+    sql = re.sub(r"\bIF\(", "IIF(", sql)
+    # sqlite has no QUALIFY, so the window function is filtered in a subquery
+    sql = re.sub(
+        r"SELECT (?P<columns>[\w, ]+?)\s+FROM (?P<table>\w+)\s+"
+        r"WHERE (?P<condition>.+?)\s+QUALIFY (?P<window>.+?\))\s*= 1",
+        r"SELECT \g<columns> FROM (SELECT *, \g<window> AS fdm_row_number "
+        r"FROM \g<table> WHERE \g<condition>) WHERE fdm_row_number = 1",
+        sql, flags=re.DOTALL
+    )
+    return sql
+
+
+def compare_problem_entries_locally(extract_end_date="2022-12-31"):
+    """Checks the problem rules label a small fixture as the original rules
+    
+    Regression test for `FDMDataset._get_problem_entries_sql`, run without 
+    BigQuery: a fixture of source and master person rows - with entries 
+    either side of each rule's boundary (e.g. the 294/300 day pre-natal 
+    periods, 42 days after death, the extract end date), missing values and a
+    duplicated person - is loaded into an in-memory sqlite database. The 
+    query and the original EXISTS based query (see 
+    `get_legacy_problem_entries_sql`) are translated to sqlite (see 
+    `get_sqlite_problem_entries_sql`) and run against it, with and without an
+    fdm_end_date column and with includes_pre_natal True and False. Checks 
+    that:
+    
+        1. both queries return the same number of rows
+        2. each entry's fdm_problem code is the code of the original query's 
+           problem (0 for "No problem")
+        3. each entry's fdm_problem_flags has the bit set for each rule whose
+           original predicate is true for it, other than the intended 
+           differences: "person_id isn't in master person table" isn't 
+           flagged for entries with no person_id, and the extract end date 
+           rules are flagged for entries whose person isn't in the master 
+           person table
+    
+    Args:
+        extract_end_date: string (default "2022-12-31"), end date of the data
+            extract - the fixture's dates are relative to 2022-12-31
+            
+    Returns:
+        None - raises an AssertionError describing the first failed check
+        
+    Example:
+    ```python
+    compare_problem_entries_locally()
+    ```
+    """
+    fdm_dataset = FDMDataset.__new__(FDMDataset)
+    source_table_id = f"{PROJECT}.CHECK_DATASET.check_table"
+    # person_id, birth_datetime, death_datetime - person 4 appears twice
+    person_rows = [
+        (1, "2000-06-15 00:00:00", None),
+        (2, None, None),
+        (3, "1950-01-01 00:00:00", "2010-01-01 00:00:00"),
+        (4, "1990-01-01 00:00:00", None),
+        (4, "1990-01-01 00:00:00", None),
+    ]
+    # entry_id, person_id, fdm_start_date, fdm_end_date
+    source_rows = [
+        (1, None, "2010-01-01 00:00:00", "2010-01-02 00:00:00"),
+        (2, 99, "2010-01-01 00:00:00", "2010-01-02 00:00:00"),
+        (3, 99, "2023-01-01 00:00:00", "2023-01-02 00:00:00"),
+        (4, 2, "2010-01-01 00:00:00", "2010-01-02 00:00:00"),
+        (5, 1, None, "2010-01-02 00:00:00"),
+        # 295, 294, 293 and 1 day(s) before birth, and on the birth date
+        (6, 1, "1999-08-25 00:00:00", "2010-01-02 00:00:00"),
+        (7, 1, "1999-08-26 00:00:00", "2010-01-02 00:00:00"),
+        (8, 1, "1999-08-27 00:00:00", "2010-01-02 00:00:00"),
+        (9, 1, "2000-06-14 00:00:00", "2010-01-02 00:00:00"),
+        (10, 1, "2000-06-15 00:00:00", "2010-01-02 00:00:00"),
+        # 300 and 301 days before birth
+        (11, 1, "1999-08-20 00:00:00", "2010-01-02 00:00:00"),
+        (12, 1, "1999-08-19 00:00:00", "2010-01-02 00:00:00"),
+        # 42 days after death, and a second later
+        (13, 3, "2010-02-12 00:00:00", "2010-02-12 00:00:00"),
+        (14, 3, "2010-02-12 00:00:01", "2010-02-12 00:00:01"),
+        # on the extract end date, and a second later
+        (15, 1, "2022-12-31 00:00:00", "2022-12-31 00:00:00"),
+        (16, 1, "2022-12-31 00:00:01", "2022-12-31 00:00:01"),
+        (17, 1, "2010-01-01 00:00:00", None),
+        (18, 1, "2010-01-01 00:00:00", "2009-12-31 00:00:00"),
+        (19, 1, "2000-06-16 00:00:00", "2000-06-14 00:00:00"),
+        (20, 3, "2010-01-01 00:00:00", "2010-02-12 00:00:01"),
+        (21, 1, "2022-12-01 00:00:00", "2023-01-01 00:00:00"),
+        (22, 4, "2010-01-01 00:00:00", "2010-01-02 00:00:00"),
+        (23, 4, "1989-01-01 00:00:00", "2010-01-02 00:00:00"),
+    ]
+    problem_codes = dict(PROBLEM_CODES, **{"No problem": 0})
+    
+    for has_end_date in [True, False]:
+        for includes_pre_natal in [True, False]:
+            case = f"end date: {has_end_date}, pre-natal: {includes_pre_natal}"
+            column_names = ["entry_id", "person_id", "fdm_start_date"]
+            if has_end_date:
+                column_names.append("fdm_end_date")
+            table = types.SimpleNamespace(
+                full_table_id=source_table_id,
+                get_column_names=lambda column_names=column_names: column_names
+            )
+            connection = sqlite3.connect(":memory:")
+            connection.execute("CREATE TABLE master_person "
+                               "(person_id, birth_datetime, death_datetime)")
+            connection.executemany("INSERT INTO master_person VALUES (?, ?, ?)",
+                                   person_rows)
+            connection.execute(f"CREATE TABLE src_table "
+                               f"({', '.join(column_names)})")
+            connection.executemany(
+                f"INSERT INTO src_table VALUES "
+                f"({', '.join(['?'] * len(column_names))})",
+                [row[:len(column_names)] for row in source_rows]
+            )
+            table_ids = {source_table_id: "src_table", 
+                         MASTER_PERSON: "master_person"}
+            
+            def run_query(sql):
+                return pd.read_sql_query(
+                    get_sqlite_problem_entries_sql(sql, table_ids), connection
+                )
+            
+            coded_df = run_query(fdm_dataset._get_problem_entries_sql(
+                table, extract_end_date, includes_pre_natal
+            ))
+            legacy_df = run_query(get_legacy_problem_entries_sql(
+                MASTER_PERSON, table, extract_end_date, includes_pre_natal
+            ))
+            assert len(coded_df) == len(legacy_df) == len(source_rows), (
+                f"{case}: {len(coded_df)} labelled rows, {len(legacy_df)} "
+                f"original rows, from {len(source_rows)} entries"
+            )
+            legacy_codes = legacy_df.set_index("entry_id").fdm_problem.map(
+                problem_codes
+            )
+            coded_df = coded_df.set_index("entry_id")
+            for entry_id, code in coded_df.fdm_problem.items():
+                assert code == legacy_codes[entry_id], (
+                    f"{case}: entry {entry_id} has code {code}, originally "
+                    f"{legacy_codes[entry_id]}"
+                )
+                
+            # each original rule evaluated on its own, as a flag
+            legacy_rules = re.search(
+                r"CASE (.*) ELSE", 
+                get_legacy_problem_entries_sql(MASTER_PERSON, table, 
+                                               extract_end_date, 
+                                               includes_pre_natal),
+                re.DOTALL
+            ).group(1)
+            legacy_flags_sql = " | ".join(
+                f"IF({rule_sql}, {1 << (PROBLEM_CODES[problem_text] - 1)}, 0)"
+                for rule_sql, problem_text in re.findall(
+                    r'WHEN (.*?) THEN "([^"]*)"', legacy_rules, re.DOTALL
+                )
+            )
+            legacy_flags = run_query(f"""
+                SELECT entry_id, {legacy_flags_sql} AS flags
+                FROM `{source_table_id}` AS src
+            """).set_index("entry_id")["flags"]
+            not_in_master_bit = 1 << (
+                PROBLEM_CODES["person_id isn't in master person table"] - 1
+            )
+            extract_end_bits = [
+                1 << (PROBLEM_CODES[problem_text] - 1) 
+                for problem_text in [
+                    "fdm_start_date is after the end date for the data extract",
+                    "fdm_end_date is after extract end date"
+                ] 
+                if has_end_date or "fdm_end_date" not in problem_text
+            ]
+            for entry_id, person_id, start_date, *end_date in source_rows:
+                expected_flags = int(legacy_flags[entry_id])
+                if person_id is None:
+                    expected_flags &= ~not_in_master_bit
+                elif expected_flags & not_in_master_bit:
+                    for bit, date in zip(extract_end_bits, 
+                                         [start_date] + end_date[:1]):
+                        if date is not None and date > f"{extract_end_date} 00:00:00":
+                            expected_flags |= bit
+                flags = int(coded_df.fdm_problem_flags[entry_id])
+                assert flags == expected_flags, (
+                    f"{case}: entry {entry_id} has flags {flags:b}, expected "
+                    f"{expected_flags:b}"
+                )
+            connection.close()
+    print("    problem entries match the original rules")
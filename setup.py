@@ -5,7 +5,8 @@ setup(
     packages=find_packages(),
     version="0.1.0",
     install_requires=["google-cloud-bigquery", "pandas", "numpy", 
-                      "python-dateutil", "pandas-gbq"],
+                      "python-dateutil", "pandas-gbq", "pyarrow"],
+    extras_require={"storage": ["google-cloud-bigquery-storage"]},
     description="Tools to build FDM Datasets for CYP",
     author="Sam Relins",
     licence="MIT"